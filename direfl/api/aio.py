@@ -0,0 +1,163 @@
+# This program is public domain
+"""
+Asyncio interface to phase reconstruction, inversion and simulation.
+
+The calculations are CPU bound, so :func:`reconstruct_async`,
+:func:`invert_async` and :func:`simulate_async` run them on an executor
+and return an :class:`AsyncJob` right away.  Await the job for the result,
+or iterate over it for :class:`Progress` events as the noise stages are
+computed::
+
+    >>> job = invert_async(data=(Q, RealR, dRealR), thickness=200)
+    >>> async for event in job:
+    ...     print(event.step, event.done, event.total)
+    >>> inversion = await job
+
+Cancelling the task which awaits the job, or calling :meth:`AsyncJob.cancel`,
+stops the calculation at the end of the current stage, and awaiting the job
+then raises asyncio.CancelledError.
+
+By default the jobs run on the event loop's default executor.  Pass any
+:class:`concurrent.futures.ThreadPoolExecutor` as *executor*, or set
+*EXECUTOR*, to control how many run at once.  Progress and cancellation
+rely on the job sharing memory with the event loop, so process pools are
+not supported; use :mod:`direfl.api.service` to spread jobs over processes.
+"""
+
+import asyncio
+import threading
+from collections import namedtuple
+
+# Executor used when none is given, or None for the loop default
+EXECUTOR = None
+
+Progress = namedtuple('Progress', ['step', 'done', 'total'])
+Progress.__doc__ = """\
+Stages *done* of *total* for the calculation *step*, which is 'reconstruct'
+or 'invert'.
+"""
+
+
+class AsyncJob(object):
+    """
+    Calculation running on an executor.
+
+    Await the job for its result, or use *async for* to receive
+    :class:`Progress` events until it completes.  Create jobs with
+    :func:`reconstruct_async`, :func:`invert_async` or
+    :func:`simulate_async` from within a running event loop.
+    """
+    def __init__(self, function, executor=None):
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._cancelled = threading.Event()
+        if executor is None:
+            executor = EXECUTOR
+        self._future = self._loop.run_in_executor(executor, function,
+                                                  self._progress)
+
+    def cancel(self):
+        """Stop the calculation at the end of the current stage."""
+        self._cancelled.set()
+
+    def done(self):
+        """Return True if the calculation has finished."""
+        return self._future.done()
+
+    def __await__(self):
+        return self._result().__await__()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _result(self):
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            raise
+
+    async def _iterate(self):
+        while True:
+            event = asyncio.ensure_future(self._events.get())
+            await asyncio.wait([event, self._future],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if event.done():
+                yield event.result()
+                continue
+            event.cancel()
+            while not self._events.empty():
+                yield self._events.get_nowait()
+            return
+
+    def _progress(self, step, done, total):
+        """Report progress from the executor, stopping if cancelled."""
+        if self._cancelled.is_set():
+            raise asyncio.CancelledError()
+        self._loop.call_soon_threadsafe(self._events.put_nowait,
+                                        Progress(step, done, total))
+
+
+def reconstruct_async(file1, file2, u, v1, v2, executor=None, **kw):
+    """
+    Return an :class:`AsyncJob` for :func:`direfl.api.invert.reconstruct`.
+
+    The job reports the 'reconstruct' step and its result is the
+    :class:`SurroundVariation`.
+    """
+    def run(progress):
+        from .invert import SurroundVariation
+        return SurroundVariation(file1, file2, u, v1, v2,
+                                 progress=_step(progress, 'reconstruct'), **kw)
+    return AsyncJob(run, executor=executor)
+
+
+def invert_async(executor=None, **kw):
+    """
+    Return an :class:`AsyncJob` for :func:`direfl.api.invert.invert`.
+
+    The keywords are the :class:`Inversion` controls.  The job reports the
+    'invert' step and its result is the :class:`Inversion`.
+    """
+    def run(progress):
+        from .invert import Inversion
+        inverter = Inversion(progress=_step(progress, 'invert'), **kw)
+        try:
+            inverter.run()
+        finally:
+            inverter.progress = None
+        return inverter
+    return AsyncJob(run, executor=executor)
+
+
+def simulate_async(executor=None, **kw):
+    """
+    Return an :class:`AsyncJob` for :class:`direfl.api.simulate.Simulation`.
+
+    The keywords are the :class:`Simulation` parameters.  The job reports
+    the 'reconstruct' and 'invert' steps and its result is the
+    :class:`Simulation`.
+    """
+    def run(progress):
+        from .simulate import Simulation
+        args = dict(kw)
+        args['phase_args'] = dict(kw.get('phase_args', {}),
+                                  progress=_step(progress, 'reconstruct'))
+        args['invert_args'] = dict(kw.get('invert_args', {}),
+                                   progress=_step(progress, 'invert'))
+        sim = Simulation(run=False, **args)
+        try:
+            sim.run()
+        finally:
+            # Later runs should not report to this job
+            sim.phase_args = kw.get('phase_args', {})
+            sim.invert_args = kw.get('invert_args', {})
+            if getattr(sim, 'invert', None) is not None:
+                sim.invert.progress = None
+        return sim
+    return AsyncJob(run, executor=executor)
+
+
+def _step(progress, step):
+    """Return progress(done, total) reporting for *step*."""
+    return lambda done, total: progress(step, done, total)
@@ -8,6 +8,14 @@ reflectivity, reflectivity_amplitude:
     reflectivity returns the magnitude squared of the waveform.  The
     function reflectivity_amplitude returns the complex waveform.
 
+reflectivity_amplitude_batch:
+    Complex waveform for a set of slab models sharing the same Q points,
+    evaluated in a single call to the underlying kernel.
+
+reflectivity_amplitude_hybrid:
+    Complex waveform for a finely sliced profile using the exact
+    calculation at low Q and a kinematic approximation at high Q.
+
 magnetic_reflectivity, magnetic_amplitude, unpolarized_magnetic:
     Slab model with supporting magnetic scattering.  The function
     magnetic_reflectivity returns the magnitude squared for the four
@@ -19,14 +27,23 @@ magnetic_reflectivity, magnetic_amplitude, unpolarized_magnetic:
 convolve, fixedres, varyingres
     Functions for estimating the resolution and convolving the
     the profile with the resolution function.
+
+ResolutionOperator:
+    Precomputed resolution convolution for repeated use with the same
+    theory and measurement points.
+
+resolution_padding, adaptive_theory:
+    Choose theory points dense enough for an accurate convolution.
 """
 
 __doc__ = "Fundamental reflectivity calculations"
 __author__ = "Paul Kienzle"
 __all__ = ['reflectivity', 'reflectivity_amplitude',
+           'reflectivity_amplitude_batch', 'reflectivity_amplitude_hybrid',
            'magnetic_reflectivity', 'magnetic_amplitude',
            'unpolarized_magnetic',
-           'fixedres', 'varyingres', 'convolve'
+           'fixedres', 'varyingres', 'convolve', 'ResolutionOperator',
+           'resolution_padding', 'adaptive_theory',
           ]
 
 from functools import reduce
@@ -48,7 +65,10 @@ def reflectivity(*args, **kw):
         points at which to evaluate the reflectivity
     depth (angstrom)
         thickness of the individual layers (incident and substrate
-        depths are ignored)
+        depths are ignored).  This may be a scalar if all the interior
+        layers have the same thickness, as for the uniform profiles
+        returned by direct inversion, in which case a faster kernel
+        is used for profiles without roughness.
     rho (microNb)
         Scattering length density.
     mu (microNb)
@@ -80,6 +100,10 @@ def reflectivity_amplitude(Q,
 
     See reflectivity for details.
     """
+    if np.isscalar(depth):
+        return reflectivity_amplitude_batch(Q, depth, [rho], mu=mu,
+                                            sigma=sigma,
+                                            wavelength=wavelength)[0]
     Q = _dense(Q, 'd')
     R = np.empty(Q.shape, 'D')
 
@@ -102,6 +126,173 @@ def reflectivity_amplitude(Q,
         reflmodule._reflectivity_amplitude(rho, mu, depth, wavelength, Q, R)
     return R
 
+def reflectivity_amplitude_batch(Q,
+                                 depth,
+                                 rho,
+                                 mu=0,
+                                 sigma=None,
+                                 wavelength=1,
+                                 ):
+    """
+    Returns the complex reflectivity waveform for P profiles at once.
+
+    *depth*, *rho* and *mu* have shape (P, N) for P profiles of N layers
+    each.  Any of them may instead be a single profile of length N, or
+    a scalar, which is shared by all profiles.  A scalar *depth* is the
+    thickness of every interior layer.  *sigma* may
+    likewise be None, a scalar, a vector of N-1 interfaces or an array
+    of shape (P, N-1).
+
+    Returns an array of shape (P, len(Q)).
+
+    See reflectivity for details.
+    """
+    Q = _dense(Q, 'd')
+    rho = np.atleast_2d(np.asarray(rho, 'd'))
+    P, n = rho.shape
+    R = np.empty((P, len(Q)), 'D')
+
+    if np.isscalar(wavelength):
+        wavelength = wavelength*np.ones(Q.shape, 'd')
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(n-1, 'd')
+    uniform = np.isscalar(depth) and sigma is None
+    if np.isscalar(depth) and not uniform:
+        depth = np.hstack((0, depth*np.ones(n-2, 'd'), 0))
+
+    mu = np.broadcast_to(mu, (P, n))
+    wavelength, rho, mu = [_dense(v, 'd') for v in (wavelength, rho, mu)]
+
+    rho, mu = [v*1e-6 for v in (rho, mu)]
+    if uniform:
+        reflmodule._reflectivity_amplitude_uniform(
+            P, rho, mu, float(depth), wavelength, Q, R)
+        return R
+
+    depth = _dense(np.broadcast_to(depth, (P, n)), 'd')
+    if sigma is not None:
+        sigma = _dense(np.broadcast_to(sigma, (P, n-1)), 'd')
+        reflmodule._reflectivity_amplitude_rough_batch(
+            P, rho, mu, depth, sigma, wavelength, Q, R)
+    else:
+        reflmodule._reflectivity_amplitude_batch(
+            P, rho, mu, depth, wavelength, Q, R)
+    return R
+
+
+def reflectivity_amplitude_hybrid(Q,
+                                  depth,
+                                  rho,
+                                  Qcut=None,
+                                  tol=5e-3,
+                                  terms=2,
+                                  oversample=64,
+                                  ):
+    """
+    Returns the complex reflectivity waveform and its estimated error,
+    using the exact calculation below *Qcut* and a kinematic approximation
+    above it.
+
+    The parameters are as follows:
+
+    Q (angstrom**-1)
+        points at which to evaluate the reflectivity
+    depth (angstrom)
+        thickness of each interior layer; the profile must be on an
+        equally spaced grid, such as those returned by direct inversion.
+    rho (microNb)
+        Scattering length density, including incident and substrate.
+    Qcut (angstrom**-1)
+        use the kinematic approximation for abs(Q) >= Qcut.  If Qcut is
+        None, choose the lowest value for which the error is below *tol*.
+    tol
+        relative RMS error allowed above the automatically chosen Qcut.
+    terms
+        order of the refraction correction to the kinematic phase.
+    oversample
+        zero padding factor for the FFT, which controls the error of
+        interpolating from the FFT grid to Q.
+
+    Far above the critical edge the reflectivity of a smooth profile is
+    well approximated by the Fourier transform of d rho/dz.  The phase of
+    the wave within the film is corrected for refraction to first order
+    in rho/Q^2 by expanding exp(-8i pi C(z)/Q) in powers of 1/Q, where
+    C(z) is the integrated excess SLD above z, so that each term is one
+    FFT of the profile.  With the default *terms* this is accurate to a
+    few parts per thousand from about ten times the critical edge Q.
+
+    The exact reflectivity is computed at a subset of check points above
+    the cut, and the returned error is the relative RMS difference
+    between the kinematic and exact values at those points.
+
+    This function does not compute roughness or absorption.
+    """
+    Q = _dense(Q, 'd')
+    rho = _dense(rho, 'd')
+    R = np.empty(Q.shape, 'D')
+
+    # Check points spread evenly across abs(Q)
+    order = np.argsort(abs(Q))
+    check = order[np.unique(np.linspace(0, len(Q)-1, 32).astype(int))]
+    Rexact = reflectivity_amplitude(Q[check], depth, rho)
+
+    Rkin = np.empty(Q.shape, 'D')
+    pos = Q >= 0
+    Rkin[pos] = _kinematic(Q[pos], depth, rho, terms, oversample)
+    Rkin[~pos] = _kinematic(-Q[~pos], depth, rho[::-1], terms, oversample)
+
+    # err[i] is the error over all check points with abs(Q) >= abs(Q[i])
+    diff = np.cumsum(abs(Rkin[check]-Rexact)[::-1]**2)[::-1]
+    norm = np.cumsum(abs(Rexact[::-1])**2)[::-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        err = np.sqrt(diff/norm)
+    if Qcut is None:
+        # Cut just above the last check point which is out of tolerance
+        bad = np.nonzero(~(err <= tol))[0]
+        first = bad[-1]+1 if len(bad) else 0
+        Qcut = abs(Q[check[first]]) if first < len(check) else np.inf
+    above = np.nonzero(abs(Q[check]) >= Qcut)[0]
+    error = err[above[0]] if len(above) else 0.
+
+    exact = abs(Q) < Qcut
+    R[~exact] = Rkin[~exact]
+    if exact.any():
+        R[exact] = reflectivity_amplitude(Q[exact], depth, rho)
+    R[check] = Rexact
+    return R, error
+
+
+def _kinematic(Q, depth, rho, terms, oversample):
+    """
+    Kinematic reflectivity amplitude for Q >= 0, with a refraction
+    correction to the phase.  See reflectivity_amplitude_hybrid.
+    """
+    if len(Q) == 0:
+        return np.empty(0, 'D')
+    rho = rho*1e-6
+    drho = np.diff(rho)
+    # Excess SLD integrated from the surface to each interface
+    C = np.hstack((0, np.cumsum(rho[1:-1]-rho[0])*depth))
+    # Sum_j f_j exp(i Q z_j) on the FFT grid Q_m = 2 pi m / (M depth);
+    # the sum is periodic in Q so we can interpolate with that period.
+    M = 2**int(np.ceil(np.log2(oversample*len(drho))))
+    period = 2*pi/depth
+    Qm = np.arange(M+1)*period/M
+    Qw = np.fmod(Q, period)
+    S = np.zeros(Q.shape, 'D')
+    coeff = drho
+    for k in range(terms+1):
+        if k > 0:
+            coeff = coeff*C/k
+        F = np.fft.ifft(coeff, M)*M
+        F = np.hstack((F, F[0]))
+        Fk = np.interp(Qw, Qm, F.real) + 1j*np.interp(Qw, Qm, F.imag)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            S += (-8j*pi/Q)**k * Fk
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 4*pi/Q**2 * S
+
+
 
 def magnetic_reflectivity(*args, **kw):
     """
@@ -212,11 +403,310 @@ def varyingres(wavelength, dLoL, dToT, Q):
     return dQ
 
 
-def convolve(Qi, Ri, Q, dQ):
+def convolve(Qi, Ri, Q, dQ, mode='direct'):
     """
     Return convolution R[k] of width dQ[k] at points Q[k].
+
+    *mode* selects the algorithm:
+
+    direct
+        Integrate the linear spline through (*Qi*, *Ri*) against the
+        gaussian window for each point separately.
+    fft
+        For constant *dQ*, resample the theory on a uniform grid and
+        convolve using an FFT.  For constant *dQ/Q*, do the same on a
+        uniform grid in log *Q*, where the resolution is shift invariant.
+        The result is interpolated back to *Q*, and agrees with *direct*
+        to a relative 1e-3.  Raises ValueError if the resolution is neither.
+    auto
+        Use *fft* for dense theory curves with constant *dQ* or *dQ/Q*,
+        otherwise use *direct*.
+
+    The default is *direct*.
     """
+    if mode not in ('auto', 'direct', 'fft'):
+        raise ValueError("mode should be auto, direct or fft")
+    Q = np.asarray(Q, 'd')
+    dQ = np.asarray(dQ, 'd')*np.ones(Q.shape)
+    if mode == 'fft' or (mode == 'auto' and len(Qi) >= _FFT_MIN_POINTS):
+        R = _convolve_fft(np.asarray(Qi, 'd'), np.asarray(Ri, 'd'), Q, dQ)
+        if R is not None:
+            return R
+        if mode == 'fft':
+            raise ValueError("fft convolution needs constant dQ or dQ/Q")
     R = np.empty(Q.shape, 'd')
     reflmodule._convolve(_dense(Qi, 'd'), _dense(Ri, 'd'),
                          _dense(Q, 'd'), _dense(dQ, 'd'), R)
     return R
+
+
+# Theory curves shorter than this use direct convolution in auto mode
+_FFT_MIN_POINTS = 2000
+# Grid steps per resolution width for fft convolution
+_FFT_STEPS = 20
+# Largest grid for fft convolution
+_FFT_MAX_POINTS = 2**22
+
+
+def _convolve_fft(Qi, Ri, Q, dQ):
+    """
+    FFT convolution for constant dQ or dQ/Q, or None if neither applies.
+    """
+    if len(Q) == 0 or not (dQ > 0).all():
+        return None
+    order = np.argsort(Qi)
+    Qi, Ri = Qi[order], Ri[order]
+    limit = np.sqrt(-2*_LOG_RESLIMIT)
+    logq = np.ptp(dQ) > 1e-10*dQ[0]
+    if not logq:
+        # Constant dQ: gaussian window on a uniform grid in Q
+        sigma = dQ[0]
+        x, y = Qi, Q
+        width = limit*sigma
+    else:
+        # Constant dQ/Q: with Q' = Q exp(t) the window is
+        #     G(Q'-Q; sQ) dQ' = G(exp(t)-1; s) exp(t) dt
+        # which does not depend on Q, so use a uniform grid in log Q.
+        if not ((Qi > 0).all() and (Q > 0).all()
+                or (Qi < 0).all() and (Q < 0).all()):
+            return None
+        dQoQ = dQ/abs(Q)
+        sigma = dQoQ[0]
+        if np.ptp(dQoQ) > 1e-10*sigma or limit*sigma >= 1:
+            return None
+        x, y = np.log(abs(Qi)), np.log(abs(Q))
+        if Qi[0] < 0:
+            x, Ri = x[::-1], Ri[::-1]
+        width = -np.log1p(-limit*sigma)
+
+    # Uniform grid fine enough for both the theory and the resolution
+    step = min(sigma/_FFT_STEPS, np.median(np.diff(x)))
+    n = int((x[-1]-x[0])/step) + 2
+    if n > _FFT_MAX_POINTS:
+        return None
+    grid, step = np.linspace(x[0], x[-1], n, retstep=True)
+    m = int(min(np.ceil(width/step), n))
+    # Weight for theory point x' at output x is kernel(x'-x), so reverse it
+    t = np.arange(m, -m-1, -1)*step
+    if logq:
+        weights = np.exp(-0.5*(np.expm1(t)/sigma)**2 + t)
+    else:
+        weights = np.exp(-0.5*(t/sigma)**2)
+
+    # Normalize by the part of the window covered by the theory curve,
+    # with trapezoid weights so the ends match the direct integral
+    size = 2**int(np.ceil(np.log2(n + 2*m)))
+    K = np.fft.rfft(weights, size)
+    def _conv(v):
+        return np.fft.irfft(np.fft.rfft(v, size)*K, size)[m:m+n]
+    ends = np.ones(n)
+    ends[[0, -1]] = 0.5
+    Rs = _conv(ends*np.interp(grid, x, Ri))/_conv(ends)
+    return np.interp(y, grid, Rs)
+
+
+# Gaussian tails below 0.1% of the peak are ignored, as in resolution.c
+_LOG_RESLIMIT = np.log(0.001)
+
+
+def resolution_padding(step, dQ):
+    """
+    Return the number of steps of size *step* needed beyond a measured
+    point to cover its resolution window of width *dQ*.
+
+    This is the numpy equivalent of resolution_padding in resolution.c.
+    """
+    limit = np.sqrt(-2*np.asarray(dQ, 'd')**2*_LOG_RESLIMIT)
+    return np.ceil(limit/step).astype(int)
+
+
+def adaptive_theory(f, Q, dQ, tol=1e-3, levels=6):
+    """
+    Choose theory points for the resolution convolution at *Q* with
+    width *dQ*, returning (Qt, Rt) with Rt = f(Qt).
+
+    *f* computes the theory function for a vector of Q values.  It may
+    return a single curve or a stack of curves, one per row, in which case
+    the refinement is driven by the worst of them.
+
+    The measured points are padded on either end to cover the resolution
+    window (see :func:`resolution_padding`) and filled in so that the
+    spacing is no coarser than the local resolution width.  Each interval
+    is then bisected, and the midpoint kept and refined further if the
+    theory function there differs from the linear spline by more than a
+    relative *tol*.  The refinement stops after *levels* bisections, so
+    critical edges and fringes from thick layers are sampled densely
+    while smooth parts of the curve use few evaluations.
+
+    Use :class:`ResolutionOperator` to convolve the result back to *Q*.
+    """
+    Q = np.asarray(Q, 'd')
+    dQ = np.asarray(dQ, 'd')*np.ones(Q.shape)
+    if not (dQ > 0).any() or len(Q) < 2:
+        return Q, f(Q)
+    # Repeated points use the narrowest of their resolutions
+    order = np.argsort(Q, kind='mergesort')
+    Qs, first = np.unique(Q[order], return_index=True)
+    if len(Qs) < 2:
+        return Q, f(Q)
+    dQs = np.minimum.reduceat(dQ[order], first)
+
+    # Fill in gaps wider than the resolution
+    h = np.diff(Qs)
+    w = np.minimum(dQs[:-1], dQs[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = np.where(w > 0, np.ceil(h/w), 1)
+    k = np.clip(k, 1, 2**levels).astype(int)
+    fill = [Qs[i] + h[i]*np.arange(1, k[i])/k[i]
+            for i in np.nonzero(k > 1)[0]]
+
+    # Pad the ends, without crossing Q = 0
+    lo_step = min(h[0], dQs[0]) if dQs[0] > 0 else h[0]
+    hi_step = min(h[-1], dQs[-1]) if dQs[-1] > 0 else h[-1]
+    n_lo = resolution_padding(lo_step, dQs[0])
+    n_hi = resolution_padding(hi_step, dQs[-1])
+    pad_lo = Qs[0] - lo_step*np.arange(n_lo, 0, -1)
+    pad_hi = Qs[-1] + hi_step*np.arange(1, n_hi+1)
+    if Qs[0] >= 0:
+        pad_lo = pad_lo[pad_lo >= 0]
+    if Qs[-1] <= 0:
+        pad_hi = pad_hi[pad_hi <= 0]
+
+    Qt = np.unique(np.hstack([pad_lo, Qs, pad_hi] + fill))
+    Rt = np.asarray(f(Qt))
+    single = Rt.ndim == 1
+    Rt = np.atleast_2d(Rt)
+
+    # Bisect intervals where the curve is not linear to within tol
+    active = np.ones(len(Qt)-1, bool)
+    for _ in range(levels):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        mid = 0.5*(Qt[idx]+Qt[idx+1])
+        Rm = np.atleast_2d(f(mid))
+        left, right = Rt[:, idx], Rt[:, idx+1]
+        scale = np.maximum(np.maximum(abs(left), abs(right)), abs(Rm))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            err = abs(Rm - 0.5*(left+right))/scale
+        refine = (err > tol).any(axis=0)
+
+        # Insert the midpoints; the children of a refined interval are active
+        pos = idx + 1 + np.arange(len(idx))
+        Qt = np.insert(Qt, idx+1, mid)
+        Rt = np.insert(Rt, idx+1, Rm, axis=1)
+        active = np.insert(active, idx+1, refine)
+        active[pos-1] = refine
+
+    return Qt, (Rt[0] if single else Rt)
+
+
+class ResolutionOperator(object):
+    """
+    Resolution convolution from theory points *Qi* to measured points *Q*
+    with gaussian width *dQ*, stored as a sparse matrix.
+
+    The weights are those of :func:`convolve` in direct mode: the theory
+    curve is treated as a linear spline, integrated analytically against a
+    gaussian truncated where it falls below 0.1% of its peak, and normalized
+    by the area of the truncated gaussian.  Since the convolution is linear
+    in the theory values, the weights only need to be computed once for a
+    given (*Qi*, *Q*, *dQ*), after which applying the resolution is a
+    single sparse matrix product::
+
+        resolution = ResolutionOperator(Qi, Q, dQ)
+        R = resolution(Ri)       # Ri has shape (len(Qi),) or (n, len(Qi))
+
+    A width of zero gives linear interpolation at that point.  Unlike
+    :func:`convolve`, the theory points need not be sorted.
+
+    The sparse matrix is available as *matrix*, with shape (len(Q), len(Qi)).
+    """
+    def __init__(self, Qi, Q, dQ):
+        from scipy import sparse
+        from scipy.special import erf
+
+        Qi, Q = [np.array(v, 'd') for v in (Qi, Q)]
+        dQ = np.array(dQ, 'd')*np.ones(Q.shape)
+        if len(Qi) < 2:
+            raise ValueError("need at least two theory points")
+        self.Qi, self.Q, self.dQ = Qi, Q, dQ
+
+        # Work with sorted theory points and map back to the inputs at the end
+        order = np.argsort(Qi, kind='mergesort')
+        Qs = Qi[order]
+        n = len(Qs)
+
+        # Window [lo, hi] matching the loop bounds in resolution.c
+        limit = np.sqrt(-2*dQ**2*_LOG_RESLIMIT)
+        lo = np.maximum(np.searchsorted(Qs, Q-limit, 'right')-1, 0)
+        hi = np.minimum(np.searchsorted(Qs, Q+limit, 'left'), n-1)
+        hi = np.minimum(np.maximum(hi, lo+1), n-1)
+        smooth = dQ > 0
+
+        # Flatten the windows into a list of (row, theory point) nodes
+        count = np.where(smooth, hi-lo+1, 2)
+        rows = np.repeat(np.arange(len(Q)), count)
+        start = np.cumsum(count)-count
+        offset = np.arange(len(rows)) - start[rows]
+        first = offset == 0
+
+        # Gaussian integrals over each linear spline segment in the window.
+        # The segment ending at node k contributes
+        #     A (R[k] + m z[k]) + B m,  m = (R[k]-R[k-1])/h
+        # with A = (erf[k]-erf[k-1])/2 and B = -sigma/sqrt(2 pi) (G[k]-G[k-1])
+        # for z = Q-Qi, so its weights are A + (A z + B)/h on R[k] and
+        # -(A z + B)/h on R[k-1].
+        col = np.minimum(lo[rows]+offset, n-1)
+        sigma = np.where(smooth, dQ, 1)[rows]
+        z = Q[rows] - Qs[col]
+        G = np.exp(-0.5*(z/sigma)**2)
+        E = erf(-z/(np.sqrt(2)*sigma))
+        h = np.hstack((0, np.diff(Qs[col])))
+        A = 0.5*np.hstack((0, np.diff(E)))
+        B = -sigma/np.sqrt(2*pi)*np.hstack((0, np.diff(G)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            C = np.where(h != 0, (A*z+B)/h, 0)
+        A[h == 0] = 0
+        A[first] = C[first] = 0
+        # Normalize by the area of the truncated gaussian
+        last = start+count-1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm = (2/(E[last]-E[start]))[rows]
+        wk = norm*(A+C)
+        wprev = -norm*C
+
+        # Linear interpolation (or extrapolation past the end) for dQ = 0
+        sharp = ~smooth[rows]
+        if sharp.any():
+            left = np.minimum(lo, n-2)[rows[sharp]]
+            col[sharp] = left + offset[sharp]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (Q[rows[sharp]]-Qs[left])/(Qs[left+1]-Qs[left])
+            wk[sharp] = np.where(first[sharp], 1-t, t)
+            wprev[sharp] = 0
+
+        row_idx = np.hstack((rows, rows[~first]))
+        col_idx = np.hstack((col, col[~first]-1))
+        weights = np.hstack((wk, wprev[~first]))
+        self.matrix = sparse.csr_matrix(
+            (weights, (row_idx, order[col_idx])), shape=(len(Q), n))
+
+    def matches(self, Qi, Q, dQ):
+        """
+        Return True if the operator was built for (*Qi*, *Q*, *dQ*).
+        """
+        dQ = np.asarray(dQ, 'd')*np.ones(np.shape(Q))
+        return all(np.shape(a) == b.shape and (np.asarray(a) == b).all()
+                   for a, b in ((Qi, self.Qi), (Q, self.Q), (dQ, self.dQ)))
+
+    def __call__(self, Ri):
+        """
+        Return the convolution of *Ri* at the measured points.
+
+        *Ri* may be a single curve or a stack of curves, one per row.
+        """
+        Ri = np.asarray(Ri)
+        if Ri.ndim == 1:
+            return self.matrix.dot(Ri)
+        return self.matrix.dot(Ri.T).T
@@ -36,6 +36,9 @@ Core classes and functions:
 * :func:`reconstruct`
    Phase reconstruction by surround variation magic.
 
+* :func:`load_results`
+   Load an inversion or reconstruction saved with *save_results*.
+
 * :func:`valid_f`
    Calculate vector function using only the finite elements of the array.
 
@@ -93,7 +96,7 @@ import numpy as np
 from numpy import (
     pi, inf, nan, sqrt, exp, sin, cos, tan, log,
     ceil, floor, real, imag, sign, isinf, isnan, isfinite,
-    diff, mean, std, arange, diag, isscalar)
+    diff, mean, std, arange, isscalar)
 from numpy.fft import fft
 
 # The following line is temporarily commented out because Sphinx on Windows
@@ -107,12 +110,17 @@ from numpy.fft import fft
 # these functions.
 #from numpy.random import uniform, poisson, normal
 
-from .calc import convolve
-from .util import isstr
+from .calc import (ResolutionOperator, adaptive_theory,
+                   reflectivity_amplitude_batch,
+                   reflectivity_amplitude_hybrid)
+from .util import isstr, cached_loadtxt, ResultCache, save_npz, load_npz
 
 # Custom colors
 DARK_RED = "#990000"
 
+# Version of the layout of the files written by save_results
+RESULTS_VERSION = 1
+
 # Common SLDs
 silicon = Si = 2.07
 sapphire = Al2O3 = 5.0
@@ -141,6 +149,83 @@ def invert(**kw):
     return inverter
 
 
+def invert_batch(Q, RealR, dRealR=None, **kw):
+    """
+    Invert a set of signals measured at the same *Q*, returning a list of
+    :class:`Inversion` objects, one for each row of *RealR*.
+
+    Each row is inverted with the keyword arguments *kw* exactly as
+    :class:`Inversion` would, ignoring the points where the row is not
+    finite, but the stages of all the rows are inverted together.  Rows
+    found in the result *cache* are not inverted again.  *seed* may also be
+    a list with a separate seed for each row.
+    """
+
+    RealR = np.atleast_2d(RealR)
+    if dRealR is not None:
+        dRealR = np.broadcast_to(dRealR, RealR.shape)
+    seeds = kw.pop('seed', None)
+    if np.ndim(seeds) == 0:
+        seeds = [seeds]*len(RealR)
+    elif len(seeds) != len(RealR):
+        raise ValueError("need one seed for each row")
+    inverters, signals = [], {}
+    for i, rer in enumerate(RealR):
+        keep = isfinite(rer)
+        if dRealR is None:
+            data = Q[keep], rer[keep]
+        else:
+            data = Q[keep], rer[keep], dRealR[i][keep]
+        inverter = Inversion(data=data, seed=seeds[i], **kw)
+        inverters.append(inverter)
+        if inverter._restore():
+            continue
+        q, stages = inverter._signals()
+        # Rows missing different points can mesh to different Q.
+        group = signals.setdefault((len(q), q[-1]), (q, []))[1]
+        group.append((inverter, stages))
+
+    for q, group in signals.values():
+        rows = [s[1] for _, stages in group for s in stages]
+        profiles = group[0][0]._profiles(q, rows)
+        for inverter, stages in group:
+            inverter.signals = stages
+            inverter.profiles, profiles = (profiles[:len(stages)],
+                                           profiles[len(stages):])
+            inverter._store()
+    return inverters
+
+
+def load_results(filename, mmap_mode='r'):
+    """
+    Load an :class:`Inversion` or :class:`SurroundVariation` saved by its
+    *save_results* method.
+
+    The arrays are memory mapped with *mmap_mode*, so the noisy stages of
+    an inversion are only read from disk when they are used.  Use
+    *mmap_mode=None* to read everything into memory.
+    """
+
+    metadata, arrays = load_npz(filename, mmap_mode=mmap_mode)
+    kind = metadata.get('kind')
+    if metadata.get('version', 0) > RESULTS_VERSION:
+        raise ValueError("%s needs a newer version of direfl"%filename)
+    if kind == 'Inversion':
+        return Inversion._from_results(metadata, arrays)
+    elif kind == 'SurroundVariation':
+        return SurroundVariation._from_results(metadata, arrays)
+    raise ValueError("%s does not contain saved results"%filename)
+
+
+def _result_cache(cache):
+    """
+    Returns *cache* as a :class:`ResultCache`, treating a string as the
+    name of its directory.
+    """
+
+    return ResultCache(cache) if isstr(cache) else cache
+
+
 class Inversion():
     """
     Class that implements the inversion calculator.
@@ -226,6 +311,8 @@ class Inversion():
       *stages* (4)          number of inversions to average over
       *noise* (1)           noise scale factor
       *monitor* (None)      incident beam intensity (poisson noise source)
+      *seed* (None)         random number seed for the noise, or None to use the
+                            global numpy generator
       ====================  =======================================================
 
     **Inversion controls:**
@@ -253,6 +340,15 @@ class Inversion():
                            graph to move to the next stage.
       *ctf_window* (0)     cosine transform smoothing. In practice, it is set to 0
                            for no smoothing.
+      *cache* (None)       :class:`ResultCache`, or the name of its directory, for
+                           reusing earlier results. The signals and profiles from
+                           a run with the same data and controls are loaded from
+                           the cache instead of being recomputed, including the
+                           noise of a run without a *seed*.
+      *progress* (None)    function called as progress(done, stages) as the
+                           stages are inverted.  The stages are inverted in up to
+                           ten groups, with a call after each group.  Raise an
+                           exception from *progress* to abandon the run.
       ===================  ========================================================
 
     **Computed profile:**
@@ -342,6 +438,14 @@ class Inversion():
     bse = 0
     showiters = False
     monitor = None
+    seed = None
+    cache = None
+    progress = None
+
+    # Controls which determine the signals and profiles computed by run()
+    _controls = ('substrate', 'thickness', 'calcpoints', 'rhopoints', 'Qmin',
+                 'Qmax', 'iters', 'stages', 'ctf_window', 'backrefl', 'noise',
+                 'bse', 'monitor', 'seed')
 
     def __init__(self, data=None, **kw):
         # Load the data
@@ -358,7 +462,7 @@ class Inversion():
         """
         Load data from a file of Q, real(R), dreal(R).
         """
-        data = np.loadtxt(file).T
+        data = cached_loadtxt(file).T
         self._setdata(data, name=file)
 
 
@@ -425,12 +529,79 @@ class Inversion():
         *profiles* to the list of generated (z, rho) profiles.
         """
 
-        from numpy.random import uniform, poisson, normal
-
         self._set(**kw)
+        if self._restore():
+            if self.progress is not None:
+                self.progress(len(self.profiles), len(self.profiles))
+            return
+        q, signals = self._signals()
+        rows = [s[1] for s in signals]
+        if self.progress is None:
+            profiles = self._profiles(q, rows)
+        else:
+            # Inverting the stages together is faster, so report progress
+            # for groups of stages rather than for each one.
+            profiles, step = [], max(1, -(-len(rows)//10))
+            for start in range(0, len(rows), step):
+                profiles.extend(self._profiles(q, rows[start:start+step]))
+                self.progress(len(profiles), len(rows))
+        self.signals, self.profiles = signals, profiles
+        self._store()
+
+
+    def _result_key(self):
+        """
+        Returns the result cache key for the input data and controls.
+        """
+
+        controls = dict((k, getattr(self, k)) for k in self._controls)
+        return ResultCache.key('Inversion', self.Qinput, self.RealRinput,
+                               self.dRealRinput, controls)
+
+
+    def _restore(self):
+        """
+        Sets *signals* and *profiles* from the result cache, returning
+        False if they are not there.
+        """
+
+        cache = _result_cache(self.cache)
+        result = cache.get(self._result_key()) if cache is not None else None
+        if result is None:
+            return False
+        q = result['Q']
+        self.signals = [(q, rer) for rer in result['RealR']]
+        self.profiles = list(zip(result['z'], result['rho']))
+        return True
+
+
+    def _store(self):
+        """
+        Saves *signals* and *profiles* to the result cache.
+        """
+
+        cache = _result_cache(self.cache)
+        if cache is not None:
+            cache.put(self._result_key(), dict(
+                Q=self.signals[0][0], RealR=[s[1] for s in self.signals],
+                z=[p[0] for p in self.profiles],
+                rho=[p[1] for p in self.profiles]))
+
+
+    def _signals(self):
+        """
+        Returns the meshed Q and the list of noisy (Q, RealR) signals for
+        each stage, starting with the noise-free signal.
+        """
+
+        if self.seed is None:
+            from numpy.random import uniform, poisson, normal
+        else:
+            rng = np.random.RandomState(self.seed)
+            uniform, poisson, normal = rng.uniform, rng.poisson, rng.normal
+
         q, rer, drer = self._remesh()
         signals = []
-        profiles = []
         stages = self.stages if self.noise > 0 else 1
         for i in range(stages):
             if i == 0:
@@ -447,23 +618,34 @@ class Inversion():
             else:
                 # Use 5% relative amplitude as noise source
                 noisyR = rer + normal(0, 1)*self.noise*0.05*abs(rer)
+            signals.append((q, noisyR))
+        return q, signals
 
-            ctf = self._transform(noisyR, Qmax=q[-1],
-                                  bse=self.bse, porder=1)
-            qp = self._invert(ctf, iters=self.iters)
+
+    def _profiles(self, q, signals):
+        """
+        Returns the list of (z, rho) profiles inverted from the *signals*
+        measured at the meshed points *q*.  The signals are inverted together.
+        """
+
+        signals = np.asarray(signals)
+        ctf = self._transform(signals, Qmax=q[-1], bse=self.bse, porder=1)
+        qp = self._invert(ctf, iters=self.iters)
+        profiles = []
+        for i in range(len(signals)):
             if self.showiters: # Show individual iterations
                 import pylab
                 pylab.cla()
                 for qpi in qp:
-                    pylab.plot(qpi[0], qpi[1])
+                    pylab.plot(qpi[0], qpi[1][i])
                 pylab.ginput(show_clicks=False)
-            z, rho = remesh(qp[-1], 0, self.thickness, self.rhopoints)
+            z, rho = remesh((qp[-1][0], qp[-1][1][i]),
+                            0, self.thickness, self.rhopoints)
 
             if not self.backrefl:
                 z, rho = z[::-1], rho[::-1]
-            signals.append((q, noisyR))
             profiles.append((z, rho))
-        self.signals, self.profiles = signals, profiles
+        return profiles
 
 
     def chisq(self):
@@ -545,7 +727,56 @@ class Inversion():
         fid.close()
 
 
-    def refl(self, Q=None, surround=None):
+    def save_results(self, outfile, dtype=None):
+        """
+        Save the input, controls, stages and profile to the .npz file
+        *outfile*.
+
+        Unlike :meth:`save`, every noisy signal and inverted profile is kept,
+        so the uncertainty analysis can be revisited without running the
+        inversion again.  Use :func:`load_results` to restore it.
+
+        **Parameters:**
+            *outfile:* file
+                Name of the file.
+            *dtype:* string
+                Type for the stage arrays, such as 'f4' to halve their size,
+                or None to keep full precision.
+
+        **Returns:**
+            *None*
+        """
+
+        controls = dict((k, getattr(self, k)) for k in self._controls)
+        metadata = dict(kind='Inversion', version=RESULTS_VERSION,
+                        name=self.name, controls=controls)
+        save_npz(outfile, dict(
+            Qinput=self.Qinput, RealRinput=self.RealRinput,
+            dRealRinput=self.dRealRinput,
+            stage_RealR=np.asarray([s[1] for s in self.signals], dtype),
+            stage_rho=np.asarray([p[1] for p in self.profiles], dtype),
+            Q=self.Q, RealR=self.RealR, dRealR=self.dRealR,
+            z=self.z, rho=self.rho, drho=self.drho), metadata)
+
+
+    @classmethod
+    def _from_results(cls, metadata, arrays):
+        """
+        Returns the inversion for the contents of a results file.
+        """
+
+        data = [arrays['Qinput'], arrays['RealRinput']]
+        if 'dRealRinput' in arrays:
+            data.append(arrays['dRealRinput'])
+        inverter = cls(data=data, **metadata['controls'])
+        inverter.name = metadata['name']
+        q, z = arrays['Q'], arrays['z']
+        inverter.signals = [(q, rer) for rer in arrays['stage_RealR']]
+        inverter.profiles = [(z, rho) for rho in arrays['stage_rho']]
+        return inverter
+
+
+    def refl(self, Q=None, surround=None, tol=None):
         """
         Return the complex reflectivity amplitude.
 
@@ -559,11 +790,44 @@ class Inversion():
                 compute the reflectivity of the reversed free film embedded in
                 the substrate to match against the reflectivity amplitude
                 supplied as input.
+            *tol:* float
+                If *tol* is provided, use the exact calculation only at low Q,
+                switching to a kinematic approximation at high Q where its
+                relative error is below *tol*.  This is much faster for
+                dense Q on fine profiles.  See
+                :func:`calc.reflectivity_amplitude_hybrid`.
 
         **Returns:**
             *None*
         """
 
+        return self._refl_profiles([self.rho], Q=Q, surround=surround,
+                                   tol=tol)[0]
+
+
+    def stage_refl(self, Q=None, surround=None):
+        """
+        Return the complex reflectivity amplitude for each stage.
+
+        This is :meth:`refl` computed for each of the inverted *profiles*
+        rather than for their average, with all stages evaluated in a
+        single call to the reflectivity kernel.
+
+        **Returns:**
+            *r:* array
+                Complex amplitude with shape (stages, len(Q)).
+        """
+
+        rhos = [p[1] + self.substrate for p in self.profiles]
+        return self._refl_profiles(rhos, Q=Q, surround=surround)
+
+
+    def _refl_profiles(self, rhos, Q=None, surround=None, tol=None):
+        """
+        Return the complex reflectivity amplitude for the profiles *rhos*
+        on the inversion grid *z*.
+        """
+
         if Q is None:
             Q = self.Q
         if self.backrefl:
@@ -574,10 +838,17 @@ class Inversion():
             # and has an implicit substrate in front and behind.
             surround = self.substrate
             Q = -Q
-        dz = np.hstack((0, diff(self.z), 0))
-        rho = np.hstack((surround, self.rho[1:], self.substrate))
-        r = refl(Q, dz, rho)
-        return  r
+        dz = layer_widths(self.z)
+        rho = [np.hstack((surround, r[1:], self.substrate)) for r in rhos]
+        if tol is not None:
+            # The kinematic approximation needs a uniform grid
+            step = self.z[1] - self.z[0]
+            if not np.allclose(diff(self.z), step):
+                raise ValueError("tol needs equally spaced z")
+            return np.array([reflectivity_amplitude_hybrid(Q, step, r,
+                                                           tol=tol)[0]
+                             for r in rho]).conj()
+        return refl_batch(Q, dz, rho)
 
 
     def plot(self, details=False, phase=None):
@@ -761,6 +1032,9 @@ class Inversion():
         """
         Returns the cosine transform function used by inversion.
 
+        *RealR* may have one row for each signal, in which case the
+        transform returns one row for each signal.
+
         *bse* is bound-state energy, with units of 10^-6 inv A^2.  It was used
         in the past to handle profiles with negative SLD at the beginning, but
         the the plain correction of bse=0 has since been found to be good
@@ -771,7 +1045,7 @@ class Inversion():
 
         if not 0 <= porder <= 6:
             raise ValueError("Polynomial order must be between 0 and 6")
-        npts = len(RealR)
+        npts = RealR.shape[-1]
         dK = 0.5 * Qmax / npts
         kappa = sqrt(bse*1e-6)
         dx = self.thickness/self.rhopoints
@@ -782,7 +1056,7 @@ class Inversion():
         # 1/sqrt(dim) is the normalization convention for Mathematica FFT
         ct = real(fft(RealR, dim)/sqrt(dim))
         convertfac = 2*dK/pi * sqrt(dim) * self.thickness
-        ctdatax = convertfac * ct[:len(xs)] # * rhoscale
+        ctdatax = convertfac * ct[..., :len(xs)] # * rhoscale
 
         ## PAK <--
         ## Mathematica guarantees that the interpolation function
@@ -804,15 +1078,21 @@ class Inversion():
         # This is the uncorrected Cosine Transform
         raw_ctf = Interpolator(xs, ctdatax, porder=porder)
         # This is the boundstate-corrected Cosine Transform
-        ctf = lambda x: raw_ctf(x) - exp(-kappa*x) * raw_ctf(0)
+        ctf = lambda x: raw_ctf(x) - exp(-kappa*x) * raw_ctf(np.zeros(1))
         return ctf
 
 
     def _invert(self, ctf, iters):
         """
         Perform the inversion.
+
+        If the transform *ctf* has one row for each signal then the
+        profiles in the returned (ut, q) pairs have one row for each signal.
         """
 
+        def pad(v, n):
+            return np.concatenate((v, np.zeros(v.shape[:-1]+(n,))), axis=-1)
+
         dz = 2/(self.calcpoints*self.rhopoints)
         x = arange(0, ceil(2/dz))*dz
         maxm = len(x)
@@ -820,32 +1100,41 @@ class Inversion():
             maxm += 1
         mx = int(maxm/2+0.5)
         h = 2/(2*mx-3)
-        g = np.hstack((ctf(x[:-1]*self.thickness), 0, 0, 0))
-        q = 2 * diff(g[:-2])/h
-        q[-1] = 0
+        g = pad(ctf(x[:-1]*self.thickness), 3)
+        q = 2 * diff(g[..., :-2])/h
+        q[..., -1] = 0
         ut = arange(2*mx-2)*h*self.thickness/2
         if self.ctf_window > 0:
             # Smooth ctf with 3-sample approximation
             du = self.ctf_window*h*self.thickness/2
             qinter = Interpolator(ut, q, porder=1)
             q = (qinter(ut - du) + qinter(ut) + qinter(ut + du))/3
-        q = np.hstack((q, 0))
+        q = pad(q, 1)
         qp = [(ut, -2*q*self.rhoscale)]
 
-        Delta = np.zeros((mx, 2*mx), 'd')
         for iter in range(iters):
+            # Row m of Delta only depends on rows m-1 and m-2, and only its
+            # diagonal is used, so keep just the last three rows.  Row m is
+            # only read over the range where it was written.
+            udiag = -g[..., :2*mx-2:2]
+            D2, D1, D = np.zeros((3,)+g.shape[:-1]+(2*mx,), 'd')
             for m in range(2, mx):
-                n = np.array(range(m, 2*mx-(m+1)))
-                Delta[m, n] = (
-                    h**2 * q[m-1] * (g[m+n] + Delta[m-1, n])
-                    + Delta[m-1, n+1] + Delta[m-1, n-1] - Delta[m-2, n])
-            udiag = -g[:2*mx-2:2] - diag(Delta)[:mx-1]
-            mup = len(udiag) - 2
+                n = slice(m, 2*mx-(m+1))
+                Dn = D[..., n]
+                np.add(g[..., 2*m:2*mx-1], D1[..., n], out=Dn)
+                Dn *= h**2 * q[..., m-1:m]
+                Dn += D1[..., m+1:2*mx-m]
+                Dn += D1[..., m-1:2*mx-m-2]
+                Dn -= D2[..., n]
+                if m < mx-1:
+                    udiag[..., m] -= D[..., m]
+                D2, D1, D = D1, D, D2
+            mup = udiag.shape[-1] - 2
             h = 1/mup
             ut = arange(mup)*h*self.thickness
-            q = 2 * diff(udiag[:-1])/h
+            q = 2 * diff(udiag[..., :-1])/h
             qp.append((ut, self.rhoscale*q))
-            q = np.hstack((q, 0, 0))
+            q = pad(q, 2)
         return qp
 
 
@@ -882,19 +1171,29 @@ def plotamp(Q, r, dr=None, scaled=True, ylabel="Real R", **kw):
 class Interpolator():
     """
     Construct an interpolation function from pairs (xi, yi).
+
+    If *yi* has one row for each function then the interpolated values
+    have one row for each function.
     """
 
     def __init__(self, xi, yi, porder=1):
-        if len(xi) != len(yi):
+        yi = np.asarray(yi)
+        if len(xi) != yi.shape[-1]:
             raise ValueError("xi:%d and yi:%d must have the same length"
-                             %(len(xi), len(yi)))
+                             %(len(xi), yi.shape[-1]))
         self.xi, self.yi = xi, yi
         self.porder = porder
         if porder != 1:
             raise NotImplementedError(
                 "Interpolator only supports polynomial order of 1")
     def __call__(self, x):
-        return np.interp(x, self.xi, self.yi)
+        if self.yi.ndim == 1:
+            return np.interp(x, self.xi, self.yi)
+        # Same weights as np.interp, shared by all rows.
+        xi = self.xi
+        j = np.clip(np.searchsorted(xi, x, 'right')-1, 0, len(xi)-2)
+        t = np.clip((x - xi[j])/(xi[j+1] - xi[j]), 0, 1)
+        return self.yi[..., j]*(1-t) + self.yi[..., j+1]*t
 
 
 def phase_shift(q, r, shift=0):
@@ -1021,7 +1320,272 @@ def _refl_calc(kz, wavelength, depth, rho, mu, sigma):
     return r
 
 
-def reconstruct(file1, file2, u, v1, v2, stages=100):
+def refl_repeat(Qz, depth, rho, repeats, mu=0, wavelength=1, sigma=0):
+    """
+    Reflectometry for a layer stack with repeated blocks of layers.
+
+    **Parameters:**
+        *Qz:* float|A
+            Scattering vector 4*pi*sin(theta)/wavelength. This is an array.
+        *depth:* float|A
+            Thickness of each layer, with each repeated layer given once.
+        *rho, mu (uNb):* (float, float)|
+            Scattering length density and absorption of each layer.
+        *repeats:* [(int, int, int)]
+            Repeated blocks as (start, end, count), meaning that layers
+            start to end-1 occur *count* times in succession.  The roughness
+            of layer end-1 is used between the copies.  Blocks may not
+            overlap, or include the incident medium or the substrate.
+        *wavelength:* float|A
+            Incident wavelength (angstrom).
+        *sigma:* float|A
+            Interfacial roughness, as for :func:`refl`.
+
+    :Returns:
+        *r* array of complex
+
+    The result is the same as :func:`refl` on the stack with the blocks
+    written out.  The transfer matrix of each block is computed once and
+    raised to the power count-1 by repeated squaring, so the cost grows
+    with the log of the number of repeats rather than the number of layers.
+    """
+
+    if isscalar(Qz):
+        Qz = np.array([Qz], 'd')
+    n = len(rho)
+    nQ = len(Qz)
+
+    kz = np.asarray(Qz, 'd')/2
+    depth = np.asarray(depth, 'd')
+    rho = np.asarray(rho, 'd')*1e-6
+    mu = (mu*np.ones(n, 'd') if isscalar(mu) else np.asarray(mu, 'd'))*1e-6
+    wavelength = wavelength*np.ones(nQ, 'd') \
+        if isscalar(wavelength) else np.asarray(wavelength, 'd')
+    sigma = sigma*np.ones(n-1, 'd') if isscalar(sigma) else np.asarray(sigma, 'd')
+
+    repeats = sorted(repeats)
+    end = 1
+    for start, stop, count in repeats:
+        if start < end or stop <= start or stop > n-1 or count < 1:
+            raise ValueError("invalid repeat (%d, %d, %d) for %d layers"
+                             % (start, stop, count, n))
+        end = stop
+
+    # For kz < 0 the layers are reversed, along with the blocks.  The
+    # interface between copies keeps the roughness at the end of the block.
+    forward = [(a, b, c, sigma[b-1]) for a, b, c in repeats]
+    reverse = [(n-b, n-a, c, sigma[b-1]) for a, b, c in reversed(repeats)]
+    idx = (kz >= 0)
+    r = np.empty(len(kz), 'D')
+    r[idx] = _refl_repeat_calc(kz[idx], wavelength[idx], depth, rho, mu,
+                               sigma, forward)
+    r[~idx] = _refl_repeat_calc(
+        abs(kz[~idx]), wavelength[~idx],
+        depth[-1::-1], rho[-1::-1], mu[-1::-1],
+        sigma[n-2::-1], reverse)
+    r[abs(kz) < 1.e-6] = -1  # reflectivity at kz=0 is -1
+    return r
+
+
+def _refl_repeat_calc(kz, wavelength, depth, rho, mu, sigma, repeats):
+    """Abeles matrix calculation with repeated blocks."""
+    if len(kz) == 0:
+        return kz
+
+    kz_sq = kz**2 + 4*pi*rho[0]
+    k = [kz] + [sqrt(kz_sq - (4*pi*rho[i] + 2j*pi*mu[i]/wavelength))
+                for i in range(1, len(rho))]
+
+    def layer(i, j, roughness):
+        # Step through layer i and across its interface with layer j,
+        # using the matrix [M11 M21; M12 M22] from _refl_calc.
+        F = (k[i] - k[j]) / (k[i] + k[j])
+        F *= exp(-2*k[i]*k[j]*roughness**2)
+        M = np.empty((len(kz), 2, 2), 'D')
+        M[:, 0, 0] = exp(1j*k[i]*depth[i]) if i > 0 else 1
+        M[:, 1, 1] = exp(-1j*k[i]*depth[i]) if i > 0 else 1
+        M[:, 0, 1] = F*M[:, 0, 0]
+        M[:, 1, 0] = F*M[:, 1, 1]
+        return M
+
+    def product(lo, hi):
+        B = np.zeros((len(kz), 2, 2), 'D')
+        B[:, 0, 0] = B[:, 1, 1] = 1
+        for i in range(lo, hi):
+            B = np.matmul(B, layer(i, i+1, sigma[i]))
+        return B
+
+    B = product(0, 0)
+    pos = 0
+    for start, end, count, roughness in repeats:
+        # All but the last copy cycle back to the start of the block; the
+        # last copy continues into the rest of the stack.
+        cycle = np.matmul(product(start, end-1),
+                          layer(end-1, start, roughness))
+        B = np.matmul(B, product(pos, start))
+        B = np.matmul(B, np.linalg.matrix_power(cycle, count-1))
+        pos = start
+    B = np.matmul(B, product(pos, len(rho)-1))
+
+    return B[:, 1, 0]/B[:, 0, 0]
+
+
+def refl_surround(Qz, depth, rho, media, sigma=0):
+    """
+    Reflectometry for one film in several surrounding media.
+
+    **Parameters:**
+        *Qz:* float|A
+            Scattering vector 4*pi*sin(theta)/wavelength. This is an array.
+        *depth:* float|A
+            Thickness of each layer.  The thickness of the incident medium
+            and substrate are ignored.
+        *rho:* float|uNb
+            Scattering length density of each layer.  The values for the
+            incident medium and substrate are ignored.
+        *media:* [(float, float, boolean)]
+            For each result, (*front*, *back*, *reverse*) giving the SLD of
+            the medium the beam comes from, the SLD of the medium it goes
+            into, and whether it passes through the film from the substrate
+            side rather than from the incident side.
+        *sigma:* float|A
+            Interfacial roughness, as for :func:`refl`.  The roughness of
+            the interface with the front or back medium is taken from the
+            side of the film which touches it.
+
+    :Returns:
+        *r* array of complex with shape (len(media), len(Qz))
+
+    Each row is the same as :func:`refl` with the film between *front* and
+    *back*, or with *reverse* the same as :func:`refl` for -*Qz* with the
+    film between *back* and *front*.  Negative *Qz* reverse the direction
+    again.
+
+    The product of the matrices for the film interior is computed once for
+    each front medium and direction of Qz.  Going through the film in the
+    other direction gives the same product transposed, with the signs of
+    the off-diagonal terms changed, so only the interfaces with the front
+    and back media are computed separately for each row.
+    """
+
+    if isscalar(Qz):
+        Qz = np.array([Qz], 'd')
+    n = len(rho)
+    kz = np.asarray(Qz, 'd')/2
+    depth = np.asarray(depth, 'd')
+    rho = np.asarray(rho, 'd')*1e-6
+    sigma = sigma*np.ones(n-1, 'd') if isscalar(sigma) else np.asarray(sigma, 'd')
+
+    r = np.empty((len(media), len(kz)), 'D')
+    interior = {}
+    for row, (front, back, reverse) in enumerate(media):
+        for negative in (False, True):
+            idx = (kz < 0) if negative else (kz >= 0)
+            if not idx.any():
+                continue
+            # For negative Qz the beam comes from the back medium instead.
+            v_in, v_out = (back, front) if negative else (front, back)
+            key = (v_in, negative)
+            if key not in interior:
+                interior[key] = _refl_interior(abs(kz[idx]), depth, rho,
+                                               sigma, v_in*1e-6)
+            k, (S11, S12, S21, S22) = interior[key]
+            if reverse != negative:
+                # Passing from the substrate side: the interior product is
+                # D S^T D with D = diag(1, -1), and the front medium meets
+                # the last layer.
+                S12, S21 = -S21, -S12
+                k_in, s_in, k_out, s_out = k[-1], sigma[n-2], k[0], sigma[0]
+            else:
+                k_in, s_in, k_out, s_out = k[0], sigma[0], k[-1], sigma[n-2]
+            k_front = abs(kz[idx])
+            k_back = sqrt(k_front**2 + 4*pi*(v_in-v_out)*1e-6 + 0j)
+            # [1 F; F 1] S [1 G; G 1], keeping only the first column.
+            F = _interface(k_front, k_in, s_in)
+            G = _interface(k_out, k_back, s_out)
+            X11 = S11 + F*S21 + G*(S12 + F*S22)
+            X21 = F*S11 + S21 + G*(F*S12 + S22)
+            r[row, idx] = X21/X11
+    r[:, abs(kz) < 1.e-6] = -1  # reflectivity at kz=0 is -1
+    return r
+
+
+def _refl_interior(kz, depth, rho, sigma, front):
+    """
+    Wave numbers in the interior layers and the product (S11, S12, S21, S22)
+    of their matrices from layer 1 through layer n-2, relative to *front*.
+    """
+    kz_sq = kz**2 + 4*pi*front
+    k = [sqrt(kz_sq - 4*pi*rho[i] + 0j) for i in range(1, len(rho)-1)]
+    S11 = exp(1j*k[0]*depth[1])
+    S22 = exp(-1j*k[0]*depth[1])
+    S12 = S21 = 0
+    for i in range(1, len(k)):
+        # S <- S [1 F; F 1] diag(P1, P2)
+        F = _interface(k[i-1], k[i], sigma[i])
+        P1 = exp(1j*k[i]*depth[i+1])
+        P2 = exp(-1j*k[i]*depth[i+1])
+        S11, S12 = (S11 + F*S12)*P1, (F*S11 + S12)*P2
+        S21, S22 = (S21 + F*S22)*P1, (F*S21 + S22)*P2
+    return k, (S11, S12, S21, S22)
+
+
+def _interface(k, k_next, roughness):
+    """Fresnel coefficient F with Nevot-Croce roughness."""
+    F = (k - k_next) / (k + k_next)
+    F *= exp(-2*k*k_next*roughness**2)
+    return F
+
+
+def refl_batch(Qz, depth, rho, sigma=None):
+    """
+    Reflectometry for a set of profiles measured at the same Qz.
+
+    **Parameters:**
+        *Qz:* float|A
+            Scattering vector 4*pi*sin(theta)/wavelength. This is an array.
+        *depth:* float|A
+            Thickness of each layer, either shared by all profiles or
+            one row per profile.  A scalar is the thickness of every
+            interior layer, which selects the faster uniform step kernel.
+        *rho:* float|uNb
+            Scattering length density with one row per profile.
+        *sigma:* float|A
+            Interfacial roughness, or None for sharp interfaces.
+
+    :Returns:
+        *r* array of complex with shape (len(rho), len(Qz))
+
+    This evaluates all profiles in one call to the compiled kernel
+    :func:`calc.reflectivity_amplitude_batch`, whose amplitude is the
+    complex conjugate of :func:`refl`; the conjugate is returned here so
+    that the two can be used interchangeably.  They differ in phase only
+    below the critical edge of the substrate, where the compiled kernel
+    takes the decaying branch for the transmitted wave.
+    """
+
+    r = reflectivity_amplitude_batch(Qz, depth, rho, sigma=sigma)
+    return r.conj()
+
+
+def layer_widths(z):
+    """
+    Return the slab thicknesses for a profile sampled at depths *z*.
+
+    The incident and substrate layers are given zero thickness.  If *z*
+    is equally spaced, as it is for inverted profiles, the common step
+    size is returned instead so that :func:`refl_batch` can use the
+    uniform step kernel.
+    """
+
+    dz = diff(z)
+    if len(dz) > 0 and np.allclose(dz, dz[0], rtol=1e-10, atol=0):
+        return dz[0]
+    return np.hstack((0, dz, 0))
+
+
+def reconstruct(file1, file2, u, v1, v2, stages=100, seed=None, cache=None,
+                progress=None):
     r"""
     Two reflectivity measurements of a film with different surrounding media
     :math:`|r_1|^2` and :math:`|r_2|^2` can be combined to compute the expected
@@ -1166,7 +1730,8 @@ def reconstruct(file1, file2, u, v1, v2, stages=100):
     intuitive: poor resolution should show less detail in the profile.
     """
 
-    return SurroundVariation(file1, file2, u, v1, v2, stages=stages)
+    return SurroundVariation(file1, file2, u, v1, v2, stages=stages,
+                             seed=seed, cache=cache, progress=progress)
 
 
 class SurroundVariation():
@@ -1186,16 +1751,55 @@ class SurroundVariation():
     *save(file)*           save output
     *show()*, *plot()*     show Q, RealR, ImagR
     =====================  ========================================
+
+    The data *R1* and *R2* may have one row for each of a set of replicate
+    measurements at the same Q, in which case all the replicates are
+    reconstructed together and the results have one row for each.  Only
+    *Q*, *RealR*, *ImagR* and their uncertainties are available for them.
+
+    The uncertainty estimate uses *stages* samples of the input noise,
+    drawn with the random number *seed* if it is given.  If *progress* is
+    given, it is called as progress(done, stages) after each sample, and
+    can raise an exception to abandon the reconstruction.  If *cache* is a
+    :class:`ResultCache` or the name of its directory, the reconstruction
+    of the same data, surround and controls is loaded from there instead
+    of being recomputed.
     """
 
     backrefl = True
+    _resolution = _resolution_profile = None
+    _fixed_theory = False
+    dRealR = dImagR = None
 
-    def __init__(self, file1, file2, u, v1, v2, stages=100):
+    # Arrays stored by save_results
+    _result_arrays = ('Qin', 'dQin', 'R1in', 'R2in', 'dR1in', 'dR2in',
+                      'Q', 'RealR', 'ImagR', 'dRealR', 'dImagR')
+
+    def __init__(self, file1, file2, u, v1, v2, stages=100, seed=None,
+                 cache=None, progress=None):
         self.u = u
         self.v1, self.v2 = v1, v2
+        self.stages, self.seed = stages, seed
         self._load(file1, file2)
-        self._calc()
-        self._calc_err(stages=stages)
+        cache = _result_cache(cache)
+        key = ResultCache.key('SurroundVariation', self.Qin, self.R1in,
+                              self.R2in, self.dR1in, self.dR2in,
+                              u, v1, v2, stages, seed)
+        result = cache.get(key) if cache is not None else None
+        if result is not None:
+            for k, v in result.items():
+                setattr(self, k, v)
+            self.Q = self.Qin
+            if progress is not None:
+                progress(stages, stages)
+        else:
+            self._calc()
+            self._calc_err(stages=stages, seed=seed, progress=progress)
+            if cache is not None:
+                names = ['RealR', 'ImagR']
+                if self.dRealR is not None:
+                    names += ['dRealR', 'dImagR']
+                cache.put(key, dict((k, getattr(self, k)) for k in names))
         self.clean()
 
 
@@ -1222,8 +1826,14 @@ class SurroundVariation():
             R1, R2 = self.refl(z, rho, resid=True)
             return np.sum(R1**2) + np.sum(R2**2)
 
-        rho_final = rho_initial
-        rho_final, f, d = fmin(cost, rho_initial, approx_grad=True, maxfun=20)
+        # The profile changes a little at a time, so keep the theory points
+        # chosen for the initial profile for the whole optimization.
+        self._resolution, self._fixed_theory = None, True
+        try:
+            rho_final, f, d = fmin(cost, rho_initial, approx_grad=True,
+                                   maxfun=20)
+        finally:
+            self._fixed_theory = False
         return z, rho_final
 
 
@@ -1248,12 +1858,11 @@ class SurroundVariation():
                 Return the reflectivities R1 and R2 for the film *z*, *rho*.
         """
 
-        w = np.hstack((0, np.diff(z), 0))
+        w = layer_widths(z)
         rho = np.hstack((0, rho[1:], self.u))
-        rho[0] = self.v1
-        R1 = self._calc_refl(w, rho)
-        rho[0] = self.v2
-        R2 = self._calc_refl(w, rho)
+        rho = np.vstack((rho, rho))
+        rho[:, 0] = self.v1, self.v2
+        R1, R2 = self._calc_refl(w, rho)
         if resid:
             R1 = (self.R1in-R1)/self.dR1in
             R2 = (self.R2in-R2)/self.dR2in
@@ -1262,44 +1871,61 @@ class SurroundVariation():
 
     def _calc_free(self, z, rho):
         # This is more or less cloned code that should be written just once.
-        w = np.hstack((0, np.diff(z), 0))
+        w = layer_widths(z)
         rho = np.hstack((self.u, rho[1:], self.u))
         rho[0] = self.u
         Q = -self.Qin
         if self.backrefl:
             Q = -Q
-        r = refl(Q, w, rho)
+        r = refl_batch(Q, w, [rho])[0]
         return r.real, r.imag
 
 
     def _calc_refl(self, w, rho):
+        # Returns one reflectivity curve for each row of rho.
         Q, dQ = self.Qin, self.dQin
         # Back reflectivity is equivalent to -Q inputs
         if self.backrefl:
             Q = -Q
-        r = refl(Q, w, rho)
-        if dQ is not None:
-            R = convolve(Q, abs(r)**2, Q, dQ)
-        else:
-            R = abs(r)**2
-        return R
+        if dQ is None:
+            return abs(refl_batch(Q, w, rho))**2
+        # Sample the theory densely enough for the resolution of this
+        # profile.  The theory points and resolution weights are reused for
+        # the same profile, or for any profile during optimize(), where the
+        # profile only changes a little at a time.
+        profile = np.array(w, 'd'), np.array(rho, 'd')
+        resolution = self._resolution
+        if (resolution is None or not resolution.matches(resolution.Qi, Q, dQ)
+                or not (self._fixed_theory or all(
+                    a.shape == b.shape and (a == b).all()
+                    for a, b in zip(profile, self._resolution_profile)))):
+            Qt, R = adaptive_theory(lambda Qt: abs(refl_batch(Qt, w, rho))**2,
+                                    Q, dQ)
+            self._resolution = ResolutionOperator(Qt, Q, dQ)
+            self._resolution_profile = profile
+            return self._resolution(R)
+        return resolution(abs(refl_batch(resolution.Qi, w, rho))**2)
 
 
     def clean(self):
         """
         Remove points which are NaN or Inf from the computed phase.
+
+        With one row for each replicate, only the points which are invalid
+        for every replicate are removed.
         """
 
         # Toss invalid values
         Q, re, im = self.Qin, self.RealR, self.ImagR
+        keep = reduce(lambda y, x: isfinite(x)&y, [re, im], True)
+        if keep.ndim > 1:
+            keep = keep.any(axis=0)
         if self.dRealR is not None:
             dre, dim = self.dRealR, self.dImagR
-            keep = reduce(lambda y, x: isfinite(x)&y, [re, im], True)
             self.Q, self.RealR, self.dRealR, self.ImagR, self.dImagR \
-                = [v[keep] for v in (Q, re, dre, im, dim)]
+                = [v[..., keep] for v in (Q, re, dre, im, dim)]
         else:
-            keep = reduce(lambda y, x: isfinite(x)&y, [re, im], True)
-            self.Q, self.RealR, self.ImagR = [v[keep] for v in (Q, re, im)]
+            self.Q, self.RealR, self.ImagR = [v[..., keep] for v in (Q, re, im)]
 
 
     def save(self, outfile=None, uncertainty=True):
@@ -1334,6 +1960,34 @@ class SurroundVariation():
         fid.close()
 
 
+    def save_results(self, outfile):
+        """
+        Save the input data, surround and reconstructed amplitude to the
+        .npz file *outfile*.  Use :func:`load_results` to restore it.
+        """
+
+        metadata = dict(kind='SurroundVariation', version=RESULTS_VERSION,
+                        name1=self.name1, name2=self.name2,
+                        u=self.u, v1=self.v1, v2=self.v2,
+                        stages=self.stages, seed=self.seed)
+        save_npz(outfile, dict((k, getattr(self, k))
+                               for k in self._result_arrays), metadata)
+
+
+    @classmethod
+    def _from_results(cls, metadata, arrays):
+        """
+        Returns the reconstruction for the contents of a results file.
+        """
+
+        phase = cls.__new__(cls)
+        for k in ('name1', 'name2', 'u', 'v1', 'v2', 'stages', 'seed'):
+            setattr(phase, k, metadata[k])
+        for k in cls._result_arrays:
+            setattr(phase, k, arrays.get(k))
+        return phase
+
+
     def save_inverted(self, outfile=None, profile=None):
         """
         Save Q, R1, R2, RealR of the inverted profile.
@@ -1444,14 +2098,14 @@ class SurroundVariation():
         # 4-column data: Q, dQ, R, dR
         # 5-column data: Q, dQ, R, dR, Lambda
         if isstr(file1):
-            d1 = np.loadtxt(file1).T
+            d1 = cached_loadtxt(file1).T
             name1 = file1
         else:
             d1 = file1
             name1 = "SimData1"
 
         if isstr(file2):
-            d2 = np.loadtxt(file2).T
+            d2 = cached_loadtxt(file2).T
             name2 = file2
         else:
             d2 = file2
@@ -1497,11 +2151,16 @@ class SurroundVariation():
         self.Q = self.Qin
 
 
-    def _calc_err(self, stages):
+    def _calc_err(self, stages, seed=None, progress=None):
         if self.dR1in is None:
+            if progress is not None:
+                progress(stages, stages)
             return
 
-        from numpy.random import normal
+        if seed is None:
+            from numpy.random import normal
+        else:
+            normal = np.random.RandomState(seed).normal
         runs = []
         for i in range(stages):
             R1 = normal(self.R1in, self.dR1in)
@@ -1509,6 +2168,8 @@ class SurroundVariation():
             rer, imr = _phase_reconstruction(self.Qin, R1, R2,
                                              self.u, self.v1, self.v2)
             runs.append((rer, imr))
+            if progress is not None:
+                progress(i+1, stages)
         rers, rims = zip(*runs)
         self.RealR = valid_f(mean, rers)
         self.ImagR = valid_f(mean, rims)
@@ -1559,6 +2220,320 @@ def _phase_reconstruction(Q, R1sq, R2sq, rho_u, rho_v1, rho_v2):
     return Rre, Rim
 
 
+# Fields of each row in the summary written by run_batch()
+BATCH_FIELDS = ['name', 'files', 'status', 'error', 'chisq', 'outfile',
+                'ampfile', 'phase_time', 'invert_time']
+
+
+def read_manifest(filename):
+    """
+    Returns the datasets listed in the batch manifest *filename*.
+
+    Each line of the manifest names an AMP file or an RF1 RF2 pair, followed
+    by optional key=value settings for that set, such as *thickness=150* or
+    *v1=0*.  Any :class:`Inversion` control can be set, as well as the
+    surround *v1*, *v2*, the step size *dz* and the output *name*.  Text
+    after # is ignored.  For example::
+
+        # Two surrounds for each sample, measured through silicon
+        sample1_D2O.refl sample1_H2O.refl v1=6.33 v2=-0.56
+        run*_a.refl run*_b.refl thickness=250
+        film.amp Qmax=0.3 name=film_lowq
+
+    File names may be glob patterns, which expand to one set for each
+    match.  For pairs the sorted matches of the two patterns are paired in
+    order.  Relative names are relative to the directory of the manifest.
+
+    Returns a list of dictionaries with the *name*, the *files* and the
+    settings *kw* of each set.
+    """
+
+    from glob import glob
+
+    root = os.path.dirname(os.path.abspath(filename))
+    datasets, names = [], set()
+    with open(filename) as fid:
+        for line in fid:
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            patterns = [w for w in words if '=' not in w]
+            kw = dict((k, _manifest_value(v)) for k, v in
+                      (w.split('=', 1) for w in words if '=' in w))
+            setname = kw.pop('name', None)
+            if not 1 <= len(patterns) <= 2:
+                raise ValueError("expected AMP or RF1 RF2 in manifest line: %s"
+                                 % line.strip())
+            matches = [sorted(glob(os.path.join(root, p))) for p in patterns]
+            if len(set(len(m) for m in matches)) != 1 or not matches[0]:
+                raise ValueError("files do not match up in manifest line: %s"
+                                 % line.strip())
+            for files in zip(*matches):
+                name = setname if len(matches[0]) == 1 else None
+                if name is None:
+                    name = os.path.splitext(os.path.basename(files[0]))[0]
+                unique, k = name, 1
+                while unique in names:
+                    k += 1
+                    unique = "%s-%d"%(name, k)
+                names.add(unique)
+                datasets.append(dict(name=unique, files=list(files),
+                                     kw=dict(kw)))
+    return datasets
+
+
+def _manifest_value(text):
+    """
+    Returns the int, float or None for a manifest setting, or the text.
+    """
+
+    if text == 'None':
+        return None
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def run_batch(datasets, outdir=".", processes=None, summary=None, **kw):
+    """
+    Reconstruct and invert each of the *datasets* from :func:`read_manifest`.
+
+    The sets are processed by a pool of *processes* workers, or one at a
+    time if *processes* is 1.  The settings *kw* apply to every set unless
+    the set overrides them.  For each set the profile is saved to
+    *outdir*/name.prf, and for RF1 RF2 pairs the reconstructed amplitude is
+    saved to *outdir*/name.amp.  A set which fails is recorded and the
+    batch continues.  The result *cache* is only used for sets with a
+    *seed*, so that unseeded sets always draw fresh noise.
+
+    Returns one dictionary for each set, with the fields in BATCH_FIELDS,
+    and writes them as JSON to *summary* (default *outdir*/summary.json).
+    """
+
+    import time
+
+    start = time.time()
+    rows = _invert_sets(datasets, outdir, processes, kw)
+    if summary is None:
+        summary = os.path.join(outdir, "summary.json")
+    _write_summary(summary, rows, time.time()-start)
+    return rows
+
+
+def watch(path, patterns=("*.amp",), outdir=None, interval=10, settle=5,
+          processes=1, summary=None, once=False, verbose=True, **kw):
+    """
+    Watch directory *path* for new data, inverting each set as it arrives.
+
+    Sets are named by *patterns*, either one pattern for AMP files or two
+    patterns for RF1 RF2 pairs.  Each pattern has one \*, and files with the
+    same text in place of the \* form a pair, so *("\*_a.refl", "\*_b.refl")*
+    pairs run12_a.refl with run12_b.refl.  A set is complete when all its
+    files exist and none has been modified for *settle* seconds.
+
+    The directory is scanned every *interval* seconds.  Complete sets which
+    are new or have changed since they were last inverted are processed as
+    :func:`run_batch` would, with outputs in *outdir* (default
+    *path*/inverted) and a summary of every set seen so far in *summary*.
+    The settings *kw* apply to every set.  The summary also records the
+    files each set was inverted from, so a restarted watch only processes
+    the sets which changed while it was stopped.  When a *seed* is given,
+    results are kept in *cache*, default *outdir*/cache, so that rewriting
+    a file with the same data does not recompute them.  Without a seed,
+    every set is inverted with fresh noise.
+
+    Set *once* to scan the directory a single time.  Otherwise the watch
+    runs until interrupted.  Returns the summary rows by set name.
+    """
+
+    import time
+
+    if not 1 <= len(patterns) <= 2 or any(p.count('*') != 1 for p in patterns):
+        raise ValueError("need one or two patterns, each with one *")
+    if outdir is None:
+        outdir = os.path.join(path, "inverted")
+    if summary is None:
+        summary = os.path.join(outdir, "summary.json")
+    if kw.get('cache') is None and kw.get('seed') is not None:
+        kw['cache'] = os.path.join(outdir, "cache")
+    rows = _read_summary(summary)
+    start = time.time()
+    while True:
+        datasets, signatures = [], {}
+        for name, files, signature in _complete_sets(path, patterns, settle):
+            if name not in rows or rows[name].get('signature') != signature:
+                signatures[name] = signature
+                datasets.append(dict(name=name, files=files, kw={}))
+        if datasets:
+            for row in _invert_sets(datasets, outdir, processes, kw):
+                row['signature'] = signatures[row['name']]
+                rows[row['name']] = row
+                if verbose:
+                    print("%s: %s"%(row['name'], row['error'] or "inverted"))
+            _write_summary(summary, [rows[k] for k in sorted(rows)],
+                           time.time()-start)
+        if once:
+            return rows
+        time.sleep(interval)
+
+
+def _complete_sets(path, patterns, settle):
+    """
+    Yields (name, files, signature) for the sets in *path* named by
+    *patterns* whose files have all been left unchanged for *settle*
+    seconds.  The signature is the size and modification time of the files.
+    """
+
+    import time
+
+    affixes = [p.split('*') for p in patterns]
+    stats = {}
+    for name in os.listdir(path):
+        try:
+            stats[name] = os.stat(os.path.join(path, name))
+        except OSError:
+            pass  # removed since the listing
+    prefix, suffix = affixes[0]
+    now = time.time()
+    for name in sorted(stats):
+        if (not name.startswith(prefix) or not name.endswith(suffix)
+                or len(name) < len(prefix) + len(suffix)):
+            continue
+        stem = name[len(prefix):len(name)-len(suffix)]
+        names = [pre + stem + post for pre, post in affixes]
+        if not all(n in stats for n in names):
+            continue
+        if any(now - stats[n].st_mtime < settle for n in names):
+            continue
+        signature = [[stats[n].st_size, stats[n].st_mtime] for n in names]
+        files = [os.path.join(path, n) for n in names]
+        yield os.path.splitext(name)[0], files, signature
+
+
+def _rhopoints(thickness, dz):
+    """
+    Returns the number of profile steps for a step of at most *dz* over
+    the film *thickness*.
+    """
+
+    return int(ceil(thickness/dz))
+
+
+def _invert_sets(datasets, outdir, processes, kw):
+    """
+    Runs :func:`_invert_set` for each of *datasets*, with a pool of
+    *processes* workers unless *processes* is 1.
+    """
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = [(dataset, dict(kw, **dataset['kw']), outdir)
+             for dataset in datasets]
+    if processes == 1 or len(tasks) < 2:
+        return [_invert_set(task) for task in tasks]
+
+    from multiprocessing import Pool
+    # Give each worker its own random stream for the noise stages.
+    pool = Pool(processes, initializer=np.random.seed)
+    try:
+        return pool.map(_invert_set, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _read_summary(summary):
+    """
+    Returns the rows of an existing batch *summary* by set name.
+    """
+
+    import json
+
+    try:
+        with open(summary) as fid:
+            return dict((row['name'], row) for row in json.load(fid)['sets'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def _write_summary(summary, rows, elapsed):
+    """
+    Writes the batch summary *rows* as JSON, replacing *summary* in one
+    step so that readers never see a partial file.
+    """
+
+    import json
+
+    failed = [row['name'] for row in rows if row['status'] != 'ok']
+    tmp = "%s.%d.tmp"%(summary, os.getpid())
+    with open(tmp, "w") as fid:
+        json.dump(dict(sets=rows, failed=failed, time=elapsed), fid, indent=2)
+    os.replace(tmp, summary)
+
+
+def _invert_set(task):
+    """
+    Runs the reconstruction and inversion of one set of a batch, returning
+    its summary row.
+    """
+
+    import time
+
+    dataset, kw, outdir = task
+    files, name = dataset['files'], dataset['name']
+    row = dict((field, None) for field in BATCH_FIELDS)
+    row.update(name=name, files=files, status='ok')
+    try:
+        start = time.time()
+        v1, v2 = kw.pop('v1', None), kw.pop('v2', None)
+        if kw.get('seed') is None:
+            # A cached unseeded run would replay its noise rather than
+            # drawing new noise for this set.
+            kw['cache'] = None
+        dz = kw.pop('dz', None)
+        if dz:
+            kw['rhopoints'] = _rhopoints(kw.get('thickness',
+                                                Inversion.thickness), dz)
+        if len(files) == 2:
+            if v1 is None or v2 is None:
+                raise ValueError("need surround v1 and v2 for phase inversion")
+            phase = SurroundVariation(
+                files[0], files[1], u=kw.get('substrate', Inversion.substrate),
+                v1=v1, v2=v2, seed=kw.get('seed'), cache=kw.get('cache'))
+            row['ampfile'] = os.path.join(outdir, name+os.extsep+"amp")
+            _publish(phase.save, row['ampfile'])
+            data = phase.Q, phase.RealR, phase.dRealR
+        else:
+            data = files[0]
+        row['phase_time'] = time.time() - start
+
+        start = time.time()
+        inverter = Inversion(data=data, **kw)
+        inverter.run()
+        row['outfile'] = os.path.join(outdir, name+os.extsep+"prf")
+        _publish(inverter.save, row['outfile'])
+        row['chisq'] = float(inverter.chisq())
+        row['invert_time'] = time.time() - start
+    except Exception as exc:
+        row['status'] = 'failed'
+        row['error'] = "%s: %s"%(type(exc).__name__, exc)
+    return row
+
+
+def _publish(save, filename):
+    """
+    Calls *save* with a temporary name and moves the result to *filename*,
+    so that readers never see a partial file.
+    """
+
+    tmp = "%s.%d.tmp"%(filename, os.getpid())
+    save(tmp)
+    os.replace(tmp, filename)
+
+
 def main():
     """
     Drive phase reconstruction and direct inversion from the command line.
@@ -1576,7 +2551,10 @@ complete phase inversion.   Phase inversion requires two surrounding materials
 and one substrate material to be specified. The measurement is assumed to come
 through the substrate."""
 
-    parser = OptionParser(usage="%prog [options] AMP or RF1 RF2",
+    parser = OptionParser(usage="%prog [options] AMP or RF1 RF2\n"
+                                "       %prog [options] --manifest FILE\n"
+                                "       %prog [options] --watch DIR\n"
+                                "       %prog [options] --serve PORT",
                           description=description,
                           version="%prog 1.0")
     inversion_keys = [] # Collect the keywords we are using
@@ -1641,10 +2619,86 @@ through the substrate."""
     group.add_option("-a", dest="amp_only", default=False,
                      action="store_true",
                      help="calculate amplitude and stop")
-    inversion_keys += ['rhopoints', 'calcpoints', 'stages']
+    group.add_option("--seed", dest="seed",
+                     default=Inversion.seed, type="int",
+                     help="random number seed for the noise stages")
+    group.add_option("--cache", dest="cache", default=None,
+                     help="directory of saved results to reuse (batch and"
+                          " watch runs only cache sets with a --seed)")
+    inversion_keys += ['rhopoints', 'calcpoints', 'stages', 'seed', 'cache']
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Batch processing", description=None)
+    group.add_option("--manifest", dest="manifest", default=None,
+                     help="file listing the datasets to process, one set"
+                          " per line, with key=value settings for each set")
+    group.add_option("--outdir", dest="outdir", default=None,
+                     help="directory for the outputs (current directory,"
+                          " or DIR/inverted when watching DIR)")
+    group.add_option("--summary", dest="summary", default=None,
+                     help="batch summary file (outdir/summary.json)")
+    group.add_option("-j", "--processes", dest="processes",
+                     default=None, type="int",
+                     help="number of worker processes (one per cpu)")
+    group.add_option("--watch", dest="watch", default=None,
+                     help="directory to watch for new data to invert")
+    group.add_option("--pattern", dest="patterns", action="append",
+                     help="file name pattern for watched data, such as"
+                          " '*.amp', or given twice for RF1 RF2 pairs")
+    group.add_option("--interval", dest="interval", default=10.,
+                     type="float", help="seconds between directory scans")
+    group.add_option("--settle", dest="settle", default=5., type="float",
+                     help="seconds a file must be unchanged to be complete")
+    group.add_option("--serve", dest="serve", default=None, type="int",
+                     help="run the inversion service on localhost PORT")
+    group.add_option("--queue", dest="queue_size", default=None, type="int",
+                     help="jobs the service accepts at once (4 per worker)")
+    group.add_option("--data-root", dest="data_root", default=None,
+                     help="directory of data files service jobs may name"
+                          " (data must be sent with each job)")
     parser.add_option_group(group)
 
     (options, args) = parser.parse_args()
+    if options.serve is not None:
+        from .service import serve
+        serve(port=options.serve, processes=options.processes,
+              queue_size=options.queue_size, data_root=options.data_root)
+        return
+    if options.manifest or options.watch:
+        if args:
+            parser.error("Datasets are not listed on the command line in "
+                         "batch or watch mode")
+        kw = dict((key, getattr(options, key)) for key in inversion_keys)
+        if options.surround:
+            kw['v1'], kw['v2'] = options.surround
+        if options.dz:
+            kw['dz'] = options.dz
+    if options.watch:
+        patterns = options.patterns or ["*.amp"]
+        if len(patterns) > 2:
+            parser.error("Need one pattern for AMP files or two for pairs")
+        try:
+            watch(options.watch, patterns, outdir=options.outdir,
+                  interval=options.interval, settle=options.settle,
+                  processes=options.processes or 1,
+                  summary=options.summary, **kw)
+        except KeyboardInterrupt:
+            pass
+        return
+    if options.manifest:
+        try:
+            datasets = read_manifest(options.manifest)
+        except (IOError, ValueError) as exc:
+            parser.error(str(exc))
+        rows = run_batch(datasets, outdir=options.outdir or ".",
+                         processes=options.processes,
+                         summary=options.summary, **kw)
+        for row in rows:
+            if row['status'] != 'ok':
+                print("%s failed: %s"%(row['name'], row['error']))
+        print("%d of %d sets inverted"
+              % (sum(row['status'] == 'ok' for row in rows), len(rows)))
+        return
     if len(args) < 1 or len(args) > 2:
          parser.error("Need real R data file or pair of reflectivities")
 
@@ -1657,7 +2711,8 @@ through the substrate."""
             parser.error("Need fronting and backing for phase inversion")
         v1, v2 = options.surround
         u = options.substrate
-        phase = SurroundVariation(args[0], args[1], u=u, v1=v1, v2=v2)
+        phase = SurroundVariation(args[0], args[1], u=u, v1=v1, v2=v2,
+                                  seed=options.seed, cache=options.cache)
         data = phase.Q, phase.RealR, phase.dRealR
         if options.ampfile:
             phase.save(options.ampfile)
@@ -1670,7 +2725,7 @@ through the substrate."""
         return
 
     if options.dz:
-        options.rhopoints = ceil(1/options.dz)
+        options.rhopoints = _rhopoints(options.thickness, options.dz)
     # Rather than trying to remember which control parameters I
     # have options for, I update the list of parameters that I
     # allow for each group of parameters, and pull the returned
@@ -208,6 +208,107 @@ PyObject* Preflamp_rough(PyObject*obj,PyObject*args)
 
 
 
+PyObject* Preflamp_batch(PyObject*obj,PyObject*args)
+{
+  PyObject *Q_obj,*R_obj,*d_obj,*rho_obj,*mu_obj, *wavelength_obj;
+  const double *Q, *d, *rho, *mu, *wavelength;
+  refl_complex *R;
+  int np;
+  Py_ssize_t nQ, nR, nd, nrho, nmu, nwavelength;
+
+  if (!PyArg_ParseTuple(args, "iOOOOOO:reflamp_batch",
+			&np,&rho_obj,&mu_obj,&d_obj,&wavelength_obj,&Q_obj,&R_obj)) return NULL;
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(mu_obj,mu,nmu);
+  INVECTOR(Q_obj,Q,nQ);
+  INVECTOR(wavelength_obj, wavelength, nwavelength);
+  OUTVECTOR(R_obj,R,nR);
+  if (np < 1 || nd != nrho || nd != nmu || nd%np != 0) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,mu have different lengths");
+#endif
+    return NULL;
+  }
+  if (nR != np*nQ || nwavelength != nQ) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "Q,R,wavelength have different lengths");
+#endif
+    return NULL;
+  }
+  reflectivity_amplitude_batch(np, nd/np, d, rho, mu, wavelength, nQ, Q, R);
+  return Py_BuildValue("");
+}
+
+
+PyObject* Preflamp_uniform(PyObject*obj,PyObject*args)
+{
+  PyObject *Q_obj,*R_obj,*rho_obj,*mu_obj, *wavelength_obj;
+  const double *Q, *rho, *mu, *wavelength;
+  refl_complex *R;
+  int np;
+  double dz;
+  Py_ssize_t nQ, nR, nrho, nmu, nwavelength;
+
+  if (!PyArg_ParseTuple(args, "iOOdOOO:reflamp_uniform",
+			&np,&rho_obj,&mu_obj,&dz,&wavelength_obj,&Q_obj,&R_obj)) return NULL;
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(mu_obj,mu,nmu);
+  INVECTOR(Q_obj,Q,nQ);
+  INVECTOR(wavelength_obj, wavelength, nwavelength);
+  OUTVECTOR(R_obj,R,nR);
+  if (np < 1 || nrho != nmu || nrho%np != 0) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "rho,mu have different lengths");
+#endif
+    return NULL;
+  }
+  if (nR != np*nQ || nwavelength != nQ) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "Q,R,wavelength have different lengths");
+#endif
+    return NULL;
+  }
+  reflectivity_amplitude_uniform(np, nrho/np, dz, rho, mu, wavelength, nQ, Q, R);
+  return Py_BuildValue("");
+}
+
+PyObject* Preflamp_rough_batch(PyObject*obj,PyObject*args)
+{
+  PyObject *Q_obj,*R_obj,*d_obj,*rho_obj,*mu_obj,*sigma_obj, *wavelength_obj;
+  const double *Q, *d, *rho, *mu, *sigma, *wavelength;
+  refl_complex *R;
+  int np;
+  Py_ssize_t nQ, nR, nd, nrho, nmu, nsigma, nwavelength;
+
+  if (!PyArg_ParseTuple(args, "iOOOOOOO:reflrough_batch",
+			&np,&rho_obj,&mu_obj,&d_obj,&sigma_obj,&wavelength_obj,
+			&Q_obj,&R_obj))
+		 return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(mu_obj,mu,nmu);
+  INVECTOR(Q_obj,Q,nQ);
+  INVECTOR(wavelength_obj, wavelength, nwavelength);
+  OUTVECTOR(R_obj,R,nR);
+  // interfaces should be one shorter than layers in each profile
+  if (np < 1 || nd != nrho || nd != nmu || nd%np != 0 || nd != nsigma+np) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,mu,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nR != np*nQ || nwavelength != nQ) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "Q,R,wavelength have different lengths");
+#endif
+    return NULL;
+  }
+  reflrough_amplitude_batch(np, nd/np, d, sigma, rho, mu, wavelength, nQ, Q, R);
+  return Py_BuildValue("");
+}
+
 PyObject* Perf(PyObject*obj,PyObject*args)
 {
   PyObject *data_obj, *result_obj;
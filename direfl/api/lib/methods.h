@@ -26,6 +26,9 @@ PyObject* pyvector(int n, double v[]);
 PyObject* Perf(PyObject*obj,PyObject*args);
 PyObject* Preflamp(PyObject*obj,PyObject*args);
 PyObject* Preflamp_rough(PyObject*obj,PyObject*args);
+PyObject* Preflamp_batch(PyObject*obj,PyObject*args);
+PyObject* Preflamp_rough_batch(PyObject*obj,PyObject*args);
+PyObject* Preflamp_uniform(PyObject*obj,PyObject*args);
 PyObject* Pmagnetic_amplitude(PyObject* obj, PyObject* args);
 PyObject* Pconvolve(PyObject*obj,PyObject*args);
 PyObject* Pfixedres(PyObject*obj,PyObject*args);
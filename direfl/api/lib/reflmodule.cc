@@ -43,6 +43,21 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "_refl(rho,mu,d,sigma,L,Q,R): compute reflectivity with approximate roughness putting it into vector R of len(Q)"},
 
+	{"_reflectivity_amplitude_batch",
+	 Preflamp_batch,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_batch(P,rho,mu,d,L,Q,R): compute reflectivity of P profiles putting it into vector R of len(P*len(Q))"},
+
+	{"_reflectivity_amplitude_rough_batch",
+	 Preflamp_rough_batch,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_rough_batch(P,rho,mu,d,sigma,L,Q,R): compute reflectivity of P profiles with approximate roughness putting it into vector R of len(P*len(Q))"},
+
+	{"_reflectivity_amplitude_uniform",
+	 Preflamp_uniform,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_uniform(P,rho,mu,dz,L,Q,R): compute reflectivity of P profiles with interior layers of thickness dz putting it into vector R of len(P*len(Q))"},
+
 	{"_erf",
 	 Perf,
 	 METH_VARARGS,
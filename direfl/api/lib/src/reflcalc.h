@@ -119,6 +119,18 @@ reflectivity_amplitude(const int layers, const double d[],
 		       const int points, const double Q[], refl_complex R[]);
 
 	
+void
+reflectivity_amplitude_batch(const int profiles, const int layers,
+		       const double d[], const double rho[], const double mu[],
+		       const double wavelength[],
+		       const int points, const double Q[], refl_complex R[]);
+
+void
+reflectivity_amplitude_uniform(const int profiles, const int layers,
+		       const double dz, const double rho[], const double mu[],
+		       const double wavelength[],
+		       const int points, const double Q[], refl_complex R[]);
+
 void
 reflrough(const int layers, const double d[], const double sigma[],
 	  const double rho[], const double mu[], const double wavelength[],
@@ -130,6 +142,12 @@ reflrough_amplitude(const int layers, const double d[], const double sigma[],
 		    const double rho[], const double mu[], const double wavelength[],
 		    const int points, const double Q[], refl_complex R[]);
 
+void
+reflrough_amplitude_batch(const int profiles, const int layers,
+		    const double d[], const double sigma[],
+		    const double rho[], const double mu[], const double wavelength[],
+		    const int points, const double Q[], refl_complex R[]);
+
 void
 magnetic_reflectivity(const int layers, const double d[], 
 		      const double rho[], const double mu[], const double wavelength[],
@@ -246,6 +246,103 @@ refl(const int layers,
 #endif /* !USE_PARRAT */
 
 
+// Matrix formalism specialized for interior layers of equal thickness dz,
+// such as the profiles returned by direct inversion.  This is the same
+// calculation as refl above, but above the critical edge of a layer with
+// no absorption S1 is purely imaginary, S1 = i s, and the layer matrix
+// reduces to
+//
+//        (  cos(s dz)    sin(s dz)/s )
+//    A = (                           )
+//        ( -s sin(s dz)  cos(s dz)   )
+//
+// which needs a real square root and a sin/cos pair rather than a complex
+// square root, an exponential and complex division.  Since A is even in S1
+// the choice of branch does not matter.  Layers below their critical edge
+// or with absorption fall back to the general form.
+static void
+refl_uniform(const int layers,
+             const double Q,
+             const double dz,
+             const double rho[],
+             const double mu[],
+             const double wavelength,
+             refl_complex& R)
+{
+  const refl_complex J(0,1);
+
+  const double Qcutoff = 1e-10;
+  int n,step;
+  if (Q >= Qcutoff) {
+    n=0;
+    step=1;
+  } else if (Q <= -Qcutoff) {
+    n=layers-1;
+    step=-1;
+  } else {
+    R = -1.;
+    return;
+  }
+
+  const double pi4=1.2566370614359172e1;            //4 pi
+  const double pi2owavelength = 0.5*pi4/wavelength; //2 pi / wavelength
+  const double Qsqrel = 0.25*Q*Q + pi4*rho[n];      //0.25 * (Q^2 + 16 pi Vrho)
+
+  refl_complex B11, B12, B21, B22;
+  B11 = B22 = 1.0;
+  B12 = B21 = 0.0;
+  for (int i=2; i < layers; i++) {
+    n += step;
+    const double Ssq = pi4*rho[n] - Qsqrel;
+    refl_complex Adiag, A12, A21;
+    if (Ssq < 0. && mu[n] == 0.) {
+      const double s = sqrt(-Ssq);
+#if defined(HAVE_SINCOS)
+      double costheta, sintheta;
+      sincos(s*dz,&sintheta,&costheta);
+#else
+      const double sintheta = sin(s*dz);
+      const double costheta = cos(s*dz);
+#endif // !HAVE_SINCOS
+      Adiag = costheta;
+      A12 = sintheta/s;
+      A21 = -s*sintheta;
+    } else {
+      // General case; see refl above for details.
+      const refl_complex S1 = sqrt(refl_complex(Ssq, -pi2owavelength*mu[n]));
+      const double em2a = exp(-2.*fabs(real(S1))*dz);
+      const double rexp = (1.+em2a)/2.;
+      const double rexm = ( real(S1)>0. ? (1.-em2a)/2. : (em2a-1.)/2. );
+      const double sintheta = sin(imag(S1)*dz);
+      const double costheta = cos(imag(S1)*dz);
+      Adiag = refl_complex(rexp*costheta,rexm*sintheta);
+      const refl_complex sinhS1(rexm*costheta,rexp*sintheta);
+      A12 = sinhS1/S1;
+      A21 = sinhS1*S1;
+    }
+
+    refl_complex C1, C2;
+    C1 = (Adiag*B11 + A12*B21);
+    C2 = (A21*B11 + Adiag*B21);
+    B11 = C1;
+    B21 = C2;
+    C1 = (Adiag*B12 + A12*B22);
+    C2 = (A21*B12 + Adiag*B22);
+    B12 = C1;
+    B22 = C2;
+  }
+
+  n+=step;
+  const refl_complex ZS = J*sqrt(refl_complex(Qsqrel-pi4*rho[n],
+                       pi2owavelength*mu[n]));
+  const refl_complex ZI = J*fabs(0.5*Q);
+  const refl_complex a = ZI*ZS*B12 - ZI*B22;
+  const refl_complex b = ZS*B11 - B21;
+  const refl_complex U = a - b;
+  const refl_complex V = a + b;
+  R = V/U;
+}
+
 
 extern "C" void
 reflectivity_amplitude(const int    layers,
@@ -262,6 +359,50 @@ reflectivity_amplitude(const int    layers,
 }
 
 
+// Evaluate a stack of profiles sharing the same Q points.  The profile
+// arrays are stored row-major as [profiles x layers] and the result as
+// [profiles x points] so that the caller pays the interface cost once.
+extern "C" void
+reflectivity_amplitude_batch(const int    profiles,
+                             const int    layers,
+                             const double depth[],
+                             const double rho[],
+                             const double mu[],
+                             const double wavelength[],
+                             const int    points,
+                             const double Q[],
+                             refl_complex R[])
+{
+  for (int p=0; p < profiles; p++) {
+    const int offset = p*layers;
+    reflectivity_amplitude(layers, depth+offset, rho+offset, mu+offset,
+                           wavelength, points, Q, R+p*points);
+  }
+}
+
+
+// Evaluate a stack of profiles whose interior layers all have thickness dz.
+// See reflectivity_amplitude_batch for the array layout.
+extern "C" void
+reflectivity_amplitude_uniform(const int    profiles,
+                               const int    layers,
+                               const double dz,
+                               const double rho[],
+                               const double mu[],
+                               const double wavelength[],
+                               const int    points,
+                               const double Q[],
+                               refl_complex R[])
+{
+  for (int p=0; p < profiles; p++) {
+    const int offset = p*layers;
+    for (int i=0; i < points; i++)
+      refl_uniform(layers, Q[i], dz, rho+offset, mu+offset,
+                   wavelength[i], R[p*points+i]);
+  }
+}
+
+
 
 
 
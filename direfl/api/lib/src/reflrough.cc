@@ -55,7 +55,7 @@ refl(const int   layers,
     vacuum=0;
     step=-1;
   } else if (Q <= -Qcutoff) {
-    n=0; r=1;
+    n=0; r=-1;
     vacuum=layers-1;
     step=1;
   } else {
@@ -110,6 +110,29 @@ reflrough_amplitude(const int layers,
 }
 
 
+// Batch version of reflrough_amplitude; see reflectivity_amplitude_batch.
+// The interfaces are stored as [profiles x (layers-1)].
+extern "C" void
+reflrough_amplitude_batch(const int profiles,
+                          const int layers,
+                          const double depth[],
+                          const double sigma[],
+                          const double rho[],
+                          const double mu[],
+                          const double wavelength[],
+                          const int points,
+                          const double Q[],
+                          refl_complex R[])
+{
+  for (int p=0; p < profiles; p++) {
+    const int offset = p*layers;
+    reflrough_amplitude(layers, depth+offset, sigma+p*(layers-1),
+                        rho+offset, mu+offset, wavelength,
+                        points, Q, R+p*points);
+  }
+}
+
+
 
 extern "C" void 
 reflrough(const int layers,
@@ -66,12 +66,28 @@ def load(filename, instrument=None, **kw):
     """
     if filename is None:
         return None
+    header, data = parse_file(filename)
+    return _make_probe(filename, header, data, instrument, kw)
+
+def _make_probe(filename, header, data, instrument, kw, resolutions=None):
+    """
+    Return the probe for a parsed file.
+
+    If *resolutions* is a dictionary, then the resolution is shared with
+    earlier probes in the dictionary having the same Q and settings.
+    """
     if instrument is None:
         instrument = Monochromatic()
-    header, data = parse_file(filename)
     header.update(**kw)
     Q, R, dR = data
-    resolution = instrument.resolution(Q, **header)
+    if resolutions is None:
+        resolution = instrument.resolution(Q, **header)
+    else:
+        key = (Q.tobytes(), repr([(k, header.get(k, None))
+                                   for k in RESOLUTION_KEYS]))
+        if key not in resolutions:
+            resolutions[key] = instrument.resolution(Q, **header)
+        resolution = resolutions[key]
     probe = resolution.probe(data=(R, dR), **header)
     probe.title = header['title'] if 'title' in header else filename
     probe.date = header['date'] if 'date' in header else "unknown"
@@ -116,10 +132,18 @@ def load_magnetic(filename, Tguide=270, shared_beam=True, **kw):
 
     For full control, specify filename as a list of files, with None
     for the missing cross sections.
+
+    The cross sections are read at the same time, and those with the same
+    Q points and instrument settings share a resolution calculation.
     """
     from refl1d.probe import PolarizedNeutronProbe
 
-    probes = [load(v, **kw) for v in find_xsec(filename)]
+    instrument = kw.pop('instrument', None)
+    files = find_xsec(filename)
+    resolutions = {}
+    probes = [_make_probe(v, parsed[0], parsed[1], instrument, kw,
+                          resolutions) if v is not None else None
+              for v, parsed in zip(files, parse_files(files))]
     if all(p is None for p in probes):
         raise IOError("Data set has no magnetic cross sections: '%s'"%filename)
     probe = PolarizedNeutronProbe(probes, Tguide=Tguide)
@@ -151,6 +175,22 @@ def find_xsec(filename):
             return None
     return (check('A'), check('B'), check('C'), check('D'))
 
+# Header fields which are used to compute the resolution
+RESOLUTION_KEYS = ('L', 'wavelength', 'dLoL', 'radiation', 'd_s1', 'd_s2',
+                   'Tlo', 'Thi', 'slits_at_Tlo', 'slits_below',
+                   'slits_above', 'sample_width', 'sample_broadening')
+
+def parse_files(filenames):
+    """
+    Parse several NCNR reduced data files at once.
+
+    Returns (*header*, *data*) for each file as from :func:`parse_file`, or
+    None where the file name is None.  The files are read in separate
+    threads so that the time is spent waiting for the disk rather than
+    for each file in turn.
+    """
+    return util.map_files(parse_file, filenames)
+
 def parse_file(filename):
     """
     Parse NCNR reduced data file returning *header* and *data*.
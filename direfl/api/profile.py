@@ -19,7 +19,11 @@ class Microslabs:
     parameter of dz for the step size within the layer.
 
     The space for the slabs is saved even after reset, in preparation for a
-    new set of slabs from different fitting parameters.
+    new set of slabs from different fitting parameters.  The slab parameters
+    are stored together in one structured array whose capacity doubles as
+    needed, so building a profile one slab at a time takes linear time.
+    The properties *w*, *sigma*, *rho*, *irho*, *rhoM* and *thetaM* are
+    views into this array; use :meth:`freeze` to get contiguous copies.
 
     Example
     =======
@@ -31,21 +35,22 @@ class Microslabs:
         for layer in model:
             w, sigma, rho, irho, rho_M, theta_M = layer.render()
             slabs.extend(w=w, sigma=sigma, rho=rho, irho=irho,
-                         rho_M=rho_M, theta_M=theta_M)
-        w, sigma = slabs.w, slabs.sigma
-        rho, irho = slabs.rho, slabs.irho
-        rho_M, theta_M = slabs.rho_M, slabs.theta_M
+                         rhoM=rho_M, thetaM=theta_M)
+        w, sigma, rho, irho, rho_M, theta_M = slabs.freeze()
         R = refl(kz, w, rho=rho, irho=irho, sigma=sigma, rho_M=rho_M, theta_M=theta_M)
         figure(2)
         plot(kz, R, label='reflectivity')
     """
     def __init__(self, nprobe, dz=None):
         self._num_slabs = 0
-        # _slabs contains the 1D objects w, sigma, rho_M, theta_M of len n
-        # _slabsQ contains the 2D objects rho, irho
-        self._slabs = np.empty(shape=(0, 2))
-        self._slabsQ = np.empty(shape=(0, nprobe, 2))
+        # _slabs holds w, sigma, rhoM, thetaM for each slab and rho, irho
+        # for each slab and probe; only the first _num_slabs are in use.
+        self._slabs = np.zeros(0, dtype=[
+            ('w', 'd'), ('sigma', 'd'),
+            ('rho', 'd', (nprobe,)), ('irho', 'd', (nprobe,)),
+            ('rhoM', 'd'), ('thetaM', 'd')])
         self._slabsM = []
+        self._repeats = []
         self.dz = dz
 
     def microslabs(self, thickness=0):
@@ -71,58 +76,94 @@ class Microslabs:
         Reset the slab model so that none are present.
         """
         self._num_slabs = 0
+        self._repeats = []
 
     def __len__(self):
-        return self._num_slabs
+        return self._num_slabs + sum((count-1)*(end-start)
+                                     for start, end, count in self._repeats)
     def repeat(self, start=0, count=1):
         """
         Extend the model so that there are *count* versions of the slabs
         from *start* to the final slab.
 
         This is equivalent to L.extend(L[start:]*(count-1)) for list L.
+
+        The repeat is recorded rather than copied, so memory does not grow
+        with *count*, and :meth:`reflectivity_amplitude` evaluates the
+        repeated block by raising its transfer matrix to a power.  The
+        slab properties *w*, *sigma*, *rho* and *irho* show the slabs with
+        the repeats written out.  A repeat which overlaps an earlier one
+        writes out the earlier repeats first.
+        """
+        # Magnetic sections within the repeat are not repeated.
+        if count <= 1 or start >= len(self):
+            return
+        if any(start < self._expanded_end(i)
+               for i in range(len(self._repeats))):
+            self._expand()
+        start -= len(self) - self._num_slabs
+        self._repeats.append((start, self._num_slabs, count))
+
+    def _expanded_end(self, i):
+        """
+        Index of the first slab after repeat *i* with the repeats written out.
+        """
+        _, end, _ = self._repeats[i]
+        return end + sum((count-1)*(stop-start)
+                         for start, stop, count in self._repeats[:i+1])
+
+    def _index(self):
+        """
+        Index into the stored slabs for each slab with the repeats
+        written out.
+        """
+        pieces, pos = [], 0
+        for start, end, count in self._repeats:
+            pieces.append(np.arange(pos, end))
+            pieces.append(np.tile(np.arange(start, end), count-1))
+            pos = end
+        pieces.append(np.arange(pos, self._num_slabs))
+        return np.hstack(pieces).astype(int)
+
+    def _expand(self):
+        """
+        Write out the repeated slabs.
         """
-        # For now use the dumb implementation; a better implementation
-        # would remember the repeats and pre-calculate the matrix product
-        # for the repeating region, saving much work later.  This has
-        # to work in conjunction with interfaces and with magnetic signals
-        # which vary across the repeated layers, so perhaps it is not so useful.
-        repeats = count-1
-        end = len(self)
-        length = end-start
-        fromidx = slice(start, end)
-        toidx = slice(end, end+repeats*length)
-        self._reserve(repeats*length)
-        self._slabs[toidx] = np.tile(self._slabs[fromidx], [repeats, 1])
-        self._slabsQ[toidx] = np.tile(self._slabsQ[fromidx], [repeats, 1, 1])
-        self._num_slabs += repeats*length
-
-        # if any magnetic sections are within the repeat, they need to be
-        # repeated as well
+        if not self._repeats:
+            return
+        idx = self._index()
+        self._reserve(len(idx)-self._num_slabs)
+        self._slabs[:len(idx)] = self._slabs[idx]
+        self._num_slabs = len(idx)
+        self._repeats = []
 
     def _reserve(self, nadd):
         """
         Reserve space for at least *nadd* slabs.
         """
-        ns, nl, _ = self._slabsQ.shape
-        if ns < self._num_slabs + nadd:
-            new_ns = self._num_slabs + nadd + 50
-            self._slabs.resize((new_ns, 4))
-            self._slabsQ.resize((new_ns, nl, 2))
-
-    def extend(self, w=0, sigma=0, rho=0, irho=0):
+        needed = self._num_slabs + nadd
+        if len(self._slabs) < needed:
+            size = max(needed, 2*len(self._slabs), 16)
+            slabs = np.zeros(size, dtype=self._slabs.dtype)
+            slabs[:self._num_slabs] = self._slabs[:self._num_slabs]
+            self._slabs = slabs
+
+    def extend(self, w=0, sigma=0, rho=0, irho=0, rhoM=0, thetaM=0):
         """
         Extend the micro slab model with the given layers.
+
+        *rho* and *irho* have one row for each probe.
         """
         nadd = len(w)
         self._reserve(nadd)
-        idx = slice(self._num_slabs, self._num_slabs+nadd)
+        new = self._slabs[self._num_slabs:self._num_slabs+nadd]
+        new['w'] = w
+        new['sigma'] = sigma
+        new['rho'] = np.asarray(rho).T
+        new['irho'] = np.asarray(irho).T
+        new['rhoM'] = rhoM
+        new['thetaM'] = thetaM
         self._num_slabs += nadd
-        self._slabs[idx, 0] = w
-        self._slabs[idx, 1] = sigma
-        #self._slabs[idx, 2] = rhoM
-        #self._slabs[idx, 3] = thetaM
-        self._slabsQ[idx, :, 0] = np.asarray(rho).T
-        self._slabsQ[idx, :, 1] = np.asarray(irho).T
 
     def magnetic(self, anchor, w, rhoM=0, thetaM=0):
         self._slabsM.append(anchor, w, rhoM, thetaM)
@@ -131,7 +172,7 @@ class Microslabs:
         """
         Total thickness of the profile.
         """
-        return np.sum(self._slabs[:self._num_slabs, 0])
+        return np.sum(self.w)
 
     def interface(self, I):
         """
@@ -142,20 +183,23 @@ class Microslabs:
         print("Ignoring special interface on the top of the stack")
         pass
 
+    def _view(self):
+        # Slabs in use, copied with the repeats written out if there are any
+        if self._repeats:
+            return self._slabs[self._index()]
+        return self._slabs[:self._num_slabs]
     def _w(self):
-        return self._slabs[:self._num_slabs, 0]
+        return self._view()['w']
     def _sigma(self):
-        return self._slabs[:self._num_slabs-1, 1]
+        return self._view()['sigma'][:-1]
     def _rho(self):
-        return self._slabsQ[:self._num_slabs, :, 0].T
+        return self._view()['rho'].T
     def _irho(self):
-        return self._slabsQ[:self._num_slabs, :, 1].T
+        return self._view()['irho'].T
     def _rhoM(self):
-        raise NotImplementedError
-        #return self._slabs[:self._num_slabs, 2].T
+        return self._view()['rhoM']
     def _thetaM(self):
-        raise NotImplementedError
-        #return self._slabs[:self._num_slabs, 3].T
+        return self._view()['thetaM']
     w = property(_w, doc="Thickness (A)")
     sigma = property(_sigma, doc="1-sigma Gaussian roughness (A)")
     rho = property(_rho, doc="Scattering length density (10^-6 number density)")
@@ -163,13 +207,87 @@ class Microslabs:
     rhoM = property(_rhoM, doc="Magnetic scattering")
     thetaM = property(_thetaM, doc="Magnetic scattering angle")
 
-    def freeze(self, step=False):
+    def freeze(self):
         """
-        Generate a consistent set of slabs, expanding interfaces where
-        necessary and reconciling differences between the nuclear and
-        the magnetic steps.
+        Return contiguous arrays w, sigma, rho, irho, rhoM, thetaM for the
+        slabs, with any repeats written out, ready to pass to the compiled
+        kernels in :mod:`calc`.
+
+        *rho* and *irho* have one row for each probe, and *sigma* has one
+        value for each interface.
         """
-        raise NotImplementedError
+        slabs = self._view()
+        return tuple(np.ascontiguousarray(v) for v in (
+            slabs['w'], slabs['sigma'][:-1], slabs['rho'].T, slabs['irho'].T,
+            slabs['rhoM'], slabs['thetaM']))
+
+    def contract(self, dA):
+        """
+        Merge runs of adjacent slabs with nearly constant scattering density.
+
+        Slabs are accumulated into a run while the interface between them
+        is sharp and (max-min)*width of rho, irho and rhoM over the run, for
+        every probe, stays below the area *dA*.  Each run is replaced by
+        a single slab with the same total thickness and the same integrated
+        rho, irho and rhoM, so the mean scattering density is preserved.  The
+        first and last slabs are the semi-infinite media and are left alone.
+        Runs do not cross the ends of repeated blocks or changes in thetaM.
+
+        Returns the compression ratio, which is the number of slabs before
+        contraction divided by the number after.
+        """
+        n = self._num_slabs
+        if n < 4:
+            return 1.
+        before = len(self)
+        breaks = set(i for block in self._repeats for i in block[:2])
+        slabs = self._slabs[:n]
+        w = slabs['w'].tolist()
+        sigma = slabs['sigma'].tolist()
+        thetaM = slabs['thetaM'].tolist()
+        values = np.hstack((slabs['rho'], slabs['irho'],
+                            slabs['rhoM'][:, None])).tolist()
+
+        # Find the first slab in each run
+        starts = [0]
+        i = 1
+        while i < n-1:
+            starts.append(i)
+            lo, hi, dz = values[i], values[i], w[i]
+            i += 1
+            while (i < n-1 and sigma[i-1] == 0 and i not in breaks
+                   and thetaM[i] == thetaM[i-1]):
+                lo = [min(a, b) for a, b in zip(lo, values[i])]
+                hi = [max(a, b) for a, b in zip(hi, values[i])]
+                if max(b-a for a, b in zip(lo, hi))*(dz+w[i]) > dA:
+                    break
+                dz += w[i]
+                i += 1
+        starts.append(n-1)
+        if len(starts) == n:
+            return 1.
+
+        # Combine the runs, keeping the roughness at the top of each run
+        starts = np.array(starts)
+        ends = np.hstack((starts[1:]-1, n-1))
+        merged = slabs[starts]
+        width = np.add.reduceat(slabs['w'], starts)
+        for field in ('rho', 'irho', 'rhoM'):
+            v = slabs[field].reshape(n, -1)
+            area = np.add.reduceat(v*slabs['w'][:, None], starts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(width[:, None] > 0, area/width[:, None],
+                                v[starts])
+            merged[field] = mean.reshape(merged[field].shape)
+        merged['w'] = width
+        merged['sigma'] = slabs['sigma'][ends]
+        m = len(starts)
+        self._slabs[:m] = merged
+        self._num_slabs = m
+        self._repeats = [(int(np.searchsorted(starts, start)),
+                          int(np.searchsorted(starts, end)), count)
+                         for start, end, count in self._repeats]
+        return before/len(self)
 
     def limited_sigma(self, limit=0):
         """
@@ -244,59 +362,97 @@ class Microslabs:
         irho = build_profile(z, self.w, roughness, self.irho[0])
         return z, rho, irho
 
+    def reflectivity_amplitude(self, Q, probe=0):
+        """
+        Return the complex reflectivity of the slabs at *Q* for the given
+        *probe*, using the sign convention of :func:`invert.refl`.
+
+        Repeated blocks are evaluated without writing them out, so the
+        cost is logarithmic in the number of repeats.
+        """
+        from .invert import refl_repeat
+        slabs = self._slabs[:self._num_slabs]
+        w, sigma = slabs['w'], slabs['sigma']
+        rho, irho = slabs['rho'][:, probe], slabs['irho'][:, probe]
+        # refl uses 4 pi rho + 2 pi i mu/wavelength for the potential
+        return refl_repeat(Q, w, rho, self._repeats, mu=2*irho,
+                           sigma=sigma[:-1])
+
 
 def build_profile(z, thickness, roughness, value):
     """
     Convert a step profile to a smooth profile.
 
-    *z*          calculation points
+    *z*          calculation points, in increasing order
     *thickness*  thickness of the layers (first and last values ignored)
     *roughness*  roughness of the interfaces (one less than d)
     *value*      profile being computed
-    *max_rough*  limit the roughness to a fraction of the layer thickness
-    """
-
-    # Find interface depths
-    offset = np.hstack((-inf, 0, np.cumsum(thickness[1:-1]), inf))
-
-    # gives the layer boundaries in terms of the index of the z
-    idx = np.searchsorted(z, offset)
-    # TODO: The following hack makes sure the final z value is calculated.
-    # TODO: Make sure it works even when z is wider than the range of offsets.
-    if idx[-1] < len(z):
-        idx[-1] = len(z)
-
-    # compute the results
-    result = np.empty_like(z)
-    for i, v in enumerate(value):
-        zo = z[idx[i]:idx[i+1]]
-        if i == 0:
-            lvalue = 0
-            lblend = 0
-        else:
-            lvalue = value[i-1]
-            lblend = blend(zo-offset[i], roughness[i-1])
-        if i >= len(value)-1:
-            rvalue = 0
-            rblend = 0
-        else:
-            rvalue = value[i+1]
-            rblend = blend(offset[i+1]-zo, roughness[i])
-        mvalue = value[i]
-        mblend = 1 - (lblend+rblend)
-        result[idx[i]:idx[i+1]] = mvalue*mblend + lvalue*lblend + rvalue*rblend
-        #result[idx[i]:idx[i+1]] = rvalue*rblend
 
+    Each point is blended with the layers on either side of the layer
+    containing it, so only the two interfaces bounding that layer
+    contribute.  The blend is only computed for the band of points within
+    a few roughness widths of each interface; elsewhere the profile is
+    the step value.
+    """
+    z = np.asarray(z, 'd')
+    value = np.asarray(value, 'd')
+    n = len(value)
+    roughness = np.asarray(roughness, 'd')*np.ones(n-1)
+
+    # Interface depths, with sentinels so that layer i lies between
+    # offset[i] and offset[i+1].  A lone substrate has no interfaces.
+    interface = np.hstack((0, np.cumsum(thickness[1:-1])))[:n-1]
+    offset = np.hstack((-inf, interface, inf))
+    result = value[np.searchsorted(offset, z, 'right')-1]
+    if n < 2:
+        return result
+
+    # Points in the band below each interface (in layer k) pick up
+    # some of layer k+1, and points above it (in layer k+1) pick up
+    # some of layer k.  Zero roughness only affects points on the
+    # interface itself.
+    width = _BLEND_WIDTH*roughness
+    below_lo = np.searchsorted(z, np.maximum(interface-width, offset[:-2]))
+    below_hi = np.searchsorted(z, interface)
+    above_lo = below_hi
+    above_hi = np.where(roughness > 0,
+                        np.searchsorted(z, np.minimum(interface+width,
+                                                      offset[2:])),
+                        np.searchsorted(z, interface, 'right'))
+    step = np.diff(value)
+    for lo, hi, sign in ((below_lo, below_hi, -1), (above_lo, above_hi, 1)):
+        k, idx = _bands(lo, hi)
+        if len(idx):
+            depth = sign*(z[idx] - interface[k])
+            result[idx] -= sign*step[k]*blend(depth, roughness[k])
     return result
 
+def _bands(lo, hi):
+    """
+    Return the band number and the index of each point in the
+    concatenated ranges lo[k]:hi[k].
+    """
+    count = np.maximum(hi-lo, 0)
+    k = np.repeat(np.arange(len(count)), count)
+    start = np.cumsum(count)-count
+    return k, lo[k] + np.arange(len(k)) - start[k]
+
 def blend(z, rough):
     """
     blend function
 
     Given a Gaussian roughness value, compute the portion of the neighboring
     profile you expect to find in the current profile at depth z.
+
+    *rough* may be a vector of roughness values, one for each z.  The
+    blend is only computed within a few roughness widths of the interface,
+    beyond which it is zero or one to machine precision.
     """
-    if rough <= 0.0:
-        return np.where(np.greater(z, 0), 0.0, 1.0)
-    else:
-        return 0.5*(1.0 - erf(z/(rough*np.sqrt(2.0))))
+    z, rough = np.broadcast_arrays(np.asarray(z, 'd'), np.asarray(rough, 'd'))
+    result = np.where(np.greater(z, 0), 0.0, 1.0)
+    near = (rough > 0) & (abs(z) < _BLEND_WIDTH*rough)
+    result[near] = 0.5*(1.0 - erf(z[near]/(rough[near]*np.sqrt(2.0))))
+    return result
+
+# Number of roughness widths beyond which the blend is 0 or 1
+_BLEND_WIDTH = 8
@@ -3,7 +3,7 @@ import cmath
 
 import numpy as np
 
-from .util import isstr
+from .util import isstr, cached_loadtxt
 from .invert import SurroundVariation, remesh
 from .sld_profile import SLDProfile, refr_idx
 
@@ -88,7 +88,7 @@ class AbstractReferenceVariation(SurroundVariation):
         assert isinstance(sld_profile, SLDProfile)
 
         if isstr(file):
-            d = np.loadtxt(file, usecols=use_columns).T
+            d = cached_loadtxt(file, usecols=use_columns).T
             name = file
         else:
             d = file
@@ -257,15 +257,22 @@ Because d is fixed, that means s1(T) = s1(To) * T/To and s2(T) = s2(To) * T/To
 # TODO: the resolution calculator should not be responsible for loading
 # the data; maybe do it as a mixin?
 
+from collections import OrderedDict
+
 import numpy as np
 from numpy import pi, inf, sqrt, log, degrees, radians, cos, sin, tan, ceil
 from numpy import arcsin as asin
-from numpy import ones_like, arange, isscalar, asarray
+from numpy import ones_like, arange, asarray
 from .util import TL2Q, QL2T, dTdL2dQ, dQdT2dLoL, FWHM2sigma, sigma2FWHM
+from .util import cached_loadtxt, cache_key
 
 PROBE_KW = ('intensity', 'background', 'back_absorption',
             'theta_offset', 'back_reflectivity', 'data')
 
+# Number of resolution_batch() results kept for reuse; 0 disables the cache
+RESOLUTION_CACHE_SIZE = 32
+_resolution_cache = OrderedDict()
+
 
 class Resolution:
     """
@@ -362,7 +369,7 @@ class Monochromatic:
         """
 
         # Load the data
-        data = np.loadtxt(filename).T
+        data = cached_loadtxt(filename).T
         if data.shape[0] == 2:
             Q, R = data
             dR = None
@@ -539,6 +546,32 @@ class Monochromatic:
 
         return Resolution(T=T, dT=dT, L=L, dL=dLoL*L, radiation=radiation)
 
+    def resolution_batch(self, Q, **kw):
+        """
+        Return the resolution for each of a list of Q vectors.
+
+        The Q vectors are joined and evaluated in a single call to
+        :meth:`resolution`.  Results are cached by instrument settings
+        and Q, so repeating the calculation with the same values returns
+        immediately.  The cached arrays are read only.
+
+        **Parameters:**
+            *Q:* [float[n]]
+                Q values for each dataset.
+
+        **Returns:**
+            *[Resolution]*
+                One resolution for each Q vector.
+        """
+
+        Q = [asarray(Qk, 'd') for Qk in Q]
+        def compute():
+            res = self.resolution(Q=_join(Q), **kw)
+            return list(zip(_split(res.T, Q), _split(res.dT, Q),
+                            _split(res.L, Q), _split(res.dL, Q),
+                            [res.radiation]*len(Q)))
+        return _cached(self, Q, kw, compute)
+
     def __str__(self):
         msg = """\
 == Instrument %(name)s ==
@@ -619,7 +652,7 @@ class Polychromatic:
         """
 
         # Load the data
-        data = np.loadtxt(filename).T
+        data = cached_loadtxt(filename).T
         Q, dQ, R, dR, L = data
         dL = binwidths(L)
         T = kw.pop('T', QL2T(Q, L))
@@ -724,6 +757,43 @@ class Polychromatic:
         # Return the resolution
         return Resolution(T=T, dT=dT, L=L, dL=dL, radiation=radiation)
 
+    def resolution_batch(self, L, dL, T=None, **kw):
+        """
+        Return the resolution for each of a list of angle settings.
+
+        The divergence for all angles is evaluated in a single call.
+        Results are cached by instrument settings, angles and wavelengths,
+        so repeating the calculation with the same values returns
+        immediately.  The cached arrays are read only.
+
+        **Parameters:**
+            *L:* float[n] | [float[n]]
+                Wavelengths shared by all angles, or a list with the
+                wavelengths for each angle.
+
+            *dL:* float[n] | [float[n]]
+                Wavelength dispersion matching *L*.
+
+            *T:* [float | float[n]]
+                Angles for each dataset.  Defaults to the instrument angle.
+
+        **Returns:**
+            *[Resolution]*
+                One resolution for each angle.
+        """
+
+        T = [asarray(Tk, 'd') for Tk in ([self.T] if T is None else T)]
+        if np.ndim(L[0]) == 0:
+            L, dL = [L]*len(T), [dL]*len(T)
+        def compute():
+            radiation = kw.get('radiation', self.radiation)
+            opts = dict(kw)
+            slits = opts.pop('slits', self.slits)
+            dT = _split(self.calc_dT(_join(T), slits, **opts), T)
+            return [(Tk, dTk, Lk, dLk, radiation)
+                    for Tk, dTk, Lk, dLk in zip(_split(_join(T), T), dT, L, dL)]
+        return _cached(self, (T, L, dL), kw, compute)
+
     def __str__(self):
         msg = """\
 == Instrument %(name)s ==
@@ -760,6 +830,44 @@ slit distances = %(d_s1)g mm and %(d_s2)g mm
            )
         return msg
 
+def _join(arrays):
+    """Join *arrays* end to end into a vector."""
+    return np.hstack([a.ravel() for a in arrays]) if arrays else np.empty(0)
+
+def _split(value, arrays):
+    """Split a joined vector back into pieces shaped like *arrays*."""
+    if np.ndim(value) == 0:
+        return [value]*len(arrays)
+    offsets = np.cumsum([a.size for a in arrays])[:-1]
+    return [v.reshape(a.shape)[()]
+            for v, a in zip(np.split(value, offsets), arrays)]
+
+def _cached(instrument, grid, kw, compute):
+    """
+    Return resolutions for *instrument* on the measurement *grid*, using
+    compute() to build the (T, dT, L, dL, radiation) fields if they are
+    not in the cache.
+    """
+
+    if RESOLUTION_CACHE_SIZE <= 0:
+        return [Resolution(*fields) for fields in compute()]
+    key = cache_key((type(instrument), vars(instrument), grid,
+                     dict((k, v) for k, v in kw.items() if k not in PROBE_KW)))
+    fields = _resolution_cache.pop(key, None)
+    if fields is None:
+        fields = [tuple(_readonly(v) for v in row) for row in compute()]
+        while len(_resolution_cache) >= RESOLUTION_CACHE_SIZE:
+            _resolution_cache.popitem(last=False)
+    _resolution_cache[key] = fields
+    return [Resolution(*row) for row in fields]
+
+def _readonly(value):
+    """Return a read only view of arrays so cached values stay unchanged."""
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
 def bins(low, high, dLoL):
     """
     Return bin centers from low to high perserving a fixed resolution.
@@ -874,19 +982,12 @@ def divergence(T=None, slits=None, distance=None,
     # Compute FWHM angular divergence dT from the slits in radians
     dT = (s1+s2)/2/(d1-d2)
 
-    # For small samples, use the sample projection instead.
+    # For small samples, use the sample projection instead.  T, slits and
+    # sample width broadcast, so many angle sets can be evaluated at once.
     sample_s = sample_width * sin(radians(T))
-    if isscalar(sample_s):
-        if sample_s < s2:
-            dT = (s1+sample_s)/(2*d1)
-    else:
-        idx = sample_s < s2
-        #print(s1, s2, d1, d2, T, dT, sample_s)
-        s1 = ones_like(sample_s)*s1
-        dT = ones_like(sample_s)*dT
-        dT[idx] = (s1[idx] + sample_s[idx])/(2*d1)
+    dT = np.where(sample_s < s2, (s1+sample_s)/(2*d1), dT)
 
-    return dT + sample_broadening
+    return dT[()] + sample_broadening
 
 def opening_slits(T=None, slits_at_Tlo=None, Tlo=None, Thi=None,
                   slits_below=None, slits_above=None):
@@ -905,6 +1006,9 @@ def opening_slits(T=None, slits_at_Tlo=None, Tlo=None, Thi=None,
     *slits_above* are the slits at *T* > *Thi*.
     """
 
+    T = asarray(T, 'd')
+    absT = abs(T)
+
     # Slits at T<Tlo
     if slits_below is None:
         slits_below = slits_at_Tlo
@@ -921,11 +1025,11 @@ def opening_slits(T=None, slits_at_Tlo=None, Tlo=None, Thi=None,
             m1, m2 = slits_at_Tlo
         except TypeError:
             m1 = m2 = slits_at_Tlo
-        idx = (abs(T) >= Tlo)
+        idx = (absT >= Tlo)
         if Thi is not None:
-            idx &= (abs(T) <= Thi)
-        s1[idx] = m1 * T[idx]/Tlo
-        s2[idx] = m2 * T[idx]/Tlo
+            idx &= (absT <= Thi)
+        s1 = np.where(idx, m1 * T/Tlo, s1)
+        s2 = np.where(idx, m2 * T/Tlo, s2)
 
     # Slits at T > Thi
     if Thi is not None:
@@ -935,9 +1039,9 @@ def opening_slits(T=None, slits_at_Tlo=None, Tlo=None, Thi=None,
             t1, t2 = slits_above
         except TypeError:
             t1 = t2 = slits_above
-        idx = abs(T) > Thi
-        s1[idx] = t1
-        s2[idx] = t2
+        idx = absT > Thi
+        s1 = np.where(idx, t1, s1)
+        s2 = np.where(idx, t2, s2)
 
     return s1, s2
 
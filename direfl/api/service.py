@@ -0,0 +1,388 @@
+# This program is public domain
+"""
+Local phase reconstruction and inversion service.
+
+Starting a python process for each inversion costs more in imports than
+many small inversions take to compute.  The service keeps a pool of worker
+processes with everything imported, and takes jobs over HTTP on localhost.
+Start it from the command line with::
+
+    invert --serve 8765 -j 4
+
+or from python with :func:`serve`, or :class:`InversionService` to run it
+in the background of another program.
+
+Jobs are posted as a JSON object to */reconstruct* or */invert*, and the
+result is returned as the .npz file written by *save_results*, which
+:func:`direfl.api.invert.load_results` turns back into a
+:class:`SurroundVariation` or :class:`Inversion`.  :class:`Client` does
+this from python::
+
+    >>> from direfl.api.service import Client
+    >>> client = Client("http://127.0.0.1:8765")
+    >>> inversion = client.invert(data=(Q, RealR, dRealR), thickness=200)
+
+=============  ===============================================================
+Job            Parameters
+=============  ===============================================================
+*reconstruct*  *data1*, *data2* columns (Q, R, dR) or file names, substrate
+               *u*, surrounds *v1*, *v2*, and optional *stages*, *seed*
+*invert*       *data* columns (Q, RealR, dRealR) or file name, and the
+               numeric :class:`Inversion` controls; or instead of *data*,
+               the *reconstruct* parameters for the phase, with *stages*
+               and *seed* for the reconstruction in *phase_args*
+=============  ===============================================================
+
+The service has no authentication, so jobs are restricted to computing
+results.  Parameters other than those above, such as *cache* or
+*showiters*, are refused, and file names are only accepted for files
+under the *data_root* given to the service.  Without a *data_root*, data
+must be sent in the job.
+
+At most *queue_size* jobs are accepted at a time, running or waiting for a
+worker.  Beyond that the service answers 503 Service Unavailable with a
+Retry-After header rather than queuing without bound.  Other failures
+return 400 Bad Request with the error as JSON.  GET */status* returns the
+worker and job counts as JSON.
+"""
+from __future__ import print_function
+
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import numpy as np
+
+from .util import isstr, _json_value
+
+# Job kinds accepted by the service
+JOBS = ('reconstruct', 'invert')
+
+# Numeric controls accepted for each kind of job
+RECONSTRUCT_CONTROLS = ('u', 'v1', 'v2', 'stages', 'seed')
+INVERT_CONTROLS = ('substrate', 'thickness', 'calcpoints', 'rhopoints',
+                   'Qmin', 'Qmax', 'iters', 'stages', 'ctf_window',
+                   'backrefl', 'noise', 'bse', 'monitor', 'seed')
+
+
+class ServiceBusy(Exception):
+    """The service has *queue_size* jobs in progress."""
+
+
+class InversionService(object):
+    """
+    HTTP service running jobs on a pool of *processes* workers.
+
+    The server listens on *host*:*port*; use port 0 to pick a free port,
+    which is then available as *address*.  Jobs may name data files under
+    the directory *data_root*; if it is None, data must be sent in the
+    job.  Call :meth:`serve_forever` to
+    handle requests in this thread or :meth:`start` to handle them in the
+    background, and :meth:`close` to stop.
+    """
+    def __init__(self, host="127.0.0.1", port=8765, processes=None,
+                 queue_size=None, data_root=None):
+        from http.server import ThreadingHTTPServer
+        from multiprocessing import Pool, cpu_count
+
+        self.processes = processes if processes else cpu_count()
+        self.queue_size = queue_size if queue_size else 4*self.processes
+        self.data_root = (os.path.realpath(data_root)
+                          if data_root is not None else None)
+        self.pool = Pool(self.processes, initializer=_start_worker)
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._lock = threading.Lock()
+        self.counts = dict(pending=0, completed=0, failed=0, rejected=0)
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.service = self
+        self.address = self.server.server_address[:2]
+        self._thread = None
+
+    def serve_forever(self):
+        """Handle requests until :meth:`close` is called."""
+        self.server.serve_forever()
+
+    def start(self):
+        """Handle requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the server and the workers."""
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+        self.server.server_close()
+        self.pool.terminate()
+        self.pool.join()
+
+    def status(self):
+        """Return the worker and job counts."""
+        with self._lock:
+            return dict(self.counts, workers=self.processes,
+                        queue_size=self.queue_size)
+
+    def submit(self, kind, params):
+        """
+        Run job *kind* with *params* on a worker, returning the .npz file
+        contents.  Raises :class:`ServiceBusy` if the queue is full, or
+        ValueError if the parameters are not allowed.
+        """
+        if kind not in JOBS:
+            raise ValueError("unknown job %r"%kind)
+        params = self._check_job(kind, params)
+        if not self._slots.acquire(False):
+            self._count('rejected')
+            raise ServiceBusy("%d jobs in progress"%self.queue_size)
+        try:
+            self._count('pending')
+            try:
+                result = self.pool.apply_async(_run_job, (kind, params)).get()
+            except Exception:
+                self._count('failed')
+                raise
+            self._count('completed')
+            return result
+        finally:
+            self._count('pending', -1)
+            self._slots.release()
+
+    def _check_job(self, kind, params):
+        """
+        Return a copy of the job *params* with the data file names resolved,
+        or raise ValueError for parameters the service does not accept.
+        """
+        params = dict(params)
+        if kind == 'reconstruct':
+            data, controls = ('data1', 'data2'), RECONSTRUCT_CONTROLS
+        elif 'data' in params:
+            data, controls = ('data',), INVERT_CONTROLS
+        else:
+            data = ('data1', 'data2')
+            controls = INVERT_CONTROLS + ('u', 'v1', 'v2', 'phase_args')
+            phase_args = params.get('phase_args', {})
+            if not isinstance(phase_args, dict):
+                raise ValueError("phase_args must be a JSON object")
+            _check_controls(phase_args, ('stages', 'seed'))
+        _check_controls(params, data+controls, skip=data+('phase_args',))
+        for name in data:
+            params[name] = self._data_file(params.get(name), name)
+        return params
+
+    def _data_file(self, data, name):
+        """
+        Return job input *name*, with a file name resolved in *data_root*.
+        """
+        if not isstr(data):
+            return data
+        if self.data_root is None:
+            raise ValueError("%s must be sent as data columns"%name)
+        path = os.path.realpath(os.path.join(self.data_root, data))
+        if os.path.commonpath([path, self.data_root]) != self.data_root:
+            raise ValueError("%s is outside the data directory"%name)
+        return path
+
+    def _count(self, key, step=1):
+        with self._lock:
+            self.counts[key] += step
+
+
+def serve(port=8765, processes=None, queue_size=None, host="127.0.0.1",
+          data_root=None):
+    """
+    Run the service on *host*:*port* until interrupted.
+    """
+    service = InversionService(host=host, port=port, processes=processes,
+                               queue_size=queue_size, data_root=data_root)
+    print("Serving %d workers on http://%s:%d"
+          % ((service.processes,) + tuple(service.address)))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+class Client(object):
+    """
+    Python client for a running :class:`InversionService` at *url*.
+
+    If *retry* is True, jobs refused because the service is busy are sent
+    again after the delay the service asks for.  Otherwise
+    :class:`ServiceBusy` is raised.  Errors in the job are raised as
+    ValueError.
+    """
+    def __init__(self, url="http://127.0.0.1:8765", retry=True, timeout=None):
+        self.url = url.rstrip('/')
+        self.retry, self.timeout = retry, timeout
+
+    def reconstruct(self, **params):
+        """Run a *reconstruct* job, returning a SurroundVariation."""
+        return self._load(self._post('reconstruct', params))
+
+    def invert(self, **params):
+        """Run an *invert* job, returning an Inversion."""
+        return self._load(self._post('invert', params))
+
+    def status(self):
+        """Return the worker and job counts of the service."""
+        from contextlib import closing
+        from urllib.request import urlopen
+        with closing(urlopen(self.url+"/status", timeout=self.timeout)) as r:
+            return json.loads(r.read().decode('utf-8'))
+
+    def _post(self, kind, params):
+        import time
+        from contextlib import closing
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        body = json.dumps(params, default=_json_value).encode('utf-8')
+        while True:
+            request = Request(self.url+"/"+kind, data=body,
+                              headers={'Content-Type': 'application/json'})
+            try:
+                with closing(urlopen(request, timeout=self.timeout)) as r:
+                    return r.read()
+            except HTTPError as exc:
+                message = exc.read().decode('utf-8', 'replace')
+                if exc.code == 503 and self.retry:
+                    time.sleep(float(exc.headers.get('Retry-After', 1)))
+                    continue
+                try:
+                    message = json.loads(message)['error']
+                except (ValueError, KeyError, TypeError):
+                    pass
+                if exc.code == 503:
+                    raise ServiceBusy(message)
+                raise ValueError(message)
+
+    def _load(self, content):
+        from .invert import load_results
+        return load_results(io.BytesIO(content), mmap_mode=None)
+
+
+def _check_controls(params, allowed, skip=()):
+    """
+    Raise ValueError if *params* has keys not in *allowed*, or values other
+    than numbers or null for keys not in *skip*.
+    """
+    unknown = sorted(k for k in params if k not in allowed)
+    if unknown:
+        raise ValueError("Invalid job parameter %s"%", ".join(unknown))
+    for k, v in params.items():
+        if k in skip or v is None:
+            continue
+        if not isinstance(v, (int, float)):
+            raise ValueError("job parameter %s must be a number"%k)
+
+
+def _start_worker():
+    """
+    Prepare a worker: import the calculation modules before the first job
+    and give the worker its own random stream for the noise stages.
+    """
+    from . import invert
+    np.random.seed()
+
+
+def _run_job(kind, params):
+    """
+    Run job *kind* with the JSON *params*, returning the .npz contents.
+    """
+    from .invert import Inversion
+
+    params = dict(params)
+    if kind == 'reconstruct':
+        result = _reconstruct(params)
+    else:
+        if 'data' in params:
+            data = _job_data(params.pop('data'), 'data')
+        else:
+            phase_args = dict(params.pop('phase_args', {}))
+            for k in ('data1', 'data2', 'u', 'v1', 'v2'):
+                if k in params:
+                    phase_args[k] = params.pop(k)
+            phase_args.setdefault('u', params.get('substrate',
+                                                  Inversion.substrate))
+            phase = _reconstruct(phase_args)
+            data = phase.Q, phase.RealR, phase.dRealR
+        result = Inversion(data=data, **params)
+        result.run(showiters=False)
+
+    content = io.BytesIO()
+    result.save_results(content)
+    return content.getvalue()
+
+
+def _reconstruct(params):
+    """
+    Returns the SurroundVariation for the *reconstruct* job *params*.
+    """
+    from .invert import SurroundVariation
+
+    data1 = _job_data(params.pop('data1', None), 'data1')
+    data2 = _job_data(params.pop('data2', None), 'data2')
+    return SurroundVariation(data1, data2, **params)
+
+
+def _job_data(data, name):
+    """
+    Returns the columns of job input *name* as arrays, or the file name.
+    """
+    if data is None:
+        raise ValueError("job needs %s"%name)
+    if isstr(data):
+        return data
+    return [np.asarray(v, 'd') if v is not None else None for v in data]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Translate HTTP requests into service calls."""
+
+    def do_GET(self):
+        if self.path.rstrip('/') != "/status":
+            return self._reply(404, error="no such page %s"%self.path)
+        self._reply(200, **self.server.service.status())
+
+    def do_POST(self):
+        kind = self.path.strip('/')
+        if kind not in JOBS:
+            return self._reply(404, error="no such job %s"%kind)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(params, dict):
+                raise ValueError("job parameters must be a JSON object")
+        except ValueError as exc:
+            return self._reply(400, error="invalid request: %s"%exc)
+        try:
+            content = self.server.service.submit(kind, params)
+        except ServiceBusy as exc:
+            return self._reply(503, error=str(exc),
+                               headers={'Retry-After': '1'})
+        except Exception as exc:
+            return self._reply(400, error="%s: %s"%(type(exc).__name__, exc))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _reply(self, code, headers=None, **fields):
+        content = json.dumps(fields).encode('utf-8')
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # keep the console for the service messages
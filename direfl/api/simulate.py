@@ -10,6 +10,15 @@ Simulate classes and functions:
 * :class:`Simulation`
    Simulate phase-reconstruction and inversion.
 
+* :class:`Replicates`
+   Inverted profiles for repeated noisy measurements of a simulation.
+
+* :func:`plan`
+   Run simulations for a grid of candidate experiments in parallel.
+
+* :func:`choose_surround`
+   Rank candidate surround media by the error in the inverted profile.
+
 * :func:`wait`
    Wait for the user to acknowledge the plot.
 """
@@ -20,14 +29,18 @@ Simulate classes and functions:
 from __future__ import division, print_function
 
 import sys
+import time
+from itertools import combinations, product
 
 import numpy as np
 
 from matplotlib.font_manager import FontProperties
 
 from . import profile
-from .calc import convolve
-from .invert import plottitle, refl, SurroundVariation, Inversion
+from .calc import ResolutionOperator, adaptive_theory
+from .invert import (plottitle, refl_surround, SurroundVariation, Inversion,
+                     invert_batch, DARK_RED, Si, H2O, D2O)
+from .util import cache_key
 
 # Note that for efficiency, pylab is only imported if plotting is requested.
 
@@ -46,6 +59,9 @@ class Simulation():
                               reflectivity
     *phase_args*              keyword arguments for reconstruction calculation
     *invert_args*             keyword arguments for inversion calculation
+    *run*                     reconstruct and invert the simulated data; use
+                              False to only simulate the measurements, e.g.,
+                              for :meth:`replicates`
     ========================  =================================================
 
     The default values for the surround are set to u=Si (2.07), v1=Air (0),
@@ -57,7 +73,7 @@ class Simulation():
     def __init__(self, sample=None, q=None, dq=None, urough=0,
                  u=2.07, v1=0, v2=6.33, noise=0, seed=None,
                  phase_args={}, invert_args={},
-                 perfect_reconstruction=False):
+                 perfect_reconstruction=False, run=True):
         if np.isscalar(dq):
             dq = dq*np.ones_like(q)
         self.q, self.dq = q, dq
@@ -67,7 +83,9 @@ class Simulation():
         self.phase_args, self.invert_args = phase_args, invert_args
         self.perfect_reconstruction = perfect_reconstruction
         self.seed = seed
-        self.set()
+        self._simulate()
+        if run:
+            self.run()
 
 
     def set(self, **kw):
@@ -77,6 +95,12 @@ class Simulation():
 
         for k, v in kw.items():
             setattr(self, k, v)
+        self._simulate()
+        self.run()
+
+
+    def _simulate(self):
+        """Generate the measurements for the current parameters."""
 
         # Generate pure signals.  Note that the measurements are done
         # through the substrate, so we need to reverse the sample layers
@@ -84,23 +108,28 @@ class Simulation():
         q, u, v1, v2 = self.q, self.u, self.v1, self.v2
         urough = self.urough
 
-        # Measuring through the substrate so use -q to generate r1, r2
-        rho = [p[0] for p in self.sample]+[u]
+        # The film is the same in every surround, so evaluate it once for
+        # the two measurements through the substrate into v1 and v2 (the
+        # reversed film) and for the free film in u.  Phase reconstruction
+        # returns the phase for the reversed free film relative to the
+        # substrate, which is the +q reflectivity in u surround.
+        rho = [0] + [p[0] for p in self.sample] + [u]
         d = [0] + [p[1] for p in self.sample] + [0]
         sigma = [p[2] for p in self.sample]+[urough]
-        r1 = refl(-q, d, [v1]+rho, sigma=sigma)
-        r2 = refl(-q, d, [v2]+rho, sigma=sigma)
-
-        # Phase reconstruction returns the phase for the reversed free film
-        # relative to the substrate, so use +q reflectivity in u surround.
-        rfree = refl(q, d, [u]+rho, sigma=sigma)
+        media = [(u, v1, True), (u, v2, True), (u, u, False)]
+        r1, r2, rfree = refl_surround(q, d, rho, media, sigma=sigma)
 
         self.rfree, self.r1, self.r2 = rfree, r1, r2
 
         # Generate noisy measurements
-        R1, R2 = abs(r1)**2, abs(r2)**2
         if self.dq is not None:
-            R1, R2 = [convolve(q, R, q, self.dq) for R in (R1, R2)]
+            def theory(qt):
+                return abs(refl_surround(qt, d, rho, media[:2], sigma=sigma))**2
+            qt, R = adaptive_theory(theory, q, self.dq)
+            R1, R2 = ResolutionOperator(qt, q, self.dq)(R)
+        else:
+            R1, R2 = abs(r1)**2, abs(r2)**2
+        self.R1theory, self.R2theory = R1, R2
         if self.noise > 0:
             self.dR1, self.dR2 = self.noise*R1, self.noise*R2
             rng = np.random.RandomState(seed=self.seed)
@@ -111,7 +140,44 @@ class Simulation():
             self.R1, self.R2 = R1, R2
 
         self.fitz = self.fitrho = None  # Clear optimize
-        self.run()
+
+
+    def replicates(self, n, seed=None):
+        """
+        Reconstruct and invert *n* independent noisy measurements.
+
+        The noise-free reflectivities from :meth:`set` are reused for every
+        replicate, with the noise for all replicates drawn from a single
+        generator seeded with *seed*.  The replicates are reconstructed and
+        inverted together using *phase_args* and *invert_args*.  The same
+        generator gives the seed for the reconstruction, unless
+        *phase_args* has one, and a different seed for the inversion of
+        each replicate in place of any seed in *invert_args*.
+
+        Returns a :class:`Replicates` object comparing the inverted profiles
+        to :meth:`sample_profile`.
+        """
+        if self.noise <= 0:
+            raise ValueError("replicates need noise > 0")
+        R1, R2 = self.R1theory, self.R2theory
+        dR1, dR2 = self.noise*R1, self.noise*R2
+        rng = np.random.RandomState(seed=seed)
+        R1n = rng.normal(R1, dR1, size=(n, len(R1)))
+        R2n = rng.normal(R2, dR2, size=(n, len(R2)))
+        phase_args = dict(self.phase_args)
+        phase_args.setdefault('seed', rng.randint(2**31))
+        invert_args = dict(self.invert_args, seed=rng.randint(2**31, size=n))
+
+        phase = SurroundVariation((self.q, R1n, dR1), (self.q, R2n, dR2),
+                                  u=self.u, v1=self.v1, v2=self.v2,
+                                  **phase_args)
+        thickness = sum(L[1] for L in self.sample) + 50
+        inverters = invert_batch(phase.Q, phase.RealR, phase.dRealR,
+                                 thickness=thickness, substrate=phase.u,
+                                 **invert_args)
+        z, target = self.sample_profile(inverters[0])
+        rho = np.array([inv.rho for inv in inverters])
+        return Replicates(z, rho, target)
 
 
     def run(self):
@@ -139,10 +205,16 @@ class Simulation():
         return z, rho
 
 
-    def sample_profile(self):
-        z, rho_u, sigma_u = self.invert.z, self.invert.substrate, self.urough
+    def sample_profile(self, inversion=None):
+        """
+        Return the sample profile on the grid of *inversion*, or of the
+        inversion of the simulated data if *inversion* is None.
+        """
+        if inversion is None:
+            inversion = self.invert
+        z, rho_u, sigma_u = inversion.z, inversion.substrate, self.urough
         rhos, widths, sigmas = zip(*self.sample)
-        substrate_width = self.invert.thickness - np.sum(widths)
+        substrate_width = inversion.thickness - np.sum(widths)
         widths = np.hstack((0, widths, substrate_width))
         rhos = np.hstack((0, rhos, rho_u))
         sigmas = np.hstack((sigmas, sigma_u))
@@ -321,7 +393,7 @@ class Simulation():
         else:
             data = self.phase.Q, self.phase.RealR, self.phase.dRealR
         substrate = self.phase.u
-        thickness = np.sum(L[1] for L in self.sample) + 50
+        thickness = sum(L[1] for L in self.sample) + 50
         self.invert = Inversion(data=data, thickness=thickness,
                                 substrate=substrate, **self.invert_args)
         self.invert.run()
@@ -366,6 +438,282 @@ class Simulation():
         self.chuckr = realR
 
 
+class Replicates(object):
+    """
+    Inverted profiles for replicate measurements, as returned by
+    :meth:`Simulation.replicates`.
+
+    ===================  ======================================================
+    Attributes           Description
+    ===================  ======================================================
+    *z*                  depth of the profile points
+    *rho*                inverted profiles, with one row for each replicate
+    *target*             the true profile of the sample at *z*
+    *error*              RMS difference between each profile and *target*
+    *mean*, *std*        mean and standard deviation of the profiles at *z*
+    ===================  ======================================================
+    """
+
+    def __init__(self, z, rho, target):
+        self.z, self.rho, self.target = z, rho, target
+        self.error = np.sqrt(np.mean((rho - target)**2, axis=1))
+        self.mean = np.mean(rho, axis=0)
+        self.std = np.std(rho, axis=0)
+
+
+    def percentile(self, p):
+        """Return the *p* percentile of the profiles at each depth."""
+        return np.percentile(self.rho, p, axis=0)
+
+
+    def show(self):
+        """Print a summary of the profile errors."""
+        lo, median, hi = np.percentile(self.error, [5, 50, 95])
+        print("%d replicates: RMS profile error %.4g (%.4g to %.4g for 90%%)"
+              % (len(self.rho), median, lo, hi))
+
+
+    def plot(self, subplot=111):
+        """Plot the true profile with the 90% band of the inverted profiles."""
+        import pylab
+
+        pylab.subplot(subplot)
+        pylab.cla()
+        pylab.plot(self.z, self.target, color='blue', label='Model')
+        [h] = pylab.plot(self.z, self.percentile(50), color=DARK_RED,
+                         label='Median inverted')
+        pylab.fill_between(self.z, self.percentile(5), self.percentile(95),
+                           color=h.get_color(), alpha=0.2)
+        pylab.legend(prop=FontProperties(size='medium'))
+        pylab.ylabel('SLD (inv A^2)')
+        pylab.xlabel('Depth (A)')
+        plottitle('%d Replicates' % len(self.rho))
+
+
+# Columns of the table returned by plan()
+PLAN_COLUMNS = ['case', 'sample', 'v1', 'v2', 'noise', 'qmin', 'qmax', 'nq',
+                'seed', 'chisq', 'profile_error', 'time']
+
+
+def plan(samples, surrounds=((0, 6.33),), noise=(0.05,), q=None,
+         seed=1, processes=None, outfile=None, **kw):
+    """
+    Simulate reconstruction and inversion for a grid of experiments.
+
+    ===============  =========================================================
+    Parameters       Description
+    ===============  =========================================================
+    *samples*        list of sample structures as used by :class:`Simulation`
+    *surrounds*      list of (*v1*, *v2*) surround pairs
+    *noise*          list of noise levels
+    *q*              list of Q vectors to measure, or a single Q vector
+    *seed*           seed for the first case; case *i* uses *seed* + *i*
+    *processes*      number of worker processes, or None for one per CPU;
+                     use 1 to run in the current process
+    *outfile*        if given, save the table as text to this file
+    *kw*             additional keyword arguments for :class:`Simulation`,
+                     such as *u*, *dq*, *urough*, *phase_args*, *invert_args*
+    ===============  =========================================================
+
+    Every combination of sample, surround, noise and Q is run.  The seeds
+    are fixed for each case, so the results do not depend on the number of
+    processes or the order in which the cases are run.
+
+    Returns a table as a structured array with one row per case and the
+    fields in *PLAN_COLUMNS*: the indices and settings of the case, the
+    chisq of the inversion against the reconstructed phase, the RMS
+    difference between the inverted profile and :meth:`sample_profile`,
+    and the run time in seconds.  Cases which fail with a numerical error
+    have NaN results, and the error is reported as a warning.
+    """
+    if q is None:
+        q = [np.linspace(0, 0.3, 150)]
+    elif np.ndim(q[0]) == 0:
+        q = [q]
+    cases = [(seed+i, sample_id, sample, v1, v2, sigma, np.asarray(qi), kw)
+             for i, ((sample_id, sample), (v1, v2), sigma, qi)
+             in enumerate(product(enumerate(samples), surrounds, noise, q))]
+
+    if processes == 1:
+        results = [_plan_case(case) for case in cases]
+    else:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            results = pool.map(_plan_case, cases, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = []
+    for i, (case, result) in enumerate(zip(cases, results)):
+        case_seed, sample_id, _, v1, v2, sigma, qi, _ = case
+        if result[-1] is not None:
+            _case_failed("case %d"%i, result[-1])
+        rows.append((i, sample_id, v1, v2, sigma, qi[0], qi[-1], len(qi),
+                     case_seed) + result[:-1])
+    dtype = [(name, 'i' if name in ('case', 'sample', 'nq', 'seed') else 'd')
+             for name in PLAN_COLUMNS]
+    table = np.array(rows, dtype=dtype)
+    if outfile is not None:
+        np.savetxt(outfile, table, header=" ".join(PLAN_COLUMNS),
+                   fmt=["%d", "%d", "%g", "%g", "%g", "%g", "%g", "%d", "%d",
+                        "%.6g", "%.6g", "%.3f"])
+    return table
+
+
+# Errors which make a case fail rather than stopping the whole run
+_CASE_ERRORS = (ValueError, ArithmeticError)
+
+
+def _plan_case(case):
+    """
+    Run one case for :func:`plan`; returns (chisq, profile_error, time,
+    error message or None).
+    """
+    seed, _, sample, v1, v2, sigma, q, kw = case
+    start = time.time()
+    try:
+        sim = Simulation(sample=sample, q=q, v1=v1, v2=v2, noise=sigma,
+                         seed=seed, **_case_args(kw, seed))
+        _, rho = sim.sample_profile()
+        error = np.sqrt(np.mean((sim.invert.rho - rho)**2))
+        chisq = sim.invert.chisq()
+        message = None
+    except _CASE_ERRORS as exc:
+        chisq = error = np.nan
+        message = "%s: %s"%(type(exc).__name__, exc)
+    return chisq, error, time.time()-start, message
+
+
+def _case_args(kw, seed):
+    """
+    Return the :class:`Simulation` keywords *kw* with seeds for the noise
+    in the reconstruction and inversion drawn from *seed*, unless they are
+    already given, so that a case never uses the global generator.
+    """
+    rng = np.random.RandomState(seed)
+    kw = dict(kw)
+    for name in ('phase_args', 'invert_args'):
+        kw[name] = dict(kw.get(name, {}))
+        kw[name].setdefault('seed', rng.randint(2**31))
+    return kw
+
+
+def _case_failed(case, message):
+    """Report a failed case of :func:`plan` or :func:`choose_surround`."""
+    import warnings
+    warnings.warn("%s failed: %s"%(case, message))
+
+
+# Columns of the table returned by choose_surround()
+SURROUND_COLUMNS = ['rank', 'u', 'v1', 'v2', 'error', 'error_std', 'time']
+
+def water_mixture(fraction):
+    """SLD of an H2O/D2O mixture with the given volume *fraction* of D2O."""
+    return (1-fraction)*H2O + fraction*D2O
+
+
+def choose_surround(sample, surrounds=None, substrates=(Si,), noise=0.05,
+                    q=None, replicates=8, seed=1, processes=None,
+                    cache=None, outfile=None, **kw):
+    """
+    Rank surround media by how well the sample profile is recovered.
+
+    ===============  =========================================================
+    Parameters       Description
+    ===============  =========================================================
+    *sample*         sample structure as used by :class:`Simulation`
+    *surrounds*      list of (*v1*, *v2*) surround pairs; the default is
+                     every pair from air and H2O/D2O mixtures with 0, 25,
+                     50, 75 and 100% D2O
+    *substrates*     list of substrate SLDs *u* to try
+    *noise*          noise level of the simulated measurements
+    *q*              Q vector to measure
+    *replicates*     number of noisy measurements per candidate
+    *seed*           seed for the noise, shared by all candidates
+    *processes*      number of worker processes, or None for one per CPU;
+                     use 1 to run in the current process
+    *cache*          dictionary to keep results in for later calls with the
+                     same settings, or None
+    *outfile*        if given, save the table as text to this file
+    *kw*             additional keyword arguments for :class:`Simulation`,
+                     such as *dq*, *urough*, *phase_args*, *invert_args*
+    ===============  =========================================================
+
+    Each candidate (*u*, *v1*, *v2*) is scored by the mean RMS difference
+    between the inverted and the true profile over *replicates* noisy
+    measurements from :meth:`Simulation.replicates`.  Every candidate sees
+    the same noise, so differences in score come from the surround.
+    Candidates are evaluated in parallel, and candidates already in *cache*
+    for the same sample and settings are not evaluated again.
+
+    Returns a table as a structured array with the fields in
+    *SURROUND_COLUMNS*, sorted from best to worst, with the mean and
+    standard deviation of the profile error and the run time in seconds.
+    Candidates which fail with a numerical error have NaN results and are
+    ranked last, and the error is reported as a warning.
+    """
+    if q is None:
+        q = np.linspace(0, 0.3, 150)
+    if surrounds is None:
+        media = [0] + [water_mixture(f) for f in (0, 0.25, 0.5, 0.75, 1)]
+        surrounds = list(combinations(media, 2))
+    cases = [(sample, u, v1, v2, noise, np.asarray(q), replicates, seed, kw)
+             for u, (v1, v2) in product(substrates, surrounds)]
+
+    if cache is None:
+        cache = {}
+    keys = [cache_key(case) for case in cases]
+    todo = [case for key, case in zip(keys, cases) if key not in cache]
+    if processes == 1:
+        results = [_surround_case(case) for case in todo]
+    elif todo:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            results = pool.map(_surround_case, todo, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+    for case, result in zip(todo, results):
+        if result[-1] is not None:
+            _case_failed("surround u=%g v1=%g v2=%g"%case[1:4], result[-1])
+        cache[cache_key(case)] = result[:-1]
+
+    rows = [case[1:4] + cache[key] for key, case in zip(keys, cases)]
+    rows.sort(key=lambda row: (np.isnan(row[3]), row[3]))
+    dtype = [(name, 'i' if name == 'rank' else 'd')
+             for name in SURROUND_COLUMNS]
+    table = np.array([(i+1,) + row for i, row in enumerate(rows)],
+                     dtype=dtype)
+    if outfile is not None:
+        np.savetxt(outfile, table, header=" ".join(SURROUND_COLUMNS),
+                   fmt=["%d", "%g", "%g", "%g", "%.6g", "%.6g", "%.3f"])
+    return table
+
+
+def _surround_case(case):
+    """
+    Score one candidate for :func:`choose_surround`; returns
+    (error, error_std, time, error message or None).
+    """
+    sample, u, v1, v2, noise, q, replicates, seed, kw = case
+    start = time.time()
+    try:
+        sim = Simulation(sample=sample, q=q, u=u, v1=v1, v2=v2, noise=noise,
+                         seed=seed, run=False, **_case_args(kw, seed))
+        error = sim.replicates(replicates, seed=seed).error
+        score = np.mean(error), np.std(error)
+        message = None
+    except _CASE_ERRORS as exc:
+        score = np.nan, np.nan
+        message = "%s: %s"%(type(exc).__name__, exc)
+    return score + (time.time()-start, message)
+
+
 def wait(msg=None):
     """Wait for the user to acknowledge the plot."""
     import pylab
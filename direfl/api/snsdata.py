@@ -10,6 +10,8 @@ The following instruments are defined::
 These are :class:`resolution.Polychromatic` classes tuned with
 default instrument parameters and loaders for reduced SNS data.
 See :module:`resolution` for details.
+
+Use :func:`load_batch` to load a directory of runs as a :class:`RunTable`.
 """
 
 import re
@@ -53,7 +55,16 @@ def load(filename, instrument=None, **kw):
     Return a probe for NCNR data.
     """
     header, data = parse_file(filename)
-    return _make_probe(geometry=Polychromatic(), header=header, data=data, **kw)
+    return _make_probe(geometry=_geometry(instrument), header=header,
+                       data=data, **kw)
+
+def _geometry(instrument):
+    """
+    Return the geometry for the resolution of a file, which is the generic
+    :class:`Polychromatic` geometry unless *instrument* is given.  The
+    instrument named in the file only supplies the slit distances.
+    """
+    return instrument if instrument is not None else Polychromatic()
 
 def _make_probe(geometry, header, data, **kw):
     header.update(**kw)
@@ -67,6 +78,13 @@ def _make_probe(geometry, header, data, **kw):
     probe.instrument = header['instrument']
     return probe
 
+# Patterns for the column names, comments and "(value, 'units')" values
+# in the header
+_COLUMN_PATTERN = re.compile(r'(?P<name>\w+)[(](?P<units>\w*)[)]')
+_COMMENT_PATTERN = re.compile(r'(?P<name>.*)\s*:\s*(?P<value>.*)\s*\n')
+_VALUE_PATTERN = re.compile(
+    r"[(]\s*(?P<value>.*)\s*, \s*'(?P<units>.*)'\s*[)]")
+
 def parse_file(filename):
     """
     Parse SNS reduced data, returning *header* and *data*.
@@ -99,21 +117,18 @@ def parse_file(filename):
     header['date'] = raw_header.get('D', '')
 
     # Column names and units
-    columnpat = re.compile(r'(?P<name>\w+)[(](?P<units>\w*)[)]')
-    columns, units = zip(*columnpat.findall(raw_header.get('L', '')))
+    columns, units = zip(*_COLUMN_PATTERN.findall(raw_header.get('L', '')))
     header['columns'] = columns
     header['units'] = units
 
     # extra information like title, angle, etc.
-    commentpat = re.compile(r'(?P<name>.*)\s*:\s*(?P<value>.*)\s*\n')
-    comments = dict(commentpat.findall(raw_header.get('C', '')))
+    comments = dict(_COMMENT_PATTERN.findall(raw_header.get('C', '')))
     header['title'] = comments.get('Title', '')
     header['description'] = comments.get('Notes', '')
 
     # parse values of the form "Long Name: (value, 'units')" in comments
-    valuepat = re.compile(r"[(]\s*(?P<value>.*)\s*, \s*'(?P<units>.*)'\s*[)]")
     def parse_value(valstr):
-        d = valuepat.match(valstr).groupdict()
+        d = _VALUE_PATTERN.match(valstr).groupdict()
         return float(d['value']), d['units']
     if 'Detector Angle' in comments:
         header['angle'], _ = parse_value(comments['Detector Angle'])
@@ -121,6 +136,136 @@ def parse_file(filename):
     return header, data
 
 
+# Header fields which are used to compute the resolution
+RESOLUTION_KEYS = ('radiation', 'd_s1', 'd_s2', 'slits', 'sample_width',
+                   'sample_broadening')
+
+# Per run fields of the table returned by load_batch()
+RUN_COLUMNS = ['filename', 'instrument', 'title', 'date', 'angle', 'group',
+               'start', 'stop']
+
+def load_batch(path, instrument=None, processes=None, **kw):
+    """
+    Load a set of reduced SNS files into a :class:`RunTable`.
+
+    *path* is a directory, in which case every file in it is loaded, or
+    a glob pattern such as 'runs/REF_L_*.txt'.  *instrument* is the
+    :class:`resolution.Polychromatic` geometry to use for every file, with
+    the same default as :func:`load`.  Other keyword arguments override
+    header fields as for :func:`load`.
+
+    The files are parsed in separate threads, or in *processes* worker
+    processes if given, as for :func:`util.map_files`.  Runs with the same
+    instrument, angle, wavelength bins and resolution settings form a
+    group, and the resolution is computed once for each group.  As for
+    :func:`load`, the angle is computed from the first Q and wavelength
+    of each run unless *angle* is given.
+
+    Files which cannot be read are skipped with a warning, and listed with
+    the reason in the *errors* of the table.
+    """
+    import glob
+    import os
+
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        files = [f for f in files if os.path.isfile(f)]
+    else:
+        files = sorted(glob.glob(path))
+    if not files:
+        raise IOError("No files match '%s'"%path)
+
+    parsed = util.map_files(_parse_run, files, processes=processes)
+    errors = [(f, p) for f, p in zip(files, parsed) if isinstance(p, str)]
+    if errors:
+        import warnings
+        warnings.warn("skipped %d unreadable files: %s"
+                      % (len(errors), ", ".join(f for f, _ in errors)))
+    if len(errors) == len(files):
+        raise IOError("No readable files match '%s'"%path)
+    groups, resolutions, runs, data = {}, [], [], []
+    start = 0
+    for filename, run in zip(files, parsed):
+        if isinstance(run, str):
+            continue
+        header, columns = run
+        header.update(**kw)
+        Q, dQ, R, dR, L = columns
+        T = kw.get('angle', util.QL2T(Q[0], L[0]))
+        geometry = _geometry(instrument)
+        key = (type(geometry), T, L.tobytes(),
+               repr([header.get(k, None) for k in RESOLUTION_KEYS]))
+        if key not in groups:
+            groups[key] = len(resolutions)
+            resolutions.append(geometry.resolution(L=L, dL=binwidths(L),
+                                                   T=T, **header))
+        runs.append((filename, header['instrument'], header['title'],
+                     header['date'], T, groups[key], start, start+len(Q)))
+        data.append(columns)
+        start += len(Q)
+
+    dtype = [('filename', object), ('instrument', object), ('title', object),
+             ('date', object), ('angle', 'd'), ('group', 'i'),
+             ('start', 'i'), ('stop', 'i')]
+    return RunTable(np.array(runs, dtype=dtype),
+                    np.hstack(data), resolutions, errors)
+
+
+def _parse_run(filename):
+    """
+    Return the header and data of a reduced SNS file, or the reason it
+    cannot be read.
+    """
+    try:
+        header, data = parse_file(filename)
+        if len(data) != 5 or data.ndim != 2:
+            raise ValueError("expected columns Q dQ R dR L")
+    except Exception as exc:
+        return "%s: %s"%(type(exc).__name__, exc)
+    return header, data
+
+
+class RunTable(object):
+    """
+    Reduced SNS runs stored column by column, as returned by
+    :func:`load_batch`.
+
+    ======================  ===================================================
+    Attributes              Description
+    ======================  ===================================================
+    *runs*                  structured array with one row per run and the
+                            fields in *RUN_COLUMNS*
+    *Q*, *dQ*, *R*, *dR*,   data for all runs end to end, with run *i* in
+    *L*                     the slice *runs['start'][i]:runs['stop'][i]*
+    *resolutions*           resolution for each group of runs, with *T*,
+                            *dT*, *L*, *dL*, *Q*, *dQ*
+    *errors*                (filename, reason) for each file which was
+                            skipped because it could not be read
+    ======================  ===================================================
+
+    Use *data(i)* to get (Q, dQ, R, dR) for run *i* in the form expected by
+    :class:`invert.SurroundVariation`.
+    """
+
+    def __init__(self, runs, columns, resolutions, errors=()):
+        self.runs = runs
+        self.Q, self.dQ, self.R, self.dR, self.L = columns
+        self.resolutions = resolutions
+        self.errors = list(errors)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def data(self, i):
+        """Return (Q, dQ, R, dR) for run *i*."""
+        index = slice(self.runs['start'][i], self.runs['stop'][i])
+        return self.Q[index], self.dQ[index], self.R[index], self.dR[index]
+
+    def resolution(self, i):
+        """Return the resolution for run *i*."""
+        return self.resolutions[self.runs['group'][i]]
+
+
 class SNSLoader:
     def load(self, filename, **kw):
         header, data = parse_file(filename)
@@ -1,3 +1,7 @@
+import os
+import warnings
+from itertools import chain
+
 import numpy as np
 from numpy import pi, inf, nan, sqrt, log, degrees, radians, cos, sin, tan
 from numpy import arcsin as asin
@@ -73,6 +77,10 @@ def parse_file(file):
     Data lines look like float float float
     Comment lines look like # float float float
     Data may contain inf or nan values.
+
+    Files ending in .gz are decompressed as they are read.  The header
+    lines are separated out as the file is scanned, and the data lines
+    are passed straight on to the numpy text parser.
     """
     if hasattr(file, 'readline'):
         fh = file
@@ -80,25 +88,328 @@ def parse_file(file):
         raise ValueError('file must be a name or a file handle')
     elif file.endswith('.gz'):
         import gzip
-        fh = gzip.open(file)
+        fh = gzip.open(file, 'rt')
     else:
         fh = open(file)
     header = {}
-    data = []
-    for line in fh:
-        columns, key, value = _parse_line(line)
-        if columns:
-            data.append([indfloat(v) for v in columns])
-        if key:
-            if key in header:
-                header[key] = "\n".join((header[key], value))
-            else:
-                header[key] = value
-    if fh is not file:
-        fh.close()
-    #print([len(d) for d in data])
+    lines = chain.from_iterable(_data_blocks(fh, header))
+    try:
+        with warnings.catch_warnings():
+            # An empty data block is not an error
+            warnings.simplefilter('ignore', UserWarning)
+            data = np.loadtxt(lines, comments='#', ndmin=2)
+    finally:
+        if fh is not file:
+            fh.close()
     #print("\n".join(k+":"+v for k, v in header.items()))
-    return header, np.array(data).T
+    return header, (data.T if data.size else np.array([]))
+
+def _data_blocks(fh, header, blocksize=1<<20):
+    """
+    Generate lists of the data lines in *fh*, a block at a time, collecting
+    the header lines into the dictionary *header*.
+    """
+    while True:
+        block = fh.read(blocksize)
+        if not block:
+            return
+        if not block.endswith('\n'):
+            block += fh.readline()
+        lines = block.splitlines(True)
+        # Header lines are rare, so only check blocks which contain them
+        if block.startswith('#') or '\n#' in block:
+            data = []
+            for line in lines:
+                if not line.startswith('#'):
+                    data.append(line)
+                    continue
+                _, key, value = _parse_line(line)
+                if key:
+                    if key in header:
+                        header[key] = "\n".join((header[key], value))
+                    else:
+                        header[key] = value
+            lines = data
+        yield lines
+
+# Directory holding binary copies of the text data files read by
+# cached_loadtxt, or None to parse the text every time.  The copies are
+# only kept if DIREFL_CACHE names the directory.
+DATA_CACHE = os.environ.get('DIREFL_CACHE') or None
+# Bytes of copies to keep in DATA_CACHE; least recently used go first.
+DATA_CACHE_SIZE = 256*2**20
+
+def cached_loadtxt(filename, usecols=None):
+    """
+    Return np.loadtxt(*filename*, usecols=*usecols*).
+
+    The first time a file is read, a copy of the data is saved as a .npy
+    file in *DATA_CACHE*, named for the path of the file and the columns
+    used.  Later reads memory map the copy instead of parsing the text,
+    for as long as the size and modification time of the file are the same.
+    The returned array is copy-on-write, so changes to it are not saved.
+    When the copies total more than *DATA_CACHE_SIZE* bytes, the least
+    recently used are removed.
+    """
+    if DATA_CACHE is None:
+        return np.loadtxt(filename, usecols=usecols)
+    import hashlib
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    mtime = getattr(stat, 'st_mtime_ns', int(stat.st_mtime*1e9))
+    key = repr((path, usecols)).encode('utf-8')
+    prefix = hashlib.sha1(key).hexdigest()[:20]
+    cache = os.path.join(DATA_CACHE,
+                         "%s-%x-%x.npy"%(prefix, stat.st_size, mtime))
+    if os.path.exists(cache):
+        try:
+            data = np.load(cache, mmap_mode='c')
+            os.utime(cache, None)  # mark as recently used
+            return data
+        except Exception:
+            pass  # damaged copy; parse the file and replace it
+
+    data = np.loadtxt(filename, usecols=usecols)
+    try:
+        if not os.path.isdir(DATA_CACHE):
+            os.makedirs(DATA_CACHE)
+        # Copies of older versions of the file are no longer needed
+        for name in os.listdir(DATA_CACHE):
+            if name.startswith(prefix+"-"):
+                os.remove(os.path.join(DATA_CACHE, name))
+        # Write under a temporary name so other readers never see a
+        # partial file.
+        tmp = "%s.%d.tmp"%(cache, os.getpid())
+        with open(tmp, 'wb') as fid:
+            np.save(fid, data)
+        os.replace(tmp, cache)
+        _evict(DATA_CACHE, ".npy", DATA_CACHE_SIZE)
+    except (OSError, IOError):
+        pass  # the cache is optional
+    return data
+
+class ResultCache(object):
+    """
+    Directory of computed results, keyed by a hash of their inputs.
+
+    Each result is a dictionary of arrays, saved as an .npz file named for
+    its key.  Files are written under a temporary name and renamed into
+    place, so processes sharing the directory never see a partial result.
+    When the files total more than *maxsize* bytes, the least recently
+    used results are removed.
+    """
+    def __init__(self, path=None, maxsize=256*2**20):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.direfl', 'results')
+        self.path, self.maxsize = path, maxsize
+
+    @staticmethod
+    def key(*parts):
+        """Return a hex digest of *parts*, including array contents."""
+        import hashlib
+        digest = hashlib.sha1()
+        _digest(digest, parts)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the arrays saved for *key*, or None if there are none."""
+        filename = os.path.join(self.path, key+".npz")
+        try:
+            with np.load(filename) as data:
+                result = dict((k, data[k]) for k in data.files)
+            os.utime(filename, None)  # mark as recently used
+        except Exception:
+            return None  # missing, removed by another process, or damaged
+        return result
+
+    def put(self, key, arrays):
+        """Save the dictionary of *arrays* for *key*."""
+        import tempfile
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+            try:
+                with os.fdopen(fd, 'wb') as fid:
+                    np.savez(fid, **arrays)
+                os.replace(tmp, os.path.join(self.path, key+".npz"))
+            except Exception:
+                os.remove(tmp)
+                raise
+            self._evict()
+        except (OSError, IOError):
+            pass  # the cache is optional
+
+    def clear(self):
+        """Remove all saved results."""
+        for name in self._entries():
+            _remove(os.path.join(self.path, name[2]))
+
+    def _entries(self):
+        """Return (mtime, size, name) for each saved result."""
+        return _entries(self.path, ".npz")
+
+    def _evict(self):
+        """Remove the least recently used results beyond *maxsize* bytes."""
+        _evict(self.path, ".npz", self.maxsize)
+
+def _entries(path, suffix):
+    """Return (mtime, size, name) for each file in *path* ending *suffix*."""
+    entries = []
+    for name in os.listdir(path) if os.path.isdir(path) else []:
+        if name.endswith(suffix):
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+    return entries
+
+def _evict(path, suffix, maxsize):
+    """Remove the least recently used *suffix* files beyond *maxsize* bytes."""
+    entries = sorted(_entries(path, suffix))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= maxsize:
+            break
+        _remove(os.path.join(path, name))
+        total -= size
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass  # already removed by another process
+
+def _digest(digest, value):
+    """Add *value* to the hash *digest*, including array contents."""
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update(repr(('array', value.dtype.str, value.shape))
+                      .encode('utf-8'))
+        digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        digest.update(("dict %d"%len(value)).encode('utf-8'))
+        for k in sorted(value):
+            _digest(digest, k)
+            _digest(digest, value[k])
+    elif isinstance(value, (list, tuple)):
+        digest.update(("list %d"%len(value)).encode('utf-8'))
+        for v in value:
+            _digest(digest, v)
+    else:
+        text = repr(value)
+        digest.update(("%d:%s"%(len(text), text)).encode('utf-8'))
+
+def save_npz(filename, arrays, metadata):
+    """
+    Save the dictionary of *arrays* to the .npz file *filename*, with the
+    dictionary *metadata* stored as JSON text in the *metadata* array.
+    *filename* may also be a file object open for writing.
+
+    The arrays are not compressed, so :func:`load_npz` can memory map them.
+    """
+    import json
+    arrays = dict((k, v) for k, v in arrays.items() if v is not None)
+    text = json.dumps(metadata, default=_json_value).encode('utf-8')
+    arrays['metadata'] = np.frombuffer(text, dtype='u1')
+    if hasattr(filename, 'write'):
+        np.savez(filename, **arrays)
+    else:
+        with open(filename, 'wb') as fid:
+            np.savez(fid, **arrays)
+
+def load_npz(filename, mmap_mode='r'):
+    """
+    Return the metadata and arrays saved by :func:`save_npz`.
+
+    Each array is memory mapped from the file with *mmap_mode*, so only
+    the parts which are used are read from disk.  Use *mmap_mode=None* to
+    read the arrays into memory, as is always done when *filename* is a
+    file object rather than a name.
+    """
+    import json
+    import struct
+    import zipfile
+    from numpy.lib import format
+
+    if hasattr(filename, 'read'):
+        mmap_mode = None
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive:
+        fid = open(filename, 'rb') if mmap_mode is not None else None
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') \
+                else info.filename
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = format.read_array(member)
+                continue
+            # Skip the local header of the member to find the .npy header.
+            fid.seek(info.header_offset)
+            local = fid.read(30)
+            name_len, extra_len = struct.unpack('<HH', local[26:30])
+            fid.seek(info.header_offset + 30 + name_len + extra_len)
+            version = format.read_magic(fid)
+            if version == (1, 0):
+                shape, fortran, dtype = format.read_array_header_1_0(fid)
+            else:
+                shape, fortran, dtype = format.read_array_header_2_0(fid)
+            if dtype.hasobject or 0 in shape:
+                with archive.open(info) as member:
+                    arrays[name] = format.read_array(member)
+            else:
+                arrays[name] = np.memmap(fid, dtype=dtype, mode=mmap_mode,
+                                         offset=fid.tell(), shape=shape,
+                                         order='F' if fortran else 'C')
+        if fid is not None:
+            fid.close()
+    text = arrays.pop('metadata', np.zeros(0, 'u1'))
+    metadata = json.loads(bytes(text).decode('utf-8')) if len(text) else {}
+    return metadata, arrays
+
+def _json_value(value):
+    """Convert numpy values for the JSON metadata."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError("%r cannot be saved as metadata"%(value,))
+
+def map_files(function, filenames, processes=None):
+    """
+    Return [function(f) for f in *filenames*], with None where the file
+    name is None.
+
+    The files are processed in separate threads, so that the time is
+    spent waiting for the disk together rather than for each file in turn.
+    Parsing holds the interpreter lock, so when there are many files
+    already in the disk cache use a pool of *processes* workers instead.
+    """
+    names = [f for f in filenames if f is not None]
+    if len(names) > 1 and processes != 1:
+        if processes is None:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(len(names), 16))
+        else:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+        try:
+            results = pool.map(function, names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [function(f) for f in names]
+    results = iter(results)
+    return [next(results) if f is not None else None for f in filenames]
+
+def cache_key(value):
+    """Return a hashable key for a value, including array contents."""
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, dict):
+        return tuple(sorted((k, cache_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(cache_key(v) for v in value)
+    return value
 
 def string_like(s):
     try:
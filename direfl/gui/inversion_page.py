@@ -58,7 +58,7 @@ from matplotlib.backend_bases import FigureManagerBase
 #from matplotlib import pyplot as plt
 import pylab
 
-from ..api.util import isstr
+from ..api.util import isstr, cached_loadtxt
 from ..api.invert import SurroundVariation, Inversion
 from .utilities import example_data
 
@@ -894,14 +894,14 @@ class InversionPage(wx.Panel):
         # 4-column data: Q, dQ, R, dR
         # 5-column data: Q, dQ, R, dR, Lambda
         if isstr(file1):
-            d1 = np.loadtxt(file1).T
+            d1 = cached_loadtxt(file1).T
             name1 = file1
         else:
             d1 = file1
             name1 = "data1"
 
         if isstr(file2):
-            d2 = np.loadtxt(file2).T
+            d2 = cached_loadtxt(file2).T
             name2 = file2
         else:
             d2 = file2
@@ -602,9 +602,10 @@ class SimulationPage(wx.Panel):
                                    sample_width=sample_width,
                                    sample_broadening=sample_broadening)
 
-            # Compute the resolution.
+            # Compute the resolution, reusing the previous result if the
+            # settings have not changed since the last Compute.
             Q = np.linspace(params[2], params[3], params[4])
-            res = instrument.resolution(Q=Q)
+            res, = instrument.resolution_batch([Q])
             Q = res.Q
             dQ = res.dQ
 
@@ -666,7 +667,7 @@ class SimulationPage(wx.Panel):
             print("*** len of Q, res.Q, res.dQ, L:",
                   len(Q), len(res.Q), len(res.dQ), len(L))
             '''
-            res = instrument.resolution(L=L, dL=dL)
+            res, = instrument.resolution_batch(L=[L], dL=[dL])
             Q = res.Q
             dQ = res.dQ
             # FIXME: perform_simulation fails if either Q or dQ is not None
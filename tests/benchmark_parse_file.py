@@ -0,0 +1,72 @@
+"""
+Time util.parse_file on large reduced data files.
+
+Usage::
+
+    python tests/benchmark_parse_file.py [rows]
+
+Writes a four column file with *rows* data lines (default 10^6), plain and
+gzip compressed, and compares :func:`direfl.api.util.parse_file` with the
+line by line parser it replaces.
+"""
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from direfl.api import util
+
+
+def line_parser(filename):
+    """The line by line parser previously used by util.parse_file."""
+    opener = gzip.open if filename.endswith('.gz') else open
+    header, data = {}, []
+    with opener(filename, 'rt') as fh:
+        for line in fh:
+            columns, key, value = util._parse_line(line)
+            if columns:
+                data.append([util.indfloat(v) for v in columns])
+            if key:
+                header[key] = value
+    return header, np.array(data).T
+
+
+def write_file(filename, rows):
+    data = np.random.rand(rows, 4)
+    data[::1000, 3] = np.inf
+    data[1::1000, 2] = np.nan
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wt') as fh:
+        fh.write("# title 'benchmark'\n# columns Q dQ R dR\n")
+        np.savetxt(fh, data, fmt='%.10g')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+    path = tempfile.mkdtemp()
+    try:
+        for name in ('data.refl', 'data.refl.gz'):
+            filename = os.path.join(path, name)
+            write_file(filename, rows)
+            size = os.path.getsize(filename)/2.**20
+            timings = []
+            for parse in (line_parser, util.parse_file):
+                start = time.time()
+                header, data = parse(filename)
+                timings.append(time.time() - start)
+            assert data.shape == (4, rows)
+            print("%-14s %6.1f MB  line parser %6.2f s  parse_file %6.2f s"
+                  "  (%.1fx)" % (name, size, timings[0], timings[1],
+                                 timings[0]/timings[1]))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import pytest
+
+from direfl.api import util
+
+
+@pytest.fixture(autouse=True)
+def _no_data_cache(monkeypatch):
+    # Tests must not leave copies of their data files in DIREFL_CACHE
+    monkeypatch.setattr(util, 'DATA_CACHE', None)
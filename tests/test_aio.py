@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from direfl.api import aio
+from direfl.api.invert import Inversion, SurroundVariation, refl
+from direfl.api.simulate import Simulation
+
+
+def _data():
+    Q = np.linspace(0, 0.3, 120)[1:]
+    R1 = abs(refl(Q, [0, 100, 0], [2.07, 4, 0]))**2
+    R2 = abs(refl(Q, [0, 100, 0], [2.07, 4, 6.33]))**2
+    return (Q, R1, 0.01*R1), (Q, R2, 0.01*R2)
+
+
+def test_reconstruct_and_invert():
+    data1, data2 = _data()
+    kw = dict(thickness=200, stages=20, rhopoints=64, seed=2)
+
+    async def main():
+        job = aio.reconstruct_async(data1, data2, 2.07, 0, 6.33, stages=10,
+                                    seed=1)
+        events = [event async for event in job]
+        phase = await job
+        inverter = await aio.invert_async(
+            data=(phase.Q, phase.RealR, phase.dRealR), **kw)
+        return events, phase, inverter
+
+    events, phase, inverter = asyncio.run(main())
+    assert events[-1] == aio.Progress('reconstruct', 10, 10)
+    assert len(events) == 10
+    local = SurroundVariation(data1, data2, 2.07, 0, 6.33, stages=10, seed=1)
+    assert np.array_equal(phase.RealR, local.RealR)
+    local = Inversion(data=(local.Q, local.RealR, local.dRealR), **kw)
+    local.run()
+    assert np.array_equal(inverter.rho, local.rho)
+    assert inverter.progress is None
+
+    async def no_stages():
+        job = aio.invert_async(data=(phase.Q, phase.RealR, phase.dRealR),
+                               **dict(kw, stages=0))
+        return [event async for event in job], await job
+
+    events, inverter = asyncio.run(no_stages())
+    assert events == [] and inverter.stages == 0
+
+
+def test_simulate():
+    q = np.linspace(0, 0.3, 120)
+    kw = dict(q=q, sample=[(5, 100, 3), (1, 123, 5)], u=2.1, v1=0, v2=4.5,
+              noise=0.05, seed=1, phase_args=dict(stages=5, seed=1),
+              invert_args=dict(stages=4, rhopoints=64, seed=1))
+
+    async def main():
+        with ThreadPoolExecutor(2) as executor:
+            jobs = [aio.simulate_async(executor=executor, **kw)
+                    for _ in range(2)]
+            steps = [(event.step, event.done) async for event in jobs[0]]
+            return steps, await asyncio.gather(*jobs)
+
+    steps, sims = asyncio.run(main())
+    assert steps[:5] == [('reconstruct', i) for i in range(1, 6)]
+    assert steps[-1] == ('invert', 4)
+    np.random.seed(0)
+    local = Simulation(**kw)
+    for sim in sims:
+        assert np.array_equal(sim.invert.rho, local.invert.rho)
+        assert 'progress' not in sim.invert_args
+        assert sim.invert.progress is None
+
+
+def test_cancel():
+    data1, data2 = _data()
+
+    async def main():
+        job = aio.reconstruct_async(data1, data2, 2.07, 0, 6.33, stages=10**6)
+        async for event in job:
+            if event.done == 3:
+                job.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+        return event
+
+    event = asyncio.run(main())
+    assert event.done < 100
+
+    async def cancel_task():
+        job = aio.reconstruct_async(data1, data2, 2.07, 0, 6.33, stages=10**6)
+        task = asyncio.ensure_future(job._result())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        with pytest.raises(asyncio.CancelledError):
+            await job
+        return job.done()
+
+    assert asyncio.run(cancel_task())
@@ -0,0 +1,141 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from direfl.api import calc
+from direfl.api.invert import refl, refl_batch, refl_surround
+
+# Sample with roughness, as used in test_invert: (rho, thickness, sigma)
+SAMPLE = ([5, 100, 3], (1, 123, 5), (3, 47, 5), [-1, 25, 5])
+U, V1, V2, UROUGH = 2.1, 0, 4.5, 2
+
+def _stack(v):
+    rho = [v] + [p[0] for p in SAMPLE] + [U]
+    d = [0] + [p[1] for p in SAMPLE] + [0]
+    sigma = [p[2] for p in SAMPLE] + [UROUGH]
+    return np.array(d, 'd'), np.array(rho, 'd'), np.array(sigma, 'd')
+
+def test_batch_matches_single():
+    Q = np.linspace(-0.3, 0.3, 121)
+    d, rho1, sigma = _stack(V1)
+    _, rho2, _ = _stack(V2)
+    rho = np.vstack((rho1, rho2))
+    for s in (None, sigma):
+        R = calc.reflectivity_amplitude_batch(Q, d, rho, sigma=s)
+        assert R.shape == (2, len(Q)) and R.flags.c_contiguous
+        for Ri, rhoi in zip(R, rho):
+            Rs = calc.reflectivity_amplitude(Q, d, rhoi, sigma=s)
+            assert np.allclose(Ri, Rs, rtol=0, atol=1e-14)
+
+def test_batch_matches_refl():
+    d, rho, sigma = _stack(V1)
+    # back reflectivity, as used by Simulation for r1, r2
+    Q = -np.linspace(0.005, 0.3, 60)
+    r = refl(Q, d, rho, sigma=sigma)
+    rb = refl_batch(Q, d, [rho], sigma=sigma)[0]
+    assert np.allclose(r, rb, rtol=0, atol=1e-12)
+    # free film in the substrate, as used by Inversion.refl
+    d, rho, _ = _stack(U)
+    Q = np.linspace(-0.3, 0.3, 121)
+    assert np.allclose(refl(Q, d, rho), refl_batch(Q, d, [rho])[0],
+                       rtol=0, atol=1e-12)
+
+def test_surround_matches_refl():
+    d, rho, sigma = _stack(0)
+    Q = np.linspace(-0.3, 0.3, 121)
+    media = [(U, V1, True), (U, V2, True), (U, U, False), (V2, V1, False)]
+    r = refl_surround(Q, d, rho, media, sigma=sigma)
+    assert r.shape == (len(media), len(Q))
+    for ri, (front, back, reverse) in zip(r, media):
+        if reverse:
+            expected = refl(-Q, d, np.r_[back, rho[1:-1], front], sigma=sigma)
+        else:
+            expected = refl(Q, d, np.r_[front, rho[1:-1], back], sigma=sigma)
+        assert np.allclose(ri, expected, rtol=0, atol=1e-12)
+
+def test_uniform_step():
+    # Smooth profile with absorption in part of it to exercise both paths
+    z = np.linspace(0, 200, 201)
+    rho = np.hstack((U, 3 + 2*np.sin(z[1:-1]/20), U))
+    mu = np.where(z > 150, 0.01, 0)
+    d = np.hstack((0, np.diff(z)[1:], 0))
+    Q = np.linspace(-0.3, 0.3, 121)
+    R = calc.reflectivity_amplitude(Q, d, rho, mu=mu)
+    Ru = calc.reflectivity_amplitude(Q, 1.0, rho, mu=mu)
+    assert np.allclose(R, Ru, rtol=0, atol=1e-12)
+
+def test_hybrid():
+    z = np.arange(800)*0.5
+    rho = np.hstack((0, 3 + 1.5*np.tanh((z-150)/10), U))
+    Q = np.linspace(-0.4, 0.4, 801)
+    exact = calc.reflectivity_amplitude(Q, 0.5, rho)
+    R, err = calc.reflectivity_amplitude_hybrid(Q, 0.5, rho, Qcut=0.15)
+    high = abs(Q) >= 0.15
+    actual = np.sqrt(np.sum(abs(R-exact)[high]**2)/np.sum(abs(exact[high])**2))
+    assert np.allclose(R[~high], exact[~high], rtol=0, atol=1e-14)
+    assert actual < 0.01 and err < 0.01
+    R, err = calc.reflectivity_amplitude_hybrid(Q, 0.5, rho, tol=0.005)
+    assert err <= 0.005
+
+def test_resolution_operator():
+    Qi = np.linspace(0.005, 0.3, 400)
+    Ri = np.exp(-30*Qi)*(1 + 0.3*np.sin(200*Qi))
+    Q = np.linspace(0.01, 0.29, 100)
+    for dQ in (0.02*Q, 0.003*np.ones_like(Q), 0*Q):
+        op = calc.ResolutionOperator(Qi, Q, dQ)
+        R = calc.convolve(Qi, Ri, Q, dQ)
+        assert np.allclose(op(Ri), R, rtol=1e-12, atol=0)
+        assert np.allclose(op(np.vstack((Ri, 2*Ri))), [R, 2*R],
+                           rtol=1e-12, atol=0)
+    assert op.matches(Qi, Q, 0) and not op.matches(Qi, Q, 0.001)
+
+def test_adaptive_theory():
+    # Thick film with a sharp critical edge is badly undersampled by Q alone
+    d, rho = [0, 800, 20, 0], [0, 4, 1, U]
+    f = lambda Q: abs(calc.reflectivity_amplitude(Q, d, rho))**2
+    Q = np.linspace(0.005, 0.15, 100)
+    dQ = 0.02*Q
+    Qt, Rt = calc.adaptive_theory(f, Q, dQ)
+    assert np.allclose(Rt, f(Qt), rtol=0, atol=0)
+    assert Qt[0] >= 0 and Qt[-1] > Q[-1]
+    R = calc.ResolutionOperator(Qt, Q, dQ)(Rt)
+    Qfine = np.linspace(0, 0.16, 100001)
+    exact = calc.convolve(Qfine, f(Qfine), Q, dQ)
+    assert np.max(abs(R-exact)/exact) < 2e-3
+    Qt2, Rt2 = calc.adaptive_theory(lambda Q: np.vstack((f(Q), f(Q))), Q, dQ)
+    assert np.array_equal(Qt, Qt2) and np.array_equal(Rt2[1], Rt)
+    # Repeated measurement points, e.g., from overlapping runs
+    Qr = np.hstack((Q[:50], Q[40:]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        Qt3, Rt3 = calc.adaptive_theory(f, Qr, 0.02*Qr)
+    assert np.array_equal(Qt3, Qt)
+
+def test_convolve_fft():
+    d, rho = [0, 800, 20, 0], [0, 4, 1, U]
+    Qi = np.linspace(0.002, 0.25, 5000)
+    Ri = abs(calc.reflectivity_amplitude(Qi, d, rho))**2
+    Q = np.linspace(0.01, 0.24, 200)
+    for dQ in (0.001*np.ones_like(Q), 0.02*Q):
+        direct = calc.convolve(Qi, Ri, Q, dQ, mode='direct')
+        fft = calc.convolve(Qi, Ri, Q, dQ, mode='fft')
+        assert np.max(abs(fft-direct)/direct) < 1e-3
+        # measuring from the other side
+        fft = calc.convolve(-Qi, Ri, -Q, dQ, mode='fft')
+        assert np.max(abs(fft-direct)/direct) < 1e-3
+    dQ = 0.001 + 0.01*Q
+    assert np.array_equal(calc.convolve(Qi, Ri, Q, dQ, mode='auto'),
+                          calc.convolve(Qi, Ri, Q, dQ, mode='direct'))
+    with pytest.raises(ValueError):
+        calc.convolve(Qi, Ri, Q, dQ, mode='fft')
+
+def test_convolve_fft_fringes():
+    # Fringes from a thick film, measured up to the ends of the theory
+    Qi = np.linspace(0.002, 0.25, 5000)
+    Ri = abs(calc.reflectivity_amplitude(Qi, [0, 2000, 0], [0, 4, U]))**2
+    Q = Qi[::25]
+    for dQ in (0.001*np.ones_like(Q), 0.02*Q):
+        direct = calc.convolve(Qi, Ri, Q, dQ)
+        auto = calc.convolve(Qi, Ri, Q, dQ, mode='auto')
+        assert np.max(abs(auto-direct)/direct) < 1e-3
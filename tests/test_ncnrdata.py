@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+
+from direfl.api import ncnrdata
+
+HEADER = """\
+# title "cross section %s"
+# instrument NG-1
+# columns Q R dR
+"""
+
+def _write_xsec(path, Q):
+    base = os.path.join(path, 'n101Gc1.refl')
+    for i, xs in enumerate('ABD'):
+        with open(base+xs, 'w') as fid:
+            fid.write(HEADER % xs)
+            np.savetxt(fid, np.array([Q, (i+1)*Q, 0.1*Q]).T)
+    return base
+
+def test_parse_files(tmpdir):
+    Q = np.linspace(0.01, 0.1, 20)
+    files = ncnrdata.find_xsec(_write_xsec(str(tmpdir), Q))
+    assert files[2] is None
+    parsed = ncnrdata.parse_files(files)
+    assert parsed[2] is None
+    for f, p in zip(files, parsed):
+        if f is not None:
+            header, data = ncnrdata.parse_file(f)
+            assert p[0] == header
+            assert np.array_equal(p[1], data)
+
+class _Resolution(object):
+    def probe(self, data, **kw):
+        return _Probe()
+
+class _Probe(object):
+    pass
+
+class _Instrument(ncnrdata.Monochromatic):
+    calls = 0
+    def resolution(self, Q, **kw):
+        self.calls += 1
+        return _Resolution()
+
+def test_shared_resolution(tmpdir):
+    Q = np.linspace(0.01, 0.1, 20)
+    files = ncnrdata.find_xsec(_write_xsec(str(tmpdir), Q))
+    instrument = _Instrument()
+    resolutions = {}
+    for f, parsed in zip(files, ncnrdata.parse_files(files)):
+        if f is not None:
+            ncnrdata._make_probe(f, parsed[0], parsed[1], instrument, {},
+                                 resolutions)
+    assert instrument.calls == 1
+    ncnrdata._make_probe(files[0], *ncnrdata.parse_file(files[0]),
+                         instrument=instrument, kw={'slits_at_Tlo': 0.2},
+                         resolutions=resolutions)
+    assert instrument.calls == 2
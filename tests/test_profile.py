@@ -0,0 +1,92 @@
+from math import erf, sqrt
+
+import numpy as np
+
+from direfl.api.invert import refl
+from direfl.api.profile import Microslabs, build_profile
+
+def _smooth(z, thickness, roughness, value):
+    # Point by point version of build_profile
+    offset = np.hstack((-np.inf, 0, np.cumsum(thickness[1:-1]), np.inf))
+    def blend(d, s):
+        return (d <= 0)*1.0 if s <= 0 else 0.5*(1 - erf(d/(s*sqrt(2))))
+    result = []
+    for zk in z:
+        i = np.searchsorted(offset, zk, 'right') - 1
+        v = value[i]
+        if i > 0:
+            v += (value[i-1]-value[i])*blend(zk-offset[i], roughness[i-1])
+        if i < len(value)-1:
+            v += (value[i+1]-value[i])*blend(offset[i+1]-zk, roughness[i])
+        result.append(v)
+    return np.array(result)
+
+def test_build_profile():
+    rng = np.random.RandomState(1)
+    n = 12
+    thickness = np.hstack((0, rng.uniform(0, 30, n-2), 0))
+    roughness = rng.uniform(0, 5, n-1)
+    roughness[::4] = 0
+    value = rng.uniform(-1, 6, n)
+    z = np.linspace(-20, np.sum(thickness)+20, 2001)
+    z = np.sort(np.hstack((z, np.cumsum(thickness[:-1]))))
+    assert np.allclose(build_profile(z, thickness, roughness, value),
+                       _smooth(z, thickness, roughness, value),
+                       rtol=0, atol=1e-12)
+
+def test_build_profile_substrate():
+    z = np.linspace(-5, 5, 11)
+    assert (build_profile(z, [0], [], [2.0]) == 2.0).all()
+
+def test_contract():
+    dz = 0.5
+    z = np.arange(-15, 310, dz)
+    rho = build_profile(z, [0, 100, 123, 47, 25, 0], [5, 3, 5, 5, 2],
+                        [2.07, 5, 1, 3, -1, 0])
+    n = len(z)
+    slabs = Microslabs(2, dz=dz)
+    slabs.extend(w=np.hstack((0, dz*np.ones(n), 0)), sigma=np.zeros(n+2),
+                 rho=[np.hstack((2.07, rho, 0))]*2, irho=np.zeros((2, n+2)))
+    w, rho = slabs.w.copy(), slabs.rho.copy()
+    ratio = slabs.contract(1e-3)
+    assert ratio > 2 and len(slabs)*ratio == len(w)
+    assert np.isclose(np.sum(slabs.w), np.sum(w))
+    assert np.allclose(np.sum(slabs.w*slabs.rho, axis=1), np.sum(w*rho, axis=1))
+    assert slabs.rho[0, 0] == 2.07 and slabs.rho[0, -1] == 0
+    # a rough interface is never merged away
+    slabs = Microslabs(1, dz=dz)
+    slabs.extend(w=[0, 1, 1, 1, 0], sigma=[0, 2, 0, 0, 0], rho=[[0, 1, 1, 1, 0]],
+                 irho=[[0]*5])
+    assert slabs.contract(1e-3) == 5/4
+    assert np.array_equal(slabs.w, [0, 1, 2, 0])
+
+def test_repeat():
+    slabs = Microslabs(1)
+    slabs.extend(w=[0, 20], sigma=[1, 2], rho=[[0, 3]], irho=[[0, 0]])
+    slabs.extend(w=[30, 45, 12], sigma=[3, 2, 4], rho=[[6.5, 1.2, 3]],
+                 irho=[[0, 0.01, 0]])
+    slabs.repeat(2, 50)
+    slabs.extend(w=[40, 0], sigma=[2, 0], rho=[[5, 2.07]], irho=[[0, 0]])
+    assert len(slabs) == 2 + 3*50 + 2
+    assert np.array_equal(slabs.w[2:8], [30, 45, 12, 30, 45, 12])
+    Q = np.linspace(-0.3, 0.3, 301)
+    r = refl(Q, slabs.w, slabs.rho[0], mu=2*slabs.irho[0], sigma=slabs.sigma)
+    assert np.allclose(slabs.reflectivity_amplitude(Q), r, rtol=0, atol=1e-12)
+    # contraction keeps the repeat intact
+    slabs.contract(1)
+    assert len(slabs) == 2 + 3*50 + 2
+    assert np.allclose(slabs.reflectivity_amplitude(Q), r, rtol=0, atol=1e-12)
+
+def test_storage():
+    slabs = Microslabs(2)
+    w = None
+    for i in range(100):
+        slabs.extend(w=[1.0], sigma=[0.5], rho=[[i], [-i]], irho=[[0], [1]],
+                     rhoM=[0.1*i], thetaM=[270])
+        w = slabs.w  # holding a view must not block growth
+    assert len(slabs) == 100 and np.shares_memory(slabs.rho, slabs._slabs)
+    w, sigma, rho, irho, rhoM, thetaM = slabs.freeze()
+    assert all(v.flags['C_CONTIGUOUS'] for v in (w, sigma, rho, irho))
+    assert rho.shape == (2, 100) and sigma.shape == (99,)
+    assert np.array_equal(rho[1], -np.arange(100))
+    assert np.allclose(rhoM, 0.1*np.arange(100)) and (thetaM == 270).all()
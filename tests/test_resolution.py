@@ -0,0 +1,53 @@
+import numpy as np
+
+from direfl.api import resolution
+from direfl.api.ncnrdata import NG1
+from direfl.api.snsdata import Liquids
+
+
+def test_opening_slits():
+    T = np.array([0.1, 0.5, 1, 2, 4])
+    s1, s2 = resolution.opening_slits(T=T, slits_at_Tlo=(0.1, 0.2), Tlo=0.5,
+                                      Thi=2, slits_above=1)
+    assert np.allclose(s1, [0.1, 0.1, 0.2, 0.4, 1])
+    assert np.allclose(s2, [0.2, 0.2, 0.4, 0.8, 1])
+    # Integer angles still give fractional openings
+    s1, s2 = resolution.opening_slits(T=[1, 2], slits_at_Tlo=0.1, Tlo=1)
+    assert np.allclose(s1, [0.1, 0.2])
+
+
+def test_divergence():
+    # Angle sets broadcast against each other
+    T = np.array([[0.1], [1.0]])*np.arange(1, 4)
+    dT = resolution.divergence(T=T, slits=0.2, distance=(1500., 200.),
+                               sample_width=20.)
+    for row, Trow in zip(dT, T):
+        for value, Tk in zip(row, Trow):
+            assert value == resolution.divergence(
+                T=Tk, slits=0.2, distance=(1500., 200.), sample_width=20.)
+
+
+def test_resolution_batch():
+    instrument = NG1(Tlo=0.5, slits_at_Tlo=0.2)
+    Q = [np.linspace(0.005, 0.2, n) for n in (10, 20, 30)]
+    batch = instrument.resolution_batch(Q)
+    for Qk, res in zip(Q, batch):
+        expected = instrument.resolution(Q=Qk)
+        assert np.allclose(res.Q, Qk)
+        assert np.allclose(res.dQ, expected.dQ)
+    # Same settings on a new instrument reuse the cached values
+    again = NG1(Tlo=0.5, slits_at_Tlo=0.2).resolution_batch(Q)
+    assert again[1].dT is batch[1].dT
+    assert not batch[1].dT.flags.writeable
+    changed = NG1(Tlo=0.5, slits_at_Tlo=0.3).resolution_batch(Q)
+    assert not np.allclose(changed[1].dT, batch[1].dT)
+
+    instrument = Liquids(slits=(0.5, 0.5))
+    L = resolution.bins(2, 15, 0.02)
+    dL = resolution.binwidths(L)
+    batch = instrument.resolution_batch(L, dL, T=[0.6, 1.2, 2.4])
+    for T, res in zip([0.6, 1.2, 2.4], batch):
+        expected = instrument.resolution(L=L, dL=dL, T=T)
+        assert np.allclose(res.Q, expected.Q)
+        assert np.allclose(res.dQ, expected.dQ)
+    assert L.flags.writeable
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+from direfl.api.invert import Inversion, SurroundVariation, refl
+from direfl.api.service import Client, InversionService, ServiceBusy
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    data_root = str(tmp_path_factory.mktemp("data"))
+    service = InversionService(port=0, processes=2, queue_size=2,
+                               data_root=data_root).start()
+    yield service
+    service.close()
+
+
+def _client(service, **kw):
+    return Client("http://%s:%d"%tuple(service.address), **kw)
+
+
+def _data():
+    Q = np.linspace(0, 0.3, 120)[1:]
+    R1 = abs(refl(Q, [0, 100, 0], [2.07, 4, 0]))**2
+    R2 = abs(refl(Q, [0, 100, 0], [2.07, 4, 6.33]))**2
+    return (Q, R1, 0.01*R1), (Q, R2, 0.01*R2)
+
+
+def test_reconstruct_and_invert(service):
+    client = _client(service)
+    data1, data2 = _data()
+    phase = client.reconstruct(data1=data1, data2=data2, u=2.07, v1=0,
+                               v2=6.33, stages=10, seed=1)
+    local = SurroundVariation(data1, data2, u=2.07, v1=0, v2=6.33,
+                              stages=10, seed=1)
+    assert isinstance(phase, SurroundVariation)
+    assert np.array_equal(phase.RealR, local.RealR)
+
+    kw = dict(thickness=200, stages=3, rhopoints=64, seed=2)
+    inverter = client.invert(data=(phase.Q, phase.RealR, phase.dRealR), **kw)
+    local = Inversion(data=(local.Q, local.RealR, local.dRealR), **kw)
+    local.run()
+    assert isinstance(inverter, Inversion)
+    assert np.array_equal(inverter.rho, local.rho)
+
+    # Reconstruction and inversion in one job
+    both = client.invert(data1=data1, data2=data2, u=2.07, v1=0, v2=6.33,
+                         phase_args=dict(stages=10, seed=1), **kw)
+    assert np.array_equal(both.rho, local.rho)
+    assert client.status()['completed'] >= 3
+
+
+def test_errors(service):
+    client = _client(service, retry=False)
+    data = ([0, 0.1, 0.2], [1, 0.5, 0.1])
+    with pytest.raises(ValueError, match="Invalid job parameter bogus"):
+        client.invert(data=data, bogus=1)
+    # Only the numeric controls are accepted
+    for bad in (dict(cache="/tmp"), dict(showiters=True),
+                dict(progress=None), dict(thickness="200")):
+        with pytest.raises(ValueError):
+            client.invert(data=data, **bad)
+    with pytest.raises(ValueError, match="Invalid job parameter cache"):
+        client.invert(data1=data, data2=data, phase_args=dict(cache="/tmp"))
+    # Data files must be in the data directory
+    with pytest.raises(ValueError, match="outside the data directory"):
+        client.invert(data="../../etc/passwd")
+    with pytest.raises(ValueError, match="outside the data directory"):
+        client.reconstruct(data1="/etc/passwd", data2="x", u=2.07, v1=0, v2=6)
+    # Jobs beyond the queue size are refused rather than queued
+    for _ in range(service.queue_size):
+        service._slots.acquire()
+    try:
+        with pytest.raises(ServiceBusy):
+            client.invert(data=([0, 0.1, 0.2], [1, 0.5, 0.1]))
+    finally:
+        for _ in range(service.queue_size):
+            service._slots.release()
+    assert client.status()['rejected'] == 1
+
+
+def test_data_root(service):
+    client = _client(service)
+    Q = np.linspace(0, 0.3, 120)[1:]
+    RealR = refl(Q, [0, 100, 0], [2.07, 4, 0]).real
+    np.savetxt(os.path.join(service.data_root, 'film.real'),
+               np.array([Q, RealR, 0.01*abs(RealR)+1e-6]).T)
+    kw = dict(thickness=200, stages=2, rhopoints=64, seed=2)
+    inverter = client.invert(data='film.real', **kw)
+    local = Inversion(data=os.path.join(service.data_root, 'film.real'), **kw)
+    local.run()
+    assert np.array_equal(inverter.rho, local.rho)
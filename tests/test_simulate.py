@@ -0,0 +1,316 @@
+import os
+
+import numpy as np
+import pytest
+
+from direfl.api.invert import (Inversion, SurroundVariation, invert_batch,
+                               load_results)
+from direfl.api.simulate import Simulation, choose_surround, plan
+
+SAMPLES = [([5, 100, 3], (1, 123, 5), (3, 47, 5), [-1, 25, 5]),
+           ([4, 80, 3], (2, 100, 4))]
+KW = dict(u=2.1, urough=2, phase_args=dict(stages=5),
+          invert_args=dict(iters=6, stages=2, calcpoints=4, rhopoints=64))
+
+def test_plan():
+    q = [np.linspace(0, 0.3, 120), np.linspace(0, 0.2, 100)]
+    serial = plan(SAMPLES, surrounds=[(0, 4.5)], noise=[0.02, 0.08], q=q,
+                  processes=1, **KW)
+    assert len(serial) == 8
+    assert list(serial['seed']) == list(range(1, 9))
+    assert np.isfinite(serial['chisq']).all()
+    assert np.isfinite(serial['profile_error']).all()
+    parallel = plan(SAMPLES, surrounds=[(0, 4.5)], noise=[0.02, 0.08], q=q,
+                    processes=2, **KW)
+    assert np.array_equal(serial['chisq'], parallel['chisq'])
+    assert np.array_equal(serial['profile_error'], parallel['profile_error'])
+
+def test_plan_rng():
+    # Cases do not disturb the global generator, and failures are reported
+    q = np.linspace(0, 0.3, 120)
+    kw = dict(KW, invert_args=dict(KW['invert_args'], bogus=1))
+    np.random.seed(5)
+    state = np.random.get_state()[1].copy()
+    with pytest.warns(UserWarning, match="case 0 failed: .*Invalid keyword"):
+        table = plan(SAMPLES[:1], surrounds=[(0, 4.5)], q=q, processes=1,
+                     **kw)
+    assert np.isnan(table['chisq']).all()
+    table = plan(SAMPLES[:1], surrounds=[(0, 4.5)], q=q, processes=1, **KW)
+    assert np.isfinite(table['chisq']).all()
+    assert np.array_equal(np.random.get_state()[1], state)
+
+def test_invert_batch():
+    q = np.linspace(0, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0.05,
+                     seed=1, **KW)
+    rng = np.random.RandomState(2)
+    R1 = rng.normal(sim.R1theory, 0.05*sim.R1theory, size=(3, len(q)))
+    R2 = rng.normal(sim.R2theory, 0.05*sim.R2theory, size=(3, len(q)))
+    np.random.seed(3)
+    phase = SurroundVariation((q, R1, 0.05*sim.R1theory),
+                              (q, R2, 0.05*sim.R2theory),
+                              u=2.1, v1=0, v2=4.5, stages=5)
+    assert phase.RealR.shape == (3, len(phase.Q))
+
+    # Each row is the same as a separate inversion of that row.
+    kw = dict(thickness=400, substrate=2.1, **KW['invert_args'])
+    np.random.seed(4)
+    batch = invert_batch(phase.Q, phase.RealR, phase.dRealR, **kw)
+    assert len(batch) == 3
+    np.random.seed(4)
+    for inv, re, dre in zip(batch, phase.RealR, phase.dRealR):
+        keep = np.isfinite(re)
+        single = Inversion(data=(phase.Q[keep], re[keep], dre[keep]), **kw)
+        single.run()
+        assert np.allclose(inv.rho, single.rho, rtol=0, atol=1e-12)
+        assert np.allclose(inv.drho, single.drho, rtol=0, atol=1e-12)
+
+    # Rows can have their own seeds
+    seeded = invert_batch(phase.Q, phase.RealR[[0, 0]], phase.dRealR[[0, 0]],
+                          seed=[5, 6], **kw)
+    assert not np.array_equal(seeded[0].rho, seeded[1].rho)
+    single = Inversion(data=(phase.Q, phase.RealR[0], phase.dRealR[0]),
+                       seed=6, **kw)
+    single.run()
+    assert np.allclose(seeded[1].rho, single.rho, rtol=0, atol=1e-12)
+
+def test_replicates():
+    q = np.linspace(0, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0.05,
+                     seed=1, **KW)
+    np.random.seed(3)
+    result = sim.replicates(4, seed=2)
+    assert result.rho.shape == (4, len(result.z))
+    assert result.target.shape == result.z.shape
+    assert np.isfinite(result.error).all()
+    assert (result.error < 2).all()
+    np.random.seed(3)
+    assert np.array_equal(result.rho, sim.replicates(4, seed=2).rho)
+    # All of the noise comes from the seed, with a different inversion
+    # seed for each replicate even when invert_args has one
+    sim.invert_args = dict(KW['invert_args'], seed=1)
+    state = np.random.get_state()[1].copy()
+    seeded = sim.replicates(4, seed=2)
+    assert np.array_equal(np.random.get_state()[1], state)
+    assert np.array_equal(seeded.rho, sim.replicates(4, seed=2).rho)
+
+def test_choose_surround():
+    surrounds = [(0, 6.33), (0, 4.5), (-0.56, 0)]
+    kw = dict(KW, substrates=[KW['u']])
+    del kw['u']
+    cache = {}
+    table = choose_surround(SAMPLES[0], surrounds=surrounds, replicates=2,
+                            processes=1, cache=cache, **kw)
+    assert list(table['rank']) == [1, 2, 3]
+    assert np.isfinite(table['error']).all()
+    assert np.all(np.diff(table['error']) >= 0)
+    assert sorted(zip(table['v1'], table['v2'])) == sorted(surrounds)
+    assert len(cache) == 3
+    # Cached candidates are not evaluated again.
+    again = choose_surround(SAMPLES[0], surrounds=surrounds[:2],
+                            replicates=2, processes=1, cache=cache, **kw)
+    assert len(cache) == 3
+    assert set(again['error']) <= set(table['error'])
+    # Without a cache the global generator is left alone
+    np.random.seed(5)
+    state = np.random.get_state()[1].copy()
+    fresh = choose_surround(SAMPLES[0], surrounds=surrounds[:1], replicates=2,
+                            processes=1, **kw)
+    assert fresh['error'][0] in set(table['error'])
+    assert np.array_equal(np.random.get_state()[1], state)
+    # Only the measurements are simulated for the replicates
+    sim = Simulation(q=np.linspace(0, 0.3, 150), sample=SAMPLES[0],
+                     noise=0.05, run=False, **KW)
+    assert not hasattr(sim, 'phase') and not hasattr(sim, 'invert')
+    assert sim.replicates(2, seed=1).rho.shape[0] == 2
+
+def test_result_cache(tmpdir):
+    q = np.linspace(0, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0.05,
+                     seed=1, **KW)
+    data1 = q, sim.R1theory, 0.05*sim.R1theory
+    data2 = q, sim.R2theory, 0.05*sim.R2theory
+    cache = str(tmpdir)
+    phase = SurroundVariation(data1, data2, u=2.1, v1=0, v2=4.5, stages=5,
+                              seed=1, cache=cache)
+    again = SurroundVariation(data1, data2, u=2.1, v1=0, v2=4.5, stages=5,
+                              seed=1, cache=cache)
+    assert np.array_equal(phase.dRealR, again.dRealR)
+    assert np.array_equal(phase.Q, again.Q)
+
+    kw = dict(data=(phase.Q, phase.RealR, phase.dRealR), thickness=400,
+              substrate=2.1, seed=2, **KW['invert_args'])
+    direct = Inversion(**kw)
+    direct.run()
+    cached = Inversion(cache=cache, **kw)
+    cached.run()
+    assert np.array_equal(direct.rho, cached.rho)
+    restored = Inversion(cache=cache, **kw)
+    restored.run()
+    assert np.array_equal(direct.drho, restored.drho)
+    assert len(tmpdir.listdir()) == 2
+
+def test_save_results(tmpdir):
+    q = np.linspace(0, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0.05,
+                     seed=1, **KW)
+    filename = os.path.join(str(tmpdir), 'phase.npz')
+    sim.phase.save_results(filename)
+    phase = load_results(filename)
+    assert isinstance(phase, SurroundVariation)
+    assert (phase.u, phase.v1, phase.v2) == (2.1, 0, 4.5)
+    for k in ('Q', 'RealR', 'ImagR', 'dRealR', 'R1in', 'dR2in'):
+        assert np.array_equal(getattr(phase, k), getattr(sim.phase, k))
+
+    filename = os.path.join(str(tmpdir), 'inversion.npz')
+    sim.invert.save_results(filename)
+    inverter = load_results(filename)
+    assert isinstance(inverter, Inversion)
+    assert inverter.stages == sim.invert.stages
+    assert isinstance(inverter.profiles[1][1], np.memmap)
+    for k in ('Q', 'RealR', 'dRealR', 'z', 'rho', 'drho'):
+        assert np.array_equal(getattr(inverter, k), getattr(sim.invert, k))
+    sim.invert.save_results(filename, dtype='f4')
+    inverter = load_results(filename)
+    assert inverter.profiles[0][1].dtype == np.float32
+    assert np.allclose(inverter.rho, sim.invert.rho, atol=1e-4)
+
+def test_run_batch(tmpdir):
+    import json
+    from direfl.api.invert import read_manifest, run_batch
+    q = np.linspace(0, 0.3, 120)[1:]
+    path = str(tmpdir)
+    for i in (1, 2):
+        sim = Simulation(q=q, sample=SAMPLES[i-1], v1=0, v2=4.5, noise=0.05,
+                         seed=i, **KW)
+        np.savetxt(os.path.join(path, 'run%d_a.refl'%i),
+                   np.array([q, sim.R1theory, 0.05*sim.R1theory]).T)
+        np.savetxt(os.path.join(path, 'run%d_b.refl'%i),
+                   np.array([q, sim.R2theory, 0.05*sim.R2theory]).T)
+    phase = sim.phase
+    np.savetxt(os.path.join(path, 'film.amp'),
+               np.array([phase.Q, phase.RealR, phase.dRealR]).T)
+    with open(os.path.join(path, 'bad.amp'), 'w') as fid:
+        fid.write("not data\n")
+    with open(os.path.join(path, 'sets.txt'), 'w') as fid:
+        fid.write("# pairs\n"
+                  "run*_a.refl run*_b.refl v1=0 v2=4.5 seed=1\n"
+                  "film.amp thickness=300 name=film_thin  # amplitude\n"
+                  "bad.amp\n")
+    datasets = read_manifest(os.path.join(path, 'sets.txt'))
+    assert [d['name'] for d in datasets] == ['run1_a', 'run2_a', 'film_thin',
+                                             'bad']
+    assert datasets[2]['kw'] == dict(thickness=300)
+
+    outdir = os.path.join(path, 'out')
+    kw = dict(substrate=2.1, **KW['invert_args'])
+    rows = run_batch(datasets, outdir=outdir, processes=2, **kw)
+    assert [row['status'] for row in rows] == ['ok', 'ok', 'ok', 'failed']
+    assert all(np.isfinite(row['chisq']) for row in rows[:3])
+    assert os.path.exists(os.path.join(outdir, 'run2_a.amp'))
+    assert os.path.exists(os.path.join(outdir, 'film_thin.prf'))
+    with open(os.path.join(outdir, 'summary.json')) as fid:
+        summary = json.load(fid)
+    assert summary['failed'] == ['bad']
+    serial = run_batch(datasets[:1], outdir=outdir, processes=1, **kw)
+    assert serial[0]['chisq'] == rows[0]['chisq']
+
+def test_dz(tmpdir, monkeypatch):
+    # -z gives the same profile step in single and batch mode
+    from direfl.api import invert
+    path = str(tmpdir)
+    sim = Simulation(q=np.linspace(0, 0.3, 120), sample=SAMPLES[0], v1=0,
+                     v2=4.5, noise=0.05, seed=1, **KW)
+    amp = os.path.join(path, 'film.amp')
+    np.savetxt(amp, np.array([sim.phase.Q, sim.phase.RealR,
+                              sim.phase.dRealR]).T)
+    options = ['-t', '150', '-z', '2', '--stages', '2', '--seed', '1', '-q']
+    single = os.path.join(path, 'single.prf')
+    monkeypatch.setattr('sys.argv', ['invert', amp, '-o', single] + options)
+    invert.main()
+    with open(os.path.join(path, 'sets.txt'), 'w') as fid:
+        fid.write("film.amp\n")
+    outdir = os.path.join(path, 'out')
+    monkeypatch.setattr('sys.argv', ['invert', '--manifest',
+                                     os.path.join(path, 'sets.txt'),
+                                     '--outdir', outdir] + options)
+    invert.main()
+    # rhopoints = thickness/dz
+    assert len(np.loadtxt(single)) == 75
+    assert np.array_equal(np.loadtxt(os.path.join(outdir, 'film.prf')),
+                          np.loadtxt(single))
+
+def test_watch(tmpdir):
+    from direfl.api.invert import watch
+    q = np.linspace(0, 0.3, 120)[1:]
+    path = str(tmpdir)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0.05,
+                     seed=1, **KW)
+    def write(name, R):
+        np.savetxt(os.path.join(path, name), np.array([q, R, 0.05*R]).T)
+    write('run1_a.refl', sim.R1theory)
+    write('run1_b.refl', sim.R2theory)
+    write('run2_a.refl', sim.R1theory)  # pair not yet complete
+    kw = dict(patterns=('*_a.refl', '*_b.refl'), settle=0, once=True,
+              verbose=False, v1=0, v2=4.5, substrate=2.1, seed=1,
+              **KW['invert_args'])
+    rows = watch(path, **kw)
+    assert sorted(rows) == ['run1_a']
+    outdir = os.path.join(path, 'inverted')
+    assert os.path.exists(os.path.join(outdir, 'run1_a.prf'))
+
+    # Only new and changed sets are processed on later scans
+    write('run2_b.refl', sim.R2theory)
+    mtime = os.path.getmtime(os.path.join(outdir, 'run1_a.prf'))
+    rows = watch(path, **kw)
+    assert sorted(rows) == ['run1_a', 'run2_a']
+    assert rows['run2_a']['status'] == 'ok'
+    assert os.path.getmtime(os.path.join(outdir, 'run1_a.prf')) == mtime
+    # run2 repeats the data of run1, so its results come from the cache
+    assert len(os.listdir(os.path.join(outdir, 'cache'))) == 2
+
+    # Unseeded sets are not cached, so each draws fresh noise
+    del kw['seed']
+    rows = watch(path, outdir=os.path.join(path, 'fresh'), **kw)
+    assert rows['run1_a']['chisq'] != rows['run2_a']['chisq']
+    assert not os.path.exists(os.path.join(path, 'fresh', 'cache'))
+
+def test_surround_resolution():
+    # The theory points for the resolution are chosen for each profile
+    q = np.linspace(0.005, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0, seed=1,
+                     **KW)
+    data1 = (q, 0.02*q, sim.R1, 0.01*sim.R1)
+    data2 = (q, 0.02*q, sim.R2, 0.01*sim.R2)
+    phase = SurroundVariation(data1, data2, u=2.1, v1=0, v2=4.5, stages=2)
+    z = np.linspace(0, 300, 151)
+    rho = 2 + np.sin(z/30)
+    first = phase.refl(z, rho)
+    resolution = phase._resolution
+    assert np.array_equal(phase.refl(z, rho)[0], first[0])
+    assert phase._resolution is resolution
+    thick = np.linspace(0, 900, 451)
+    R1, R2 = phase.refl(thick, 2 + np.sin(thick/30))
+    assert phase._resolution is not resolution
+    fresh = SurroundVariation(data1, data2, u=2.1, v1=0, v2=4.5, stages=2)
+    expected = fresh.refl(thick, 2 + np.sin(thick/30))
+    assert np.array_equal(R1, expected[0]) and np.array_equal(R2, expected[1])
+
+    # During optimization the points for the initial profile are kept
+    grids = []
+    def refl(z, rho, resid=False):
+        result = SurroundVariation.refl(phase, z, rho, resid=resid)
+        grids.append(phase._resolution)
+        return result
+    phase.refl = refl
+    z = np.linspace(0, 300, 11)
+    phase.optimize(z, 2 + np.sin(z/30))
+    assert len(set(map(id, grids))) == 1 and not phase._fixed_theory
+
+def test_refl_tol():
+    q = np.linspace(0, 0.3, 120)
+    sim = Simulation(q=q, sample=SAMPLES[0], v1=0, v2=4.5, noise=0, **KW)
+    Q = np.linspace(0.001, 2, 4000)
+    exact = sim.invert.refl(Q)
+    approx = sim.invert.refl(Q, tol=5e-3)
+    assert np.max(abs(approx-exact)) < 1e-3*np.max(abs(exact))
@@ -0,0 +1,68 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from direfl.api import snsdata
+from direfl.api.resolution import Resolution, binwidths
+from direfl.api.util import QL2T
+
+HEADER = """\
+#F /SNS/REF_L/IPTS-1234/%(run)s.nxs
+#D 2011-03-01 12:00:00
+#C Title: run %(run)s
+#C Detector Angle: (%(angle)g, 'degrees')
+#C Notes: none
+#L Q(1/A) dQ(1/A) R() dR() L(A)
+"""
+
+def _write_runs(path):
+    L = 2*1.02**np.arange(50)
+    for i, angle in enumerate((0.6, 0.6, 1.2, 0.6)):
+        run = 'REF_L_%d' % (1000+i)
+        Q = 4*np.pi*np.sin(np.radians(angle))/L
+        data = np.array([Q, 0.02*Q, (i+1)*np.exp(-Q*50), 0.01+0*Q, L]).T
+        with open(os.path.join(path, run+'.txt'), 'w') as fid:
+            # The header angle is ignored, as it is by load()
+            fid.write(HEADER % dict(run=run, angle=2*angle))
+            np.savetxt(fid, data)
+
+def test_load_batch(tmpdir, monkeypatch):
+    path = str(tmpdir)
+    _write_runs(path)
+    with open(os.path.join(path, 'notes.txt'), 'w') as fid:
+        fid.write("not a data file\n")
+    with pytest.warns(UserWarning, match="notes.txt"):
+        table = snsdata.load_batch(path, slits=(0.5, 0.5))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        parallel = snsdata.load_batch(path, processes=2, slits=(0.5, 0.5))
+    assert np.array_equal(parallel.R, table.R)
+    assert len(table) == 4
+    assert [f for f, _ in table.errors] == [os.path.join(path, 'notes.txt')]
+    assert list(table.runs['instrument']) == ['Liquids']*4
+    assert np.allclose(table.runs['angle'], [0.6, 0.6, 1.2, 0.6])
+    # Runs at the same angle share a resolution
+    assert list(table.runs['group']) == [0, 0, 1, 0]
+    assert len(table.resolutions) == 2
+    for i in range(len(table)):
+        filename = table.runs['filename'][i]
+        header, data = snsdata.parse_file(filename)
+        Q, dQ, R, dR = table.data(i)
+        assert np.array_equal(np.array([Q, dQ, R, dR]), data[:4])
+        resolution = table.resolution(i)
+        expected = snsdata.Polychromatic().resolution(
+            L=data[4], dL=binwidths(data[4]), T=QL2T(Q[0], data[4][0]),
+            slits=(0.5, 0.5), **header)
+        assert np.allclose(resolution.dQ, expected.dQ)
+        # load() gives the same resolution for the file; its probe needs
+        # the fitting package, so return the resolution instead.
+        monkeypatch.setattr(Resolution, 'probe', lambda self, **kw: self)
+        single = snsdata.load(filename, slits=(0.5, 0.5))
+        assert np.array_equal(single.dQ, resolution.dQ)
+
+    # Glob patterns select a subset
+    table = snsdata.load_batch(os.path.join(path, 'REF_L_100[01].txt'),
+                               slits=(0.5, 0.5))
+    assert len(table) == 2 and len(table.resolutions) == 1
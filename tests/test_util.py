@@ -0,0 +1,119 @@
+import gzip
+import io
+import os
+
+import numpy as np
+
+from direfl.api import util
+
+TEXT = """\
+# title 'my sample'
+# columns Q R dR
+# 0.1 0.2 0.3
+1 inf NaN
+-INF 2 3 # trailing comment
+
+   # indented comment
+# title second line
+4 5e-3 nan
+"""
+
+def _check(header, data):
+    assert header == {'title': 'my sample\nsecond line', 'columns': 'Q R dR'}
+    expected = np.array([[1, np.inf, np.nan], [-np.inf, 2, 3],
+                         [4, 5e-3, np.nan]]).T
+    assert np.array_equal(data, expected, equal_nan=True)
+
+def test_parse_file(tmpdir):
+    _check(*util.parse_file(io.StringIO(TEXT)))
+    filename = os.path.join(str(tmpdir), 'data.refl.gz')
+    with gzip.open(filename, 'wt') as fh:
+        fh.write(TEXT)
+    _check(*util.parse_file(filename))
+    assert util.parse_file(io.StringIO("# title empty\n"))[1].shape == (0,)
+
+def test_data_blocks():
+    # Blocks which end part way through a line or a header
+    for blocksize in (1, 5, 17):
+        header = {}
+        blocks = util._data_blocks(io.StringIO(TEXT), header, blocksize)
+        lines = [line for block in blocks for line in block]
+        assert not any(line.startswith('#') for line in lines)
+        assert len([line for line in lines if line.strip()[:1].isdigit()
+                    or line.strip()[:1] == '-']) == 3
+        assert header['title'] == 'my sample\nsecond line'
+
+def test_cached_loadtxt(tmpdir, monkeypatch):
+    cache = os.path.join(str(tmpdir), 'cache')
+    monkeypatch.setattr(util, 'DATA_CACHE', cache)
+    filename = os.path.join(str(tmpdir), 'data.refl')
+    np.savetxt(filename, np.arange(12.).reshape(4, 3))
+    first = util.cached_loadtxt(filename)
+    assert len(os.listdir(cache)) == 1
+    again = util.cached_loadtxt(filename)
+    assert isinstance(again, np.memmap)
+    assert np.array_equal(first, again)
+    cols = util.cached_loadtxt(filename, usecols=(0, 2))
+    assert np.array_equal(cols, first[:, [0, 2]])
+    assert len(os.listdir(cache)) == 2
+
+    # A changed file replaces its old copy
+    np.savetxt(filename, np.arange(15.).reshape(5, 3))
+    changed = util.cached_loadtxt(filename)
+    assert changed.shape == (5, 3)
+    assert len(os.listdir(cache)) == 2
+
+    # Copies beyond DATA_CACHE_SIZE are removed, least recently used first
+    names = sorted(os.listdir(cache), key=lambda name: os.path.getsize(
+        os.path.join(cache, name)))
+    os.utime(os.path.join(cache, names[0]), (0, 0))
+    size = os.path.getsize(os.path.join(cache, names[1]))
+    monkeypatch.setattr(util, 'DATA_CACHE_SIZE', 2*size)
+    other = os.path.join(str(tmpdir), 'other.refl')
+    np.savetxt(other, np.arange(15.).reshape(5, 3)+1)
+    util.cached_loadtxt(other)
+    assert len(os.listdir(cache)) == 2 and names[1] in os.listdir(cache)
+
+    # Without a cache directory nothing is written
+    monkeypatch.setattr(util, 'DATA_CACHE', None)
+    assert not isinstance(util.cached_loadtxt(filename), np.memmap)
+
+def test_result_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'results')
+    cache = util.ResultCache(path, maxsize=4500)
+    x = np.arange(100.)
+    key = cache.key('test', x, dict(a=1, b=None))
+    assert key == cache.key('test', x.copy(), dict(b=None, a=1))
+    assert key != cache.key('test', x+1, dict(a=1, b=None))
+    assert cache.get(key) is None
+    cache.put(key, dict(x=x, y=[x, x]))
+    result = cache.get(key)
+    assert np.array_equal(result['x'], x)
+    assert result['y'].shape == (2, 100)
+
+    # Results beyond maxsize are removed, least recently used first
+    cache.put('other', dict(x=x))
+    os.utime(os.path.join(path, 'other.npz'), (0, 0))
+    cache.get(key)
+    cache.put('third', dict(x=x))
+    assert cache.get('other') is None
+    assert cache.get(key) is not None and cache.get('third') is not None
+    cache.clear()
+    assert os.listdir(path) == []
+
+def test_save_npz(tmpdir):
+    filename = os.path.join(str(tmpdir), 'result.npz')
+    a = np.arange(24.).reshape(4, 6)
+    arrays = dict(a=a, f=np.asfortranarray(a), empty=np.zeros(0), missing=None)
+    util.save_npz(filename, arrays, dict(x=np.float64(2.5), y=None, name='run'))
+    metadata, arrays = util.load_npz(filename)
+    assert metadata == dict(x=2.5, y=None, name='run')
+    assert sorted(arrays) == ['a', 'empty', 'f']
+    assert isinstance(arrays['a'], np.memmap)
+    assert np.array_equal(arrays['a'], a) and np.array_equal(arrays['f'], a)
+    assert arrays['empty'].shape == (0,)
+    metadata, arrays = util.load_npz(filename, mmap_mode=None)
+    assert not isinstance(arrays['a'], np.memmap)
+    # The file is a standard .npz file
+    with np.load(filename) as data:
+        assert np.array_equal(data['a'], a)